@@ -1,9 +1,9 @@
-from typing import Callable, List
+import functools
+from typing import Callable, List, Tuple, Union
 
 import numpy as np
-from field import Field3, UniformField
+from field import Field3, TimeVaryingField, UniformField, interpolate_values
 from numba import jit
-from scipy.integrate import odeint
 from vector import Vector3
 
 
@@ -28,9 +28,14 @@ class Balloon:
     k_ratio_fuel = 4870.0  # %
     k_ratio_vent = 1485.0  # %
 
-    def __init__(self, wind_field: Field3 = UniformField(Vector3(0.0, 0.0, 0.0))):
+    def __init__(
+        self,
+        wind_field: Union[Field3, TimeVaryingField] = UniformField(
+            Vector3(0.0, 0.0, 0.0)
+        ),
+    ):
         """
-        Initializes the balloon with the given acceleration field.
+        Initializes the balloon with the given acceleration field, which may vary in time.
         """
         # Initialize mutable state.
         self.time: float = 0.0
@@ -41,13 +46,28 @@ class Balloon:
         self.vent: float = 0.0
 
         # Initialize immutable state.
-        self.wind_field: Field3 = wind_field
+        self.wind_field: Union[Field3, TimeVaryingField] = wind_field
 
-        # Compile the derivative helper.
+        # Get the compiled derivative helper, which is shared by all balloons.
         self.derivative_helper: Callable[
             [np.ndarray, np.ndarray, float, float], np.ndarray
         ] = self.make_derivative_helper()
 
+    def __getstate__(self) -> dict:
+        """
+        Returns the state to pickle. The compiled derivative helper is not pickled.
+        """
+        state = self.__dict__.copy()
+        del state["derivative_helper"]
+        return state
+
+    def __setstate__(self, state: dict):
+        """
+        Restores the pickled state along with the shared compiled derivative helper.
+        """
+        self.__dict__.update(state)
+        self.derivative_helper = self.make_derivative_helper()
+
     def get_time(self) -> float:
         """
         Returns the current time in seconds.
@@ -96,25 +116,36 @@ class Balloon:
         """
         self.vent = value / self.k_ratio_vent
 
-    def derivative(self, x: np.ndarray, _) -> np.ndarray:
+    def get_wind(self, position: Vector3, time: float) -> Vector3:
+        """
+        Returns the wind velocity in meters per second at the given position in meters and time in
+        seconds. The time is ignored unless the wind varies in time.
+        """
+        if isinstance(self.wind_field, TimeVaryingField):
+            return self.wind_field(position, time)
+        return self.wind_field(position)
+
+    def derivative(self, x: np.ndarray, time: float) -> np.ndarray:
         """
         Returns the derivative for computing the balloon's simulation trajectory.
         """
-        # Evaluate the wind velocity at the current position.
-        dimensionless_position = Vector3(*x[0:3])
+        # Evaluate the wind velocity at the current position and time.
+        wind = self.get_wind(
+            Vector3(*x[0:3]) * self.k_ratio_distance, time * self.k_ratio_time
+        )
         wind_velocity = np.array(
-            self.wind_field(dimensionless_position * self.k_ratio_distance)
-            * (self.k_ratio_time / self.k_ratio_distance),
-            dtype=np.float64,
+            wind * (self.k_ratio_time / self.k_ratio_distance), dtype=np.float64
         )
 
         # Defer to the compiled derivative helper.
         return self.derivative_helper(x, wind_velocity, self.fuel, self.vent)
 
     @staticmethod
+    @functools.cache
     def make_derivative_helper():
         """
-        Returns a compiled derivative helper function with all constants captured.
+        Returns a compiled derivative helper function with all constants captured. The function is
+        only compiled once.
         """
         # Capture constants in closure.
         k_alpha = Balloon.k_alpha
@@ -180,12 +211,142 @@ class Balloon:
             return ddt_state
 
         # Return the compiled function.
-        return jit(derivative_helper)
+        return jit(derivative_helper, cache=True)
+
+    @staticmethod
+    @functools.cache
+    def make_integrate_function() -> Callable[..., Tuple[np.ndarray, float]]:
+        """
+        Returns a compiled function that integrates the dimensionless state from the start time to
+        the end time with fixed fuel and vent, using the wind field given by a grid of control
+        vectors (see interpolate_grid). It uses an adaptive Dormand-Prince 5(4) method with the same
+        default tolerances as odeint, so that whole trajectories can be integrated without returning
+        to Python. It takes and returns a step size hint so that consecutive calls can continue with
+        the step size that was last accepted. The control vectors may be stored in single precision,
+        in which case they are interpolated in double precision. The values of the grid can also be
+        a member of an ensemble (see interpolate_values). The function is only compiled once per
+        kind of values, and is cached on disk.
+        """
+        # Capture constants in closure. Compiled functions are called as globals, since numba can't
+        # cache functions whose closures hold other compiled functions.
+        k_ratio_distance = Balloon.k_ratio_distance
+        wind_scale = Balloon.k_ratio_time / Balloon.k_ratio_distance
+        tolerance = 1.49012e-8
+
+        # Dormand-Prince coefficients. The nodes are not needed, since the derivative does not
+        # depend on time.
+        a_21 = 1.0 / 5.0
+        a_31, a_32 = 3.0 / 40.0, 9.0 / 40.0
+        a_41, a_42, a_43 = 44.0 / 45.0, -56.0 / 15.0, 32.0 / 9.0
+        a_51, a_52 = 19372.0 / 6561.0, -25360.0 / 2187.0
+        a_53, a_54 = 64448.0 / 6561.0, -212.0 / 729.0
+        a_61, a_62 = 9017.0 / 3168.0, -355.0 / 33.0
+        a_63, a_64, a_65 = 46732.0 / 5247.0, 49.0 / 176.0, -5103.0 / 18656.0
+        b_1, b_3, b_4 = 35.0 / 384.0, 500.0 / 1113.0, 125.0 / 192.0
+        b_5, b_6 = -2187.0 / 6784.0, 11.0 / 84.0
+        e_1, e_3, e_4 = 71.0 / 57600.0, -71.0 / 16695.0, 71.0 / 1920.0
+        e_5, e_6, e_7 = -17253.0 / 339200.0, 22.0 / 525.0, -1.0 / 40.0
+
+        # Define the function to be compiled.
+        def integrate(
+            x: np.ndarray,
+            step_size: float,
+            time_start: float,
+            time_end: float,
+            fuel: float,
+            vent: float,
+            dim_x: float,
+            dim_y: float,
+            dim_z: float,
+            points_x: np.ndarray,
+            points_y: np.ndarray,
+            points_z: np.ndarray,
+            values: np.ndarray,
+        ) -> Tuple[np.ndarray, float]:
+            def derivative(x: np.ndarray) -> np.ndarray:
+                wind_velocity = (
+                    interpolate_values(
+                        dim_x,
+                        dim_y,
+                        dim_z,
+                        points_x,
+                        points_y,
+                        points_z,
+                        values,
+                        x[0] * k_ratio_distance,
+                        x[1] * k_ratio_distance,
+                        x[2] * k_ratio_distance,
+                    )
+                    * wind_scale
+                )
+
+                # The derivative helper modifies its inputs, so pass it a copy of the state.
+                return derivative_helper(x.copy(), wind_velocity, fuel, vent)
+
+            time = time_start
+            x = x.copy()
+            k_1 = derivative(x)
+            while time < time_end:
+                # Never step past the end time.
+                h = min(step_size, time_end - time)
+
+                # Evaluate the stages.
+                k_2 = derivative(x + h * (a_21 * k_1))
+                k_3 = derivative(x + h * (a_31 * k_1 + a_32 * k_2))
+                k_4 = derivative(x + h * (a_41 * k_1 + a_42 * k_2 + a_43 * k_3))
+                k_5 = derivative(
+                    x + h * (a_51 * k_1 + a_52 * k_2 + a_53 * k_3 + a_54 * k_4)
+                )
+                k_6 = derivative(
+                    x
+                    + h
+                    * (a_61 * k_1 + a_62 * k_2 + a_63 * k_3 + a_64 * k_4 + a_65 * k_5)
+                )
+                x_new = x + h * (
+                    b_1 * k_1 + b_3 * k_3 + b_4 * k_4 + b_5 * k_5 + b_6 * k_6
+                )
+                k_7 = derivative(x_new)
+
+                # Estimate the error relative to the tolerances.
+                error = h * (
+                    e_1 * k_1
+                    + e_3 * k_3
+                    + e_4 * k_4
+                    + e_5 * k_5
+                    + e_6 * k_6
+                    + e_7 * k_7
+                )
+                scale = tolerance + tolerance * np.maximum(np.abs(x), np.abs(x_new))
+                error_norm = np.sqrt(np.mean((error / scale) ** 2))
+
+                # Accept or reject the step, and adapt the step size.
+                factor = 5.0
+                if error_norm > 0.0:
+                    factor = max(0.2, min(5.0, 0.9 * error_norm**-0.2))
+                if error_norm <= 1.0:
+                    time = time_end if h == time_end - time else time + h
+                    x = x_new
+                    k_1 = k_7
+
+                    # Don't shrink the step size hint because of a step truncated at the end time.
+                    step_size = (
+                        max(step_size, h * factor) if h < step_size else h * factor
+                    )
+                else:
+                    step_size = h * factor
+
+            return x, step_size
+
+        # Return the compiled function.
+        return jit(integrate, cache=True)
 
     def step(self, duration: float):
         """
         Simulates the balloon for the given duration in seconds.
         """
+        # Import SciPy lazily, since the compiled integrator doesn't need it and it is slow to import.
+        from scipy.integrate import odeint
+
         time_delta = duration / self.k_ratio_time
 
         time_start = self.time
@@ -207,3 +368,73 @@ class Balloon:
             self.velocity = Vector3(0.0, 0.0, 0.0)
 
         self.time = time_end
+
+    def step_many(
+        self, duration: float, num_steps: int
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Simulates the balloon for the given number of steps of the given duration in seconds. This
+        is equivalent to calling step repeatedly, except that steps in the air are integrated with
+        as few solver calls as possible. Returns the dimensionless times and states (see derivative)
+        at the end of each step.
+        """
+        from scipy.integrate import odeint
+
+        time_delta = duration / self.k_ratio_time
+
+        time = np.empty(num_steps, dtype=np.float64)
+        x = np.empty((num_steps, 7), dtype=np.float64)
+        i = 0
+        while i < num_steps:
+            # Take single steps on the ground, where every step needs to be clamped.
+            if self.position.z <= 0.0:
+                self.step(duration)
+                time[i] = self.time
+                x[i, 0:3] = self.position
+                x[i, 3:6] = self.velocity
+                x[i, 6] = self.temperature
+                i += 1
+                continue
+
+            # Accumulate the times like consecutive calls to step would.
+            time_span = np.empty(num_steps - i + 1, dtype=np.float64)
+            time_span[0] = self.time
+            for j in range(num_steps - i):
+                time_span[j + 1] = time_span[j] + time_delta
+
+            # Integrate the remaining steps at once, and stop at the first step which ends on the
+            # ground.
+            x_start = np.empty(7, dtype=np.float64)
+            x_start[0:3] = self.position
+            x_start[3:6] = self.velocity
+            x_start[6] = self.temperature
+            x_span = odeint(self.derivative, x_start, time_span)[1:]
+            (grounded,) = np.nonzero(x_span[:, 2] <= 0.0)
+            if len(grounded) > 0:
+                x_span = x_span[: grounded[0] + 1]
+                x_span[-1, 2] = 0.0
+                x_span[-1, 3:6] = 0.0
+
+            time[i : i + len(x_span)] = time_span[1 : len(x_span) + 1]
+            x[i : i + len(x_span)] = x_span
+            i += len(x_span)
+
+            self.position = Vector3(*x_span[-1, 0:3])
+            self.velocity = Vector3(*x_span[-1, 3:6])
+            self.temperature = x_span[-1, 6]
+            self.time = time[i - 1]
+
+        return time, x
+
+
+derivative_helper = Balloon.make_derivative_helper()
+"""
+The compiled derivative helper (see Balloon.make_derivative_helper), as a global for compiled
+functions to call.
+"""
+
+integrate = Balloon.make_integrate_function()
+"""
+The compiled integrator (see Balloon.make_integrate_function), as a global for compiled functions
+to call.
+"""
@@ -0,0 +1,642 @@
+import argparse
+import datetime
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+from typing import Any, Callable, Dict, List, Sequence, Tuple, Union
+
+import numba
+import numpy as np
+from balloon import Balloon
+from controller import (
+    HierarchicalSearchPositionController,
+    ReplanningSearchPositionController,
+    SearchPositionController,
+)
+from ensemble import BalloonBatch, BatchFixedController, run_batch
+from evaluate import (
+    CONTROLLER_PARAMETERS,
+    FIELD_DIMENSIONS,
+    FIELD_MAGNITUDE,
+    FIELD_NUM_DIMENSION_POINTS,
+    EvaluationEngine,
+    make_scenario,
+    simulate_scenario,
+)
+from field import FieldCache, RandomField
+from simulation import run_reference_simulation
+from vector import Vector3
+
+BENCHMARK_RESULTS = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), ".cache", "benchmarks"
+)
+"""
+The directory where the results of the benchmark suite are stored by default, one file per commit.
+"""
+
+STARTUP_BUDGET = {"startup.import": 1.0, "startup.first_step": 1.0}
+"""
+The time budgets in seconds for importing simulation and for simulating the first step in a fresh
+process, once numba's on-disk cache is filled (see benchmark_startup).
+"""
+
+STARTUP_SCRIPT = """
+import json
+import time
+
+start_time = time.perf_counter()
+import simulation
+
+import_time = time.perf_counter()
+from balloon import Balloon
+from controller import VerticalPositionController
+from field import RandomField
+from vector import Vector3
+
+wind_field = RandomField(
+    Vector3(10.0, 10.0, 0.0), Vector3(4000.0, 4000.0, 2000.0), Vector3(20, 20, 10)
+)
+simulation.run(
+    Balloon(wind_field), VerticalPositionController(500.0), 1.0, 1.0, show_progress=False
+)
+print(json.dumps([import_time - start_time, time.perf_counter() - import_time]))
+"""
+"""
+The script run by benchmark_startup in a fresh process. It prints the time to import simulation and
+the time to simulate the first step of a balloon in a random field, including the imports it needs.
+"""
+
+type BenchmarkResults = Dict[str, Dict[str, float]]
+"""
+Represents the results of the benchmark suite, mapping the name of each benchmark to its metrics.
+Every benchmark has a "time" metric, which is the median time in seconds of one unit of work (a
+call, a lookup, a simulated hour, a seed) and is what regressions are checked against.
+"""
+
+
+def benchmark_planner(size: float, seed: int = 0):
+    """
+    Compares the flat and hierarchical planners on a square domain of the given size. The balloon
+    starts near one corner and the target is near the opposite corner.
+    """
+    generator = np.random.default_rng(seed)
+    magnitude = Vector3(10.0, 10.0, 0.0)
+    dimensions = Vector3(size, size, 2000.0)
+    num_dimension_points = Vector3(size / 200, size / 200, 10)
+    wind_field = RandomField(
+        magnitude, dimensions, num_dimension_points, generator=generator
+    )
+
+    start = Vector3(-0.4 * size, -0.4 * size, 500.0)
+    target = Vector3(0.4 * size, 0.4 * size, 500.0)
+
+    for controller_type in [
+        SearchPositionController,
+        HierarchicalSearchPositionController,
+    ]:
+        controller = controller_type(target, dimensions, wind_field)
+        start_grid = controller.position_to_grid(start)
+
+        start_time = time.perf_counter()
+        if isinstance(controller, HierarchicalSearchPositionController):
+            path = controller.plan(start_grid)
+        else:
+            path = controller.path(start_grid)
+        elapsed = time.perf_counter() - start_time
+
+        assert controller.parents is not None
+        end = controller.grid_to_position(path[-1])
+        print(
+            "size={}, planner={}, time={:.3f}s, nodes={}, path_length={}, path_cost={:.1f}s, "
+            "end_distance={:.1f}m".format(
+                size,
+                controller_type.__name__,
+                elapsed,
+                len(controller.parents),
+                len(path),
+                controller.path_cost(path),
+                Vector3(end.x - target.x, end.y - target.y, 0).magnitude(),
+            )
+        )
+
+
+def benchmark_replanning(region_size: float, seed: int = 0):
+    """
+    Compares a full search against an incremental repair after the wind field is rotated by 90
+    degrees within a square region of the given size.
+    """
+    generator = np.random.default_rng(seed)
+    magnitude = Vector3(10.0, 10.0, 0.0)
+    dimensions = Vector3(4000.0, 4000.0, 2000.0)
+    num_dimension_points = Vector3(20, 20, 10)
+    wind_field = RandomField(
+        magnitude, dimensions, num_dimension_points, generator=generator
+    )
+    target = Vector3(1000.0, 1000.0, 500.0)
+
+    lower_bound = Vector3(-region_size / 2, -region_size / 2, 0.0)
+    upper_bound = Vector3(region_size / 2, region_size / 2, dimensions.z)
+
+    def updated_wind_field(position: Vector3) -> Vector3:
+        wind = wind_field(position)
+        if all(l <= p <= u for l, p, u in zip(lower_bound, position, upper_bound)):
+            return Vector3(-wind.y, wind.x, wind.z)
+        return wind
+
+    controller = ReplanningSearchPositionController(target, dimensions, wind_field)
+    controller.parents = controller.search()
+
+    start_time = time.perf_counter()
+    expanded = controller.update_wind_field(
+        updated_wind_field, lower_bound, upper_bound
+    )
+    repair_elapsed = time.perf_counter() - start_time
+
+    start_time = time.perf_counter()
+    SearchPositionController(target, dimensions, updated_wind_field).search()
+    search_elapsed = time.perf_counter() - start_time
+
+    print(
+        "region_size={}, search_time={:.3f}s, repair_time={:.3f}s, expanded={}, "
+        "grids={}".format(
+            region_size,
+            search_elapsed,
+            repair_elapsed,
+            expanded,
+            len(controller.costs),
+        )
+    )
+
+
+def benchmark_precision(seed: int = 0, num_balloons: int = 200):
+    """
+    Compares storing wind fields and states in single precision with double precision. Reports the
+    deviation of the reference simulation's trajectory in single precision from the trajectory in
+    double precision, and the time and deviation of a batch of balloons with different fuel in a
+    field stored in single precision. Balloon states are always integrated in double precision.
+    """
+    monitors = {}
+    for dtype in [np.float64, np.float32]:
+        start_time = time.perf_counter()
+        monitor = run_reference_simulation(np.random.default_rng(seed), dtype=dtype)
+        elapsed = time.perf_counter() - start_time
+        monitors[dtype] = monitor
+
+        reference = monitors[np.float64]
+        print(
+            "simulation=reference, dtype={}, time={:.3f}s, states={}B, max_position_error={:.3g}m, "
+            "final_position_error={:.3g}m, max_velocity_error={:.3g}m/s, "
+            "max_temperature_error={:.3g}K".format(
+                dtype.__name__,
+                elapsed,
+                monitor.states[: monitor.size].nbytes,
+                np.max(np.linalg.norm(monitor.position - reference.position, axis=1)),
+                np.linalg.norm(monitor.position[-1] - reference.position[-1]),
+                np.max(np.linalg.norm(monitor.velocity - reference.velocity, axis=1)),
+                np.max(np.abs(monitor.temperature - reference.temperature)),
+            )
+        )
+
+    positions = {}
+    for dtype in [np.float64, np.float32]:
+        wind_field = RandomField(
+            Vector3(10.0, 10.0, 0.0),
+            Vector3(4000.0, 4000.0, 2000.0),
+            Vector3(20, 20, 10),
+            generator=np.random.default_rng(seed),
+            dtype=dtype,
+        )
+        balloons = BalloonBatch(num_balloons, wind_field)
+        controller = BatchFixedController(np.linspace(15.0, 30.0, num_balloons), 0.0)
+
+        start_time = time.perf_counter()
+        for states in run_batch(balloons, controller, 1.0, 3600.0):
+            pass
+        elapsed = time.perf_counter() - start_time
+        positions[dtype] = states["position"].copy()
+
+        print(
+            "simulation=batch, dtype={}, balloons={}, time={:.3f}s, field={}B, "
+            "max_position_error={:.3g}m".format(
+                dtype.__name__,
+                num_balloons,
+                elapsed,
+                wind_field.control_vectors.nbytes,
+                np.max(
+                    np.linalg.norm(positions[dtype] - positions[np.float64], axis=1)
+                ),
+            )
+        )
+
+
+def measure(
+    function: Callable[[], Any],
+    repeat: int = 5,
+    number: int = 1,
+    items: int = 1,
+    setup: Union[Callable[[], Any], None] = None,
+    warm_up: bool = True,
+) -> Dict[str, float]:
+    """
+    Measures the time of the given function. The function is called number times in each of the
+    given number of rounds, each preceded by the setup function if given, and the time is divided by
+    the number of items processed per call. Unless warm_up is false, the function is called once
+    beforehand so that compilation is not measured. Returns the median, minimum, and maximum time in
+    seconds.
+    """
+    if warm_up:
+        function()
+
+    times = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start_time = time.perf_counter()
+        for _ in range(number):
+            function()
+        times.append((time.perf_counter() - start_time) / (number * items))
+
+    return {
+        "time": float(np.median(times)),
+        "min_time": min(times),
+        "max_time": max(times),
+        "repeat": repeat,
+    }
+
+
+def benchmark_vector(repeat: int = 5, number: int = 100000) -> BenchmarkResults:
+    """
+    Measures the arithmetic of Vector3, which dominates the controllers' Python code.
+    """
+    a = Vector3(1.0, 2.0, 3.0)
+    b = Vector3(4.0, 5.0, 6.0)
+    return {
+        "vector.add": measure(lambda: a + b, repeat, number),
+        "vector.multiply": measure(lambda: a * 2.0, repeat, number),
+        "vector.magnitude": measure(a.magnitude, repeat, number),
+        "vector.normalize": measure(a.normalize, repeat, number),
+    }
+
+
+def benchmark_field(
+    repeat: int = 5, num_positions: int = 10000, seed: int = 0
+) -> BenchmarkResults:
+    """
+    Measures looking up a random field like the evaluation's one position at a time and in batches.
+    The times are per position.
+    """
+    generator = np.random.default_rng(seed)
+    wind_field = RandomField(
+        FIELD_MAGNITUDE,
+        FIELD_DIMENSIONS,
+        FIELD_NUM_DIMENSION_POINTS,
+        generator=generator,
+    )
+    dimensions = np.array(FIELD_DIMENSIONS)
+    positions = generator.uniform(-0.5, 0.5, (num_positions, 3)) * dimensions
+    positions[:, 2] += dimensions[2] / 2
+    vectors = [Vector3(*position) for position in positions]
+
+    def call_scalar():
+        for position in vectors:
+            wind_field(position)
+
+    return {
+        "field.scalar": measure(call_scalar, repeat, items=num_positions),
+        "field.batched": measure(
+            lambda: wind_field.interpolate_many(positions), repeat, items=num_positions
+        ),
+    }
+
+
+def benchmark_balloon(repeat: int = 3, seed: int = 0) -> BenchmarkResults:
+    """
+    Measures Balloon.step with steps of one second in a random field. The time is per simulated
+    hour.
+    """
+    wind_field = RandomField(
+        FIELD_MAGNITUDE,
+        FIELD_DIMENSIONS,
+        FIELD_NUM_DIMENSION_POINTS,
+        generator=np.random.default_rng(seed),
+    )
+
+    def fly():
+        balloon = Balloon(wind_field)
+        balloon.set_fuel(25.0)
+        for _ in range(3600):
+            balloon.step(1.0)
+
+    return {"balloon.step": measure(fly, repeat)}
+
+
+def benchmark_search(
+    sizes: Sequence[float] = (2000.0, 4000.0, 8000.0), repeat: int = 3, seed: int = 0
+) -> BenchmarkResults:
+    """
+    Measures SearchPositionController.search on square domains of the given sizes with a control
+    point every 200 meters, like benchmark_planner. The field cache is cleared before each search.
+    """
+    results = {}
+    for size in sizes:
+        dimensions = Vector3(size, size, 2000.0)
+        wind_field = RandomField(
+            Vector3(10.0, 10.0, 0.0),
+            dimensions,
+            Vector3(size / 200, size / 200, 10),
+            generator=np.random.default_rng(seed),
+        )
+        controller = SearchPositionController(
+            Vector3(0.4 * size, 0.4 * size, 500.0), dimensions, wind_field
+        )
+
+        # Compile the field before the search is measured.
+        wind_field(Vector3(0.0, 0.0, 0.0))
+        results[f"search.size_{size:.0f}"] = measure(
+            controller.search,
+            repeat,
+            setup=controller.wind_field.clear,
+            warm_up=False,
+        )
+    return results
+
+
+def benchmark_run(repeat: int = 3, seed: int = 0) -> BenchmarkResults:
+    """
+    Measures simulation.run for each controller type in an evaluation scenario, including the
+    controllers' setup. Search policies are not cached, and the field cache is cleared before each
+    run.
+    """
+    control_vectors, target = make_scenario(seed)
+    wind_field = RandomField.from_control_vectors(FIELD_DIMENSIONS, control_vectors)
+    field_cache = FieldCache.shared(wind_field)
+
+    return {
+        f"run.{controller_type}": measure(
+            lambda: simulate_scenario(controller_type, wind_field, target, None),
+            repeat,
+            setup=field_cache.clear,
+        )
+        for controller_type in CONTROLLER_PARAMETERS
+    }
+
+
+def benchmark_evaluate(
+    num_seeds: int = 4, processes: Union[int, None] = None
+) -> BenchmarkResults:
+    """
+    Measures the throughput of an evaluation engine evaluating every controller type, without
+    caching search policies. Every worker evaluates a seed first so that startup is not measured.
+    The time is per seed.
+    """
+    controller_types = list(CONTROLLER_PARAMETERS)
+    num_processes = processes or os.cpu_count() or 1
+    with EvaluationEngine(processes, batch_size=1, policy_cache=None) as engine:
+        engine.evaluate(
+            controller_types, range(10**6, 10**6 + num_processes), show_progress=False
+        )
+
+        start_time = time.perf_counter()
+        engine.evaluate(controller_types, range(num_seeds), show_progress=False)
+        elapsed = time.perf_counter() - start_time
+
+    return {
+        "evaluate": {
+            "time": elapsed / num_seeds,
+            "seeds_per_minute": 60.0 * num_seeds / elapsed,
+            "processes": num_processes,
+        }
+    }
+
+
+def benchmark_startup(repeat: int = 5) -> BenchmarkResults:
+    """
+    Measures importing simulation and simulating the first step in fresh processes (see
+    STARTUP_SCRIPT). A process is run first to fill numba's on-disk cache, and is not measured.
+    """
+    times = []
+    for _ in range(repeat + 1):
+        output = subprocess.run(
+            [sys.executable, "-c", STARTUP_SCRIPT],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True,
+            check=True,
+            text=True,
+        ).stdout
+        times.append(json.loads(output.splitlines()[-1]))
+
+    results = {}
+    for name, measured in zip(STARTUP_BUDGET, np.array(times[1:]).T):
+        results[name] = {
+            "time": float(np.median(measured)),
+            "min_time": float(np.min(measured)),
+            "max_time": float(np.max(measured)),
+            "repeat": repeat,
+        }
+    return results
+
+
+def assert_startup_budget(results: BenchmarkResults):
+    """
+    Raises an AssertionError if the startup benchmarks in the given results exceed their budgets.
+    """
+    over_budget = [
+        "{} took {:.3f}s, over its budget of {}s".format(
+            name, results[name]["time"], budget
+        )
+        for name, budget in STARTUP_BUDGET.items()
+        if results[name]["time"] > budget
+    ]
+    if over_budget:
+        raise AssertionError("; ".join(over_budget))
+
+
+def run_suite(repeat: int = 3) -> BenchmarkResults:
+    """
+    Runs every benchmark of the suite with the given number of rounds for the slower benchmarks.
+    """
+    results: BenchmarkResults = {}
+    for name, benchmark in [
+        ("startup", benchmark_startup),
+        ("vector", lambda: benchmark_vector(max(5, repeat))),
+        ("field", lambda: benchmark_field(max(5, repeat))),
+        ("balloon", lambda: benchmark_balloon(repeat)),
+        ("search", lambda: benchmark_search(repeat=repeat)),
+        ("run", lambda: benchmark_run(repeat)),
+        ("evaluate", benchmark_evaluate),
+    ]:
+        print(f"Running {name} benchmarks...", flush=True)
+        results.update(benchmark())
+    return results
+
+
+def get_commit() -> Union[str, None]:
+    """
+    Returns the hash of the checked out commit, followed by "-dirty" if this directory has changes
+    that are not committed, or None outside of a git repository.
+    """
+    directory = os.path.dirname(os.path.abspath(__file__))
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=directory,
+            capture_output=True,
+            check=True,
+            text=True,
+        ).stdout.strip()
+        status = subprocess.run(
+            ["git", "status", "--porcelain", "--", "."],
+            cwd=directory,
+            capture_output=True,
+            check=True,
+            text=True,
+        ).stdout
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return f"{commit}-dirty" if status.strip() else commit
+
+
+def get_environment() -> Dict[str, Any]:
+    """
+    Returns the versions and machine that benchmarks are measured with. Results measured in
+    different environments cannot be compared (see check_environment).
+    """
+    return {
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "numba": numba.__version__,
+        "machine": platform.machine(),
+        "processor": platform.processor(),
+        "cpus": os.cpu_count(),
+    }
+
+
+def check_environment(environment: Dict[str, Any]) -> List[str]:
+    """
+    Returns the differences between the given environment of saved results and the current one.
+    """
+    current = get_environment()
+    return [
+        f"{key} is {current[key]} but was {environment.get(key)}"
+        for key in current
+        if environment.get(key) != current[key]
+    ]
+
+
+def save_results(filename: str, results: BenchmarkResults):
+    """
+    Saves the given results to a JSON file along with the commit and machine they were measured on.
+    """
+    os.makedirs(os.path.dirname(os.path.abspath(filename)), exist_ok=True)
+    with open(filename, "w") as f:
+        json.dump(
+            {
+                "commit": get_commit(),
+                "date": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+                **get_environment(),
+                "benchmarks": results,
+            },
+            f,
+            indent=2,
+        )
+
+
+def load_results(filename: str) -> Tuple[Dict[str, Any], BenchmarkResults]:
+    """
+    Loads the results saved in the given JSON file. Returns the environment they were measured in
+    (see get_environment) and the results.
+    """
+    with open(filename) as f:
+        saved = json.load(f)
+    results = saved.pop("benchmarks")
+    return {key: saved.get(key) for key in get_environment()}, results
+
+
+def compare_results(
+    baseline: BenchmarkResults, results: BenchmarkResults, tolerance: float = 0.1
+) -> List[str]:
+    """
+    Prints the ratio of the time of each benchmark to its time in the baseline. Returns the names of
+    the benchmarks whose time grew by more than the given fraction.
+    """
+    regressions = []
+    for name, metrics in results.items():
+        if name not in baseline:
+            continue
+        ratio = metrics["time"] / baseline[name]["time"]
+        regressed = ratio > 1.0 + tolerance
+        if regressed:
+            regressions.append(name)
+        print(
+            "benchmark={}, baseline={:.4g}s, time={:.4g}s, ratio={:.3f}{}".format(
+                name,
+                baseline[name]["time"],
+                metrics["time"],
+                ratio,
+                ", regression" if regressed else "",
+            )
+        )
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Runs the benchmark suite and stores its results as JSON."
+    )
+    parser.add_argument("--output", help="file to store the results in")
+    parser.add_argument("--baseline", help="results to check for regressions against")
+    parser.add_argument("--tolerance", type=float, default=0.1)
+    parser.add_argument(
+        "--ignore-environment",
+        action="store_true",
+        help="compare against a baseline measured in a different environment",
+    )
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument(
+        "--startup",
+        action="store_true",
+        help="only check the startup time budget",
+    )
+    parser.add_argument(
+        "--comparisons",
+        action="store_true",
+        help="run the planner, replanning and precision comparisons instead",
+    )
+    args = parser.parse_args()
+
+    if args.comparisons:
+        for size in [4000.0, 8000.0, 16000.0]:
+            benchmark_planner(size)
+        for region_size in [200.0, 500.0, 1000.0, 2000.0]:
+            benchmark_replanning(region_size)
+        benchmark_precision()
+    elif args.startup:
+        results = benchmark_startup(args.repeat)
+        for name, metrics in results.items():
+            print("benchmark={}, time={:.3f}s".format(name, metrics["time"]))
+        assert_startup_budget(results)
+    else:
+        results = run_suite(args.repeat)
+        output = args.output or os.path.join(
+            BENCHMARK_RESULTS, f"{get_commit() or 'results'}.json"
+        )
+        save_results(output, results)
+        print(f"Results saved to {output}")
+
+        if args.baseline is not None:
+            # Timings from another machine or version would report false regressions.
+            environment, baseline = load_results(args.baseline)
+            differences = "; ".join(check_environment(environment))
+            if differences:
+                message = f"Different environment than the baseline: {differences}"
+                if not args.ignore_environment:
+                    raise SystemExit(message)
+                print(f"Warning: {message}")
+
+            regressions = compare_results(baseline, results, args.tolerance)
+            if regressions:
+                raise SystemExit(f"Regressions: {', '.join(regressions)}")
+        assert_startup_budget(results)
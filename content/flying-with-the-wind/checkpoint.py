@@ -0,0 +1,83 @@
+import copy
+import os
+import pickle
+import tempfile
+from dataclasses import dataclass
+from typing import List
+
+from balloon import Balloon
+from controller import Controller
+from monitor import Monitor
+from simulation import run
+
+
+@dataclass
+class Checkpoint:
+    """
+    Represents the state of a running simulation: the balloon, its controller, and the monitor
+    recording its trajectory so far. Checkpoints can be pickled and restored in a fresh process.
+    Compiled functions are not pickled. They are shared by all balloons and wind fields, and are
+    compiled at most once per process or loaded from numba's on-disk cache.
+    """
+
+    balloon: Balloon
+    controller: Controller
+    monitor: Monitor
+
+    @staticmethod
+    def capture(
+        balloon: Balloon, controller: Controller, monitor: Monitor
+    ) -> "Checkpoint":
+        """
+        Returns a checkpoint of the given simulation state. The state is copied so that the original
+        simulation can continue without affecting the checkpoint.
+        """
+        return Checkpoint(balloon, controller, monitor).fork(1)[0]
+
+    @staticmethod
+    def load(filename: str) -> "Checkpoint":
+        """
+        Loads a checkpoint from the given file.
+        """
+        with open(filename, "rb") as f:
+            return pickle.load(f)
+
+    def save(self, filename: str):
+        """
+        Saves the checkpoint to the given file. The file is written atomically so that an
+        interrupted save never leaves a partial checkpoint behind.
+        """
+        directory = os.path.dirname(filename) or "."
+        os.makedirs(directory, exist_ok=True)
+        fd, temporary = tempfile.mkstemp(dir=directory, suffix=".pickle")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                pickle.dump(self, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(temporary, filename)
+        except BaseException:
+            os.unlink(temporary)
+            raise
+
+    def fork(self, n: int) -> List["Checkpoint"]:
+        """
+        Returns n independent copies of the checkpoint, for example to roll out different scenarios
+        from the same state. Wind fields and field caches are immutable and shared between copies,
+        so nothing needs to be recompiled.
+        """
+        return [copy.deepcopy(self) for _ in range(n)]
+
+    def resume(
+        self, time_step: float, total_time: float, show_progress: bool = True
+    ) -> Monitor:
+        """
+        Continues the simulation until the given total time, appending to the checkpoint's monitor.
+        The checkpoint's state is advanced in place, so fork it first to keep the original.
+        """
+        return run(
+            balloon=self.balloon,
+            controller=self.controller,
+            time_step=time_step,
+            total_time=total_time,
+            show_progress=show_progress,
+            monitor=self.monitor,
+        )
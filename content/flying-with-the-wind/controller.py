@@ -1,13 +1,14 @@
-import functools
 import heapq
 import math
 import os
 from dataclasses import dataclass
-from typing import Callable, Dict, Generator, List, Tuple, Union
+from typing import Callable, Dict, Generator, List, Set, Tuple, Union
 
+import numpy as np
 from balloon import Balloon
-from field import Field3
-from simple_pid import PID
+from field import Field3, FieldCache, sample_field
+from numba import jit
+from policy import PolicyTable, policy_key
 from vector import Vector3
 
 
@@ -37,7 +38,10 @@ class ControllerOutput:
 
 type Controller = Callable[[ControllerInput], ControllerOutput]
 """
-Represents a controller for the balloon.
+Represents a controller for the balloon. A controller may also define a next_decision_time method
+which takes the same input and returns the time in seconds until which the returned output is
+guaranteed not to change, so that the simulation does not need to call the controller before then
+(see get_next_decision_time).
 """
 
 
@@ -55,6 +59,18 @@ def get_controller_input(balloon: Balloon) -> ControllerInput:
     )
 
 
+def get_next_decision_time(controller: Controller, input: ControllerInput) -> float:
+    """
+    Returns the next time in seconds at which the given controller needs to be called again after
+    being called with the given input. Controllers that do not declare their decision times need to
+    be called at every step, which is signalled by returning the input time.
+    """
+    next_decision_time = getattr(controller, "next_decision_time", None)
+    if next_decision_time is None:
+        return input.time
+    return next_decision_time(input)
+
+
 def apply_controller_output(
     balloon: Balloon, controller_output: ControllerOutput
 ) -> None:
@@ -82,6 +98,12 @@ class FixedController:
         """
         return self.output
 
+    def next_decision_time(self, input: ControllerInput) -> float:
+        """
+        Returns the next time at which the controller needs to be called. The output never changes.
+        """
+        return math.inf
+
 
 class SequenceController:
     """
@@ -109,11 +131,201 @@ class SequenceController:
 
         return self.last_controller(input)
 
+    def next_decision_time(self, input: ControllerInput) -> float:
+        """
+        Returns the next time at which the controller needs to be called. This is the next switching
+        time, or earlier if the current controller needs to be called before then.
+        """
+        next_time = self.controllers[-1][0] if self.controllers else math.inf
+        if self.last_controller is None:
+            return next_time
+        return min(next_time, get_next_decision_time(self.last_controller, input))
+
+
+def get_schedule_entries(
+    controller: Controller,
+) -> Union[List[Tuple[float, ControllerOutput]], None]:
+    """
+    Returns the outputs of a controller whose output only depends on time, as a list of start times
+    and outputs sorted by time. The first start time is always negative infinity. Returns None if
+    the output of the controller may depend on the balloon's state.
+    """
+    if isinstance(controller, FixedController):
+        return [(-math.inf, controller.output)]
+
+    if not isinstance(controller, SequenceController):
+        return None
+
+    # Collect the controllers that are still pending, starting with the current one.
+    segments: List[Tuple[float, Union[Controller, None]]] = [
+        (-math.inf, controller.last_controller)
+    ]
+    segments.extend(reversed(controller.controllers))
+
+    # Flatten the child schedules over the interval in which each child is active.
+    entries = []
+    for i, (start, child) in enumerate(segments):
+        end = segments[i + 1][0] if i + 1 < len(segments) else math.inf
+        if child is None:
+            entries.append((start, ControllerOutput(fuel=0.0, vent=0.0)))
+            continue
+
+        child_entries = get_schedule_entries(child)
+        if child_entries is None:
+            return None
+
+        entries.append(
+            (start, [output for time, output in child_entries if time <= start][-1])
+        )
+        entries.extend(
+            (time, output) for time, output in child_entries if start < time < end
+        )
+
+    return entries
+
+
+def compile_schedule(
+    controller: Controller,
+) -> Union[Tuple[np.ndarray, np.ndarray, np.ndarray], None]:
+    """
+    Compiles a controller whose output only depends on time into arrays of start times, fuel
+    percentages, and vent percentages. The output at a given time is the last entry whose start time
+    is less than or equal to it. Returns None if the output of the controller may depend on the
+    balloon's state.
+    """
+    entries = get_schedule_entries(controller)
+    if entries is None:
+        return None
+
+    times = np.array([time for time, _ in entries], dtype=np.float64)
+    fuel = np.array([output.fuel for _, output in entries], dtype=np.float64)
+    vent = np.array([output.vent for _, output in entries], dtype=np.float64)
+    return times, fuel, vent
+
+
+# Layout of the PID state arrays used by the vertical controllers. Values that have not been set yet
+# are NaN. The sample time and output limits are shared by every PID controller.
+PID_K_P = 0
+PID_K_I = 1
+PID_K_D = 2
+PID_SETPOINT = 3
+PID_INTEGRAL = 4
+PID_LAST_TIME = 5
+PID_LAST_INPUT = 6
+PID_LAST_OUTPUT = 7
+PID_STATE_SIZE = 8
+PID_SAMPLE_TIME = 1.0
+PID_OUTPUT_LIMIT = 1.0
+
+
+def make_pid_state(k_p: float, k_i: float, k_d: float, setpoint: float) -> np.ndarray:
+    """
+    Returns the state array of a PID controller with the given gains and setpoint.
+    """
+    state = np.empty(PID_STATE_SIZE, dtype=np.float64)
+    state[PID_K_P] = k_p
+    state[PID_K_I] = k_i
+    state[PID_K_D] = k_d
+    reset_pid(state, setpoint)
+    return state
+
+
+@jit(cache=True)
+def reset_pid(state: np.ndarray, setpoint: float):
+    """
+    Resets the PID controller to the state of a newly created controller with the given setpoint.
+    Controllers are created at time zero.
+    """
+    state[PID_SETPOINT] = setpoint
+    state[PID_INTEGRAL] = 0.0
+    state[PID_LAST_TIME] = 0.0
+    state[PID_LAST_INPUT] = np.nan
+    state[PID_LAST_OUTPUT] = np.nan
+
+
+@jit(cache=True)
+def update_pid(state: np.ndarray, measurement: float, now: float) -> float:
+    """
+    Updates the PID controller with the given measurement at the given time and returns its output.
+    The derivative term is computed on the measurement. A new output is only computed once the
+    sample time has elapsed since the last update.
+    """
+    dt = now - state[PID_LAST_TIME]
+    if dt == 0:
+        dt = 1e-16
+    if dt < PID_SAMPLE_TIME and not np.isnan(state[PID_LAST_OUTPUT]):
+        return state[PID_LAST_OUTPUT]
+
+    error = state[PID_SETPOINT] - measurement
+    d_input = 0.0
+    if not np.isnan(state[PID_LAST_INPUT]):
+        d_input = measurement - state[PID_LAST_INPUT]
+
+    # Compute each term, clamping the integral to avoid windup.
+    proportional = state[PID_K_P] * error
+    integral = state[PID_INTEGRAL] + state[PID_K_I] * error * dt
+    integral = min(max(integral, -PID_OUTPUT_LIMIT), PID_OUTPUT_LIMIT)
+    derivative = -state[PID_K_D] * d_input / dt
+
+    output = proportional + integral + derivative
+    output = min(max(output, -PID_OUTPUT_LIMIT), PID_OUTPUT_LIMIT)
+
+    state[PID_INTEGRAL] = integral
+    state[PID_LAST_TIME] = now
+    state[PID_LAST_INPUT] = measurement
+    state[PID_LAST_OUTPUT] = output
+    return output
+
+
+@jit(cache=True)
+def update_vertical_velocity(state: np.ndarray, velocity: float, now: float) -> float:
+    """
+    Updates a vertical velocity PID controller. Returns the output discretized to 1%, where positive
+    values are fuel and negative values are vent.
+    """
+    return np.rint(100 * update_pid(state, velocity, now))
+
+
+@jit(cache=True)
+def update_vertical_position(
+    position_state: np.ndarray,
+    velocity_state: np.ndarray,
+    position: float,
+    velocity: float,
+    now: float,
+) -> float:
+    """
+    Updates a cascaded vertical position PID controller. The position controller output is scaled
+    to 4 m/s, discretized to 0.1 m/s and used as the setpoint of the velocity controller, which is
+    reset whenever the setpoint changes. Returns the output of the velocity controller.
+    """
+    target_velocity = np.rint(update_pid(position_state, position, now) * 4 * 10) / 10
+
+    # Matches math.isclose with the default relative tolerance.
+    last_velocity = velocity_state[PID_SETPOINT]
+    if abs(target_velocity - last_velocity) > 1e-9 * max(
+        abs(target_velocity), abs(last_velocity)
+    ):
+        reset_pid(velocity_state, target_velocity)
+
+    return update_vertical_velocity(velocity_state, velocity, now)
+
+
+def make_vertical_output(output: float) -> ControllerOutput:
+    """
+    Converts the signed output of a vertical controller to fuel and vent percentages.
+    """
+    output = int(output)
+    if output < 0:
+        return ControllerOutput(fuel=0, vent=-output)
+    else:
+        return ControllerOutput(fuel=output, vent=0)
+
 
 class VerticalVelocityController:
     """
     A controller that targets a constant vertical velocity. It embeds a PID controller. Fuel and
-    vent inputs are discretized to 1%.
+    vent inputs are discretized to 1%. The PID state is a flat array updated by a compiled kernel.
     """
 
     def __init__(
@@ -127,40 +339,29 @@ class VerticalVelocityController:
         Initializes the controller with the given tuning parameters.
         """
         self.target = target
-        self.now = 0
-        self.pid = PID(
-            Kp=k_p,
-            Ki=k_i,
-            Kd=k_d,
-            setpoint=target,
-            sample_time=1,
-            output_limits=(-1.0, 1.0),
-            time_fn=lambda: self.now,
-        )
+        self.pid = make_pid_state(k_p, k_i, k_d, target)
 
     def __call__(self, input: ControllerInput) -> ControllerOutput:
         """
         Returns the controller output for the given input.
         """
-        self.now = input.time
-
-        output = self.pid(input.velocity.z)
-        if output is None:
-            output = 0
-
-        output = round(100 * output)
+        return make_vertical_output(
+            update_vertical_velocity(self.pid, input.velocity.z, input.time)
+        )
 
-        if output < 0:
-            return ControllerOutput(fuel=0, vent=-output)
-        else:
-            return ControllerOutput(fuel=output, vent=0)
+    def set_target(self, target: float):
+        """
+        Changes the target in place. The controller behaves as if it was newly created.
+        """
+        self.target = target
+        reset_pid(self.pid, target)
 
 
 class VerticalPositionController:
     """
     A controller that targets a constant vertical position. It embeds a PID controller whose output
     is fed into a VelocityController. Velocity input is discretized to 0.1 m/s and capped at 4 m/s
-    in either direction.
+    in either direction. Both PID states are flat arrays updated by a single compiled kernel.
     """
 
     def __init__(
@@ -174,43 +375,66 @@ class VerticalPositionController:
         Initializes the controller with the given tuning parameters.
         """
         self.target = target
-        self.now = 0
-        self.pid = PID(
-            Kp=k_p,
-            Ki=k_i,
-            Kd=k_d,
-            setpoint=target,
-            sample_time=1,
-            output_limits=(-1.0, 1.0),
-            time_fn=lambda: self.now,
-        )
-        self.last_velocity = 0.0
-        self.last_velocity_controller = VerticalVelocityController(0.0)
+        self.pid = make_pid_state(k_p, k_i, k_d, target)
+        self.velocity_controller = VerticalVelocityController(0.0)
 
     def __call__(self, input: ControllerInput) -> ControllerOutput:
         """
         Returns the controller output for the given input.
         """
-        self.now = input.time
-
-        output = self.pid(input.position.z)
-        if output is None:
-            output = 0
-
-        output *= 4
-        output = round(output * 10) / 10
-        if math.isclose(output, self.last_velocity):
-            return self.last_velocity_controller(input)
+        return make_vertical_output(
+            update_vertical_position(
+                self.pid,
+                self.velocity_controller.pid,
+                input.position.z,
+                input.velocity.z,
+                input.time,
+            )
+        )
 
-        self.last_velocity = output
-        self.last_velocity_controller = VerticalVelocityController(output)
-        return self.last_velocity_controller(input)
+    def set_target(self, target: float):
+        """
+        Changes the target in place. The controller behaves as if it was newly created.
+        """
+        self.target = target
+        reset_pid(self.pid, target)
+        self.velocity_controller.set_target(0.0)
+
+
+@jit(cache=True)
+def best_wind_level(
+    directions: np.ndarray,
+    valid: np.ndarray,
+    i_x: int,
+    i_y: int,
+    target_x: float,
+    target_y: float,
+) -> int:
+    """
+    Returns the vertical grid index in the given column whose normalized wind direction is most
+    similar to the target direction, or -1 if there is no wind in the column.
+    """
+    best_z = -1
+    best_similarity = -np.inf
+    for z in range(directions.shape[2]):
+        if not valid[i_x, i_y, z]:
+            continue
+        similarity = (
+            directions[i_x, i_y, z, 0] * target_x
+            + directions[i_x, i_y, z, 1] * target_y
+        )
+        if similarity > best_similarity:
+            best_similarity = similarity
+            best_z = z
+    return best_z
 
 
 class GreedyPositionController:
     """
     A controller that targets a given position taking the wind field into account. It greedily
-    chooses the vertical position which would move the balloon closest to the target.
+    chooses the vertical position which would move the balloon closest to the target. The wind
+    direction at every grid position in the dimensions is precomputed, so each decision is a
+    compiled scan of one column.
     """
 
     def __init__(
@@ -225,11 +449,17 @@ class GreedyPositionController:
         """
         self.target: Vector3 = target
         self.dimensions: Vector3 = dimensions
-        self.wind_field: Field3 = functools.lru_cache(maxsize=None)(wind_field)
+        self.wind_field: FieldCache = FieldCache.shared(wind_field)
         self.grid_size: Vector3 = grid_size
 
         self.controller: Union[VerticalPositionController, None] = None
 
+        # Precompute the normalized horizontal wind for every grid position within the dimensions.
+        self.table_origin: Vector3 = self.position_to_grid(
+            Vector3(-self.dimensions.x / 2, -self.dimensions.y / 2, 0)
+        )
+        self.directions, self.valid = self.make_wind_table(wind_field)
+
     def __call__(self, input: ControllerInput) -> ControllerOutput:
         """
         Returns the controller output for the given input.
@@ -239,7 +469,7 @@ class GreedyPositionController:
         position_grid = self.position_to_grid(input.position)
         target_grid = self.position_to_grid(self.target)
         if position_grid.x == target_grid.x and position_grid.y == target_grid.y:
-            self.controller = VerticalPositionController(self.target.z)
+            self.set_controller_target(self.target.z)
             return self.controller(input)
 
         # Compute the normalized vector from position to target.
@@ -248,12 +478,51 @@ class GreedyPositionController:
         ).normalize()
 
         # Use cosine similarity to find the best vertical position.
+        best_grid = self.best_grid(position_grid, v_target)
+
+        # If we are already targeting the best vertical position, then use the existing controller.
+        best_z = self.grid_to_position(best_grid).z
+        if self.controller is not None and best_z == self.controller.target:
+            return self.controller(input)
+
+        # Retarget the controller.
+        self.controller_z = best_z
+        self.set_controller_target(best_z)
+        return self.controller(input)
+
+    def set_controller_target(self, target: float):
+        """
+        Targets the given vertical position with a newly initialized controller state. The existing
+        controller is reused to avoid allocating a new one.
+        """
+        if self.controller is None:
+            self.controller = VerticalPositionController(target)
+        else:
+            self.controller.set_target(target)
+
+    def best_grid(self, position_grid: Vector3, v_target: Vector3) -> Vector3:
+        """
+        Returns the grid position in the column of the given grid position whose wind direction is
+        most similar to the given normalized target direction. Returns the given grid position if
+        there is no wind in the column.
+        """
+        # Look up columns within the dimensions in the precomputed table.
+        i_x = int(position_grid.x - self.table_origin.x)
+        i_y = int(position_grid.y - self.table_origin.y)
+        if 0 <= i_x < self.directions.shape[0] and 0 <= i_y < self.directions.shape[1]:
+            best_z = best_wind_level(
+                self.directions, self.valid, i_x, i_y, v_target.x, v_target.y
+            )
+            if best_z < 0:
+                return position_grid
+            return Vector3(position_grid.x, position_grid.y, best_z)
+
+        # Otherwise, evaluate the wind field for each vertical position in the column.
         best_grid = position_grid
         best_similarity = -float("inf")
 
-        current_grid = self.position_to_grid(input.position)
         for z in range(0, int(self.dimensions.z // self.grid_size.z)):
-            test_grid = Vector3(current_grid.x, current_grid.y, z)
+            test_grid = Vector3(position_grid.x, position_grid.y, z)
             v_wind = self.wind_field(self.grid_to_position(test_grid))
             if v_wind.x == 0 and v_wind.y == 0:
                 continue
@@ -264,15 +533,38 @@ class GreedyPositionController:
                 best_similarity = similarity
                 best_grid = test_grid
 
-        # If we are already targeting the best vertical position, then use the existing controller.
-        best_z = self.grid_to_position(best_grid).z
-        if self.controller is not None and best_z == self.controller.target:
-            return self.controller(input)
+        return best_grid
 
-        # Initialize a new controller.
-        self.controller_z = best_z
-        self.controller = VerticalPositionController(best_z)
-        return self.controller(input)
+    def make_wind_table(self, wind_field: Field3) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Evaluates the wind field at every grid position within the dimensions. Returns an array of
+        normalized horizontal wind directions of shape (X, Y, Z, 2) and a mask of shape (X, Y, Z)
+        indicating which grid positions have any horizontal wind.
+        """
+        upper_grid = self.position_to_grid(
+            Vector3(self.dimensions.x / 2, self.dimensions.y / 2, 0)
+        )
+        grids = np.stack(
+            np.meshgrid(
+                np.arange(self.table_origin.x, upper_grid.x + 1),
+                np.arange(self.table_origin.y, upper_grid.y + 1),
+                np.arange(0, int(self.dimensions.z // self.grid_size.z)),
+                indexing="ij",
+            ),
+            axis=-1,
+        )
+        grid_size = np.array(self.grid_size)
+        positions = grids.reshape(-1, 3) * grid_size + grid_size / 2
+        wind = sample_field(wind_field, positions).reshape(grids.shape)
+
+        wind_x = wind[..., 0]
+        wind_y = wind[..., 1]
+        valid = (wind_x != 0) | (wind_y != 0)
+        magnitude = (wind_x**2 + wind_y**2) ** 0.5
+        directions = np.zeros(grids.shape[:3] + (2,), dtype=np.float64)
+        np.divide(wind_x, magnitude, out=directions[..., 0], where=valid)
+        np.divide(wind_y, magnitude, out=directions[..., 1], where=valid)
+        return directions, valid
 
     def position_to_grid(self, position: Vector3) -> Vector3:
         """
@@ -295,7 +587,9 @@ class SearchPositionController:
     """
     A controller that targets a given position taking the wind field into account. It uses A* to
     find the lowest cost path to the target. If the position is not reachable, then the closest
-    reachable position is targeted instead (subject to the grid size specified).
+    reachable position is targeted instead (subject to the grid size specified). If a policy cache
+    directory is given, search results are stored there and reused by controllers with the same
+    wind field and parameters.
     """
 
     def __init__(
@@ -305,13 +599,14 @@ class SearchPositionController:
         wind_field: Field3,
         grid_size: Vector3 = Vector3(100, 100, 100),
         max_vertical_speed: float = 4.0,
+        policy_cache: Union[str, None] = None,
     ):
         """
         Initializes the controller with the given tuning parameters.
         """
         self.target: Vector3 = target
         self.dimensions: Vector3 = dimensions
-        self.wind_field: Field3 = functools.lru_cache(maxsize=None)(wind_field)
+        self.wind_field: FieldCache = FieldCache.shared(wind_field)
         self.grid_size: Vector3 = grid_size
         self.max_vertical_speed: float = max_vertical_speed
 
@@ -322,7 +617,23 @@ class SearchPositionController:
 
         self.controller: Union[VerticalPositionController, None] = None
         self.current_grid: Union[Vector3, None] = None
-        self.parents: Union[Dict[Vector3, Union[Vector3, None]], None] = None
+        self.parents: Union[
+            Dict[Vector3, Union[Vector3, None]], PolicyTable, None
+        ] = None
+
+        # The policy can only be cached if the wind field can be identified.
+        self.policy_filename: Union[str, None] = None
+        field_digest = getattr(wind_field, "digest", None)
+        if policy_cache is not None and field_digest is not None:
+            key = policy_key(
+                field_digest,
+                self.dimensions,
+                self.target_grid,
+                self.grid_size,
+                self.max_vertical_speed,
+            )
+            self.policy_filename = os.path.join(policy_cache, f"{key}.npy")
+            self.parents = self.load_policy()
 
     def __call__(self, input: ControllerInput) -> ControllerOutput:
         """
@@ -334,9 +645,7 @@ class SearchPositionController:
             # The controller is not initialized. Set a default controller that holds at the current
             # grid height and attempt to update the controller by searching for path to the target.
             self.current_grid = self.position_to_grid(input.position)
-            self.controller = VerticalPositionController(
-                self.grid_to_position(self.current_grid).z
-            )
+            self.set_controller_target(self.grid_to_position(self.current_grid).z)
             self.update_controller()
         else:
             # The controller is already initialized. We only need to update the controller if the
@@ -383,6 +692,7 @@ class SearchPositionController:
         # Run search if this is the first time the controller is being updated.
         if self.parents is None:
             self.parents = self.search()
+            self.save_policy()
 
         # If there is no current grid position, do nothing.
         if self.current_grid is None:
@@ -392,7 +702,39 @@ class SearchPositionController:
         next_grid = self.parents.get(self.current_grid, None)
         if next_grid is not None and next_grid != self.unreachable_grid:
             next_position = self.grid_to_position(next_grid)
-            self.controller = VerticalPositionController(next_position.z)
+            self.set_controller_target(next_position.z)
+
+    def set_controller_target(self, target: float):
+        """
+        Targets the given vertical position with a newly initialized controller state. The existing
+        controller is reused to avoid allocating a new one.
+        """
+        if self.controller is None:
+            self.controller = VerticalPositionController(target)
+        else:
+            self.controller.set_target(target)
+
+    def load_policy(self) -> Union[PolicyTable, None]:
+        """
+        Memory-maps the cached policy for this controller. Returns None if it is not cached.
+        """
+        if self.policy_filename is None or not os.path.exists(self.policy_filename):
+            return None
+        return PolicyTable.load(
+            self.policy_filename, self.grid_bounds()[0], self.unreachable_grid
+        )
+
+    def save_policy(self):
+        """
+        Stores the current parents map in the policy cache if caching is enabled.
+        """
+        if self.policy_filename is None or not isinstance(self.parents, dict):
+            return
+        lower_bound, upper_bound = self.grid_bounds()
+        table = PolicyTable.from_parents(
+            self.parents, lower_bound, upper_bound, self.unreachable_grid
+        )
+        table.save(self.policy_filename)
 
     def grid_distance(self, grid_a: Vector3, grid_b: Vector3) -> float:
         """
@@ -428,14 +770,7 @@ class SearchPositionController:
         # single search pass on the reverse graph.
         forward_graph: Dict[Vector3, Dict[Vector3, Tuple[float, float]]] = {}
         for grid in self.grids():
-            forward_graph[grid] = {
-                neighbor: (0, self.grid_cost(grid, neighbor))
-                for neighbor in self.neighbors(grid)
-            }
-            forward_graph[grid][self.unreachable_grid] = (
-                self.grid_distance(grid, self.unreachable_grid),
-                0,
-            )
+            forward_graph[grid] = self.edges(grid)
         forward_graph[self.unreachable_grid] = {self.target_grid: (0, 0)}
 
         # Build the reverse graph. We can clear the forward graph once this is done to save memory
@@ -460,7 +795,7 @@ class SearchPositionController:
         # from every possible grid position to the target (or the closest reachable position).
         while queue:
             cost, grid = heapq.heappop(queue)
-            for neighbor in reverse_graph[grid]:
+            for neighbor in reverse_graph.get(grid, {}):
                 if neighbor not in costs:
                     costs[neighbor] = (float("inf"), float("inf"))
                 new_cost = (
@@ -475,9 +810,31 @@ class SearchPositionController:
         # Return the parents map.
         return parents
 
-    def grids(self) -> Generator[Vector3, None, None]:
+    def path(self, grid: Vector3) -> List[Vector3]:
         """
-        Yields all grid positions within the bounds of the dimensions.
+        Returns the planned path from the given grid position. The path ends at the target or at the
+        closest reachable grid position if the target is not reachable.
+        """
+        if self.parents is None:
+            self.parents = self.search()
+
+        path = [grid]
+        next_grid = self.parents.get(grid, None)
+        while next_grid is not None and next_grid != self.unreachable_grid:
+            path.append(next_grid)
+            next_grid = self.parents.get(next_grid, None)
+        return path
+
+    def path_cost(self, path: List[Vector3]) -> float:
+        """
+        Returns the total time it takes to traverse the given path.
+        """
+        return sum(self.grid_cost(a, b) for a, b in zip(path, path[1:]))
+
+    def grid_bounds(self) -> Tuple[Vector3, Vector3]:
+        """
+        Returns the inclusive lower bound and exclusive upper bound of grid positions within the
+        bounds of the dimensions.
         """
         lower_bound = self.position_to_grid(
             Vector3(-self.dimensions.x / 2, -self.dimensions.y / 2, 0)
@@ -485,8 +842,33 @@ class SearchPositionController:
         upper_bound = self.position_to_grid(
             Vector3(self.dimensions.x / 2, self.dimensions.y / 2, self.dimensions.z)
         )
-        for x in range(int(lower_bound.x) + 1, int(upper_bound.x)):
-            for y in range(int(lower_bound.y) + 1, int(upper_bound.y)):
+        return (
+            Vector3(lower_bound.x + 1, lower_bound.y + 1, lower_bound.z),
+            upper_bound,
+        )
+
+    def edges(self, grid: Vector3) -> Dict[Vector3, Tuple[float, float]]:
+        """
+        Returns the outgoing edges of the given grid position in the forward graph. Every grid
+        position has an edge to the unreachable grid position in addition to its neighbors.
+        """
+        edges: Dict[Vector3, Tuple[float, float]] = {
+            neighbor: (0, self.grid_cost(grid, neighbor))
+            for neighbor in self.neighbors(grid)
+        }
+        edges[self.unreachable_grid] = (
+            self.grid_distance(grid, self.unreachable_grid),
+            0,
+        )
+        return edges
+
+    def grids(self) -> Generator[Vector3, None, None]:
+        """
+        Yields all grid positions within the bounds of the dimensions.
+        """
+        lower_bound, upper_bound = self.grid_bounds()
+        for x in range(int(lower_bound.x), int(upper_bound.x)):
+            for y in range(int(lower_bound.y), int(upper_bound.y)):
                 for z in range(int(lower_bound.z), int(upper_bound.z)):
                     yield Vector3(x, y, z)
 
@@ -520,3 +902,280 @@ class SearchPositionController:
         n = Vector3(grid.x + dx, grid.y + dy, grid.z)
         if self.grid_in_bounds(n):
             yield n
+
+
+class ReplanningSearchPositionController(SearchPositionController):
+    """
+    A search controller that accepts updates to the wind field. It keeps the search graph and the
+    cost-to-go of every grid position, and repairs them incrementally in the style of D* Lite when
+    the wind field changes within a region. Since the target does not move, this reduces to lifelong
+    planning on the reverse graph rooted at the target. The work done by an update scales with the
+    number of grid positions whose cost-to-go changes rather than with the size of the grid.
+    """
+
+    def __init__(
+        self,
+        target: Vector3,
+        dimensions: Vector3,
+        wind_field: Field3,
+        grid_size: Vector3 = Vector3(100, 100, 100),
+        max_vertical_speed: float = 4.0,
+    ):
+        """
+        Initializes the controller with the given tuning parameters.
+        """
+        super().__init__(target, dimensions, wind_field, grid_size, max_vertical_speed)
+        self.successors: Dict[Vector3, Dict[Vector3, Tuple[float, float]]] = {}
+        self.predecessors: Dict[Vector3, Set[Vector3]] = {}
+        self.costs: Dict[Vector3, Tuple[float, float]] = {}
+        self.lookahead_costs: Dict[Vector3, Tuple[float, float]] = {}
+        self.queue: List[Tuple[Tuple[float, float], Vector3]] = []
+        self.queued: Dict[Vector3, Tuple[float, float]] = {}
+
+    def search(self) -> Dict[Vector3, Union[Vector3, None]]:
+        """
+        Builds the search graph and computes the lowest cost path from all grid positions to the
+        target. The returned parents map is kept up to date by subsequent wind field updates.
+        """
+        self.parents = {self.target_grid: None}
+        self.successors = {self.unreachable_grid: {self.target_grid: (0, 0)}}
+        self.predecessors = {self.target_grid: {self.unreachable_grid}}
+        for grid in self.grids():
+            self.set_edges(grid, self.edges(grid))
+
+        self.costs = {}
+        self.lookahead_costs = {self.target_grid: (0, 0)}
+        self.queue = [((0, 0), self.target_grid)]
+        self.queued = {self.target_grid: (0, 0)}
+        self.compute_costs()
+        return self.parents
+
+    def update_wind_field(
+        self, wind_field: Field3, lower_bound: Vector3, upper_bound: Vector3
+    ) -> int:
+        """
+        Replaces the wind field. The field is assumed to have changed only between the given lower
+        and upper bound positions. Repairs the cost-to-go of affected grid positions and updates the
+        current controller. Returns the number of grid positions that were expanded.
+        """
+        self.wind_field = FieldCache.shared(wind_field)
+        if self.parents is None:
+            return 0
+
+        # Recompute the outgoing edges of every grid position whose wind changed. Only the lookahead
+        # cost of these grid positions changes directly.
+        region_lower = self.position_to_grid(lower_bound)
+        region_upper = self.position_to_grid(upper_bound)
+        grid_lower, grid_upper = self.grid_bounds()
+        for x in range(
+            max(region_lower.x, grid_lower.x), min(region_upper.x + 1, grid_upper.x)
+        ):
+            for y in range(
+                max(region_lower.y, grid_lower.y), min(region_upper.y + 1, grid_upper.y)
+            ):
+                for z in range(
+                    max(region_lower.z, grid_lower.z),
+                    min(region_upper.z + 1, grid_upper.z),
+                ):
+                    grid = Vector3(x, y, z)
+                    self.set_edges(grid, self.edges(grid))
+                    self.update_grid(grid)
+
+        # Propagate the changes and switch to the repaired path.
+        expanded = self.compute_costs()
+        self.update_controller()
+        return expanded
+
+    def set_edges(self, grid: Vector3, edges: Dict[Vector3, Tuple[float, float]]):
+        """
+        Replaces the outgoing edges of the given grid position, keeping the reverse graph in sync.
+        """
+        for successor in self.successors.get(grid, {}):
+            self.predecessors[successor].discard(grid)
+        for successor in edges:
+            self.predecessors.setdefault(successor, set()).add(grid)
+        self.successors[grid] = edges
+
+    def update_grid(self, grid: Vector3):
+        """
+        Recomputes the lookahead cost and parent of the given grid position from its successors and
+        queues it if it is inconsistent.
+        """
+        assert self.parents is not None
+        infinity = (float("inf"), float("inf"))
+
+        if grid != self.target_grid:
+            best_cost, best_parent = infinity, None
+            for successor, edge_cost in self.successors.get(grid, {}).items():
+                cost = self.costs.get(successor, infinity)
+                cost = (cost[0] + edge_cost[0], cost[1] + edge_cost[1])
+                if cost < best_cost:
+                    best_cost, best_parent = cost, successor
+            self.lookahead_costs[grid] = best_cost
+            self.parents[grid] = best_parent
+
+        cost = self.costs.get(grid, infinity)
+        lookahead_cost = self.lookahead_costs.get(grid, infinity)
+        if cost != lookahead_cost:
+            key = min(cost, lookahead_cost)
+            self.queued[grid] = key
+            heapq.heappush(self.queue, (key, grid))
+        else:
+            self.queued.pop(grid, None)
+
+    def compute_costs(self) -> int:
+        """
+        Processes queued grid positions until every cost-to-go is consistent with its successors.
+        Returns the number of grid positions that were expanded.
+        """
+        infinity = (float("inf"), float("inf"))
+        expanded = 0
+
+        while self.queue:
+            key, grid = heapq.heappop(self.queue)
+            if self.queued.get(grid) != key:
+                continue
+            del self.queued[grid]
+            expanded += 1
+
+            cost = self.costs.get(grid, infinity)
+            lookahead_cost = self.lookahead_costs.get(grid, infinity)
+            if cost > lookahead_cost:
+                # The grid position became cheaper. Settle it and relax its predecessors.
+                self.costs[grid] = lookahead_cost
+            else:
+                # The grid position became more expensive. Invalidate it and requeue it along with
+                # its predecessors so that they can find alternative paths.
+                self.costs[grid] = infinity
+                self.update_grid(grid)
+
+            for predecessor in self.predecessors.get(grid, ()):
+                self.update_grid(predecessor)
+
+        return expanded
+
+
+class HierarchicalSearchPositionController(SearchPositionController):
+    """
+    A search controller for large domains. It first plans on a grid that is coarser by the given
+    refinement factor and then searches the fine grid only within a corridor around the coarse path.
+    The coarse planner is itself hierarchical if more than two levels are requested. A new corridor
+    is planned whenever the balloon leaves the current one, so memory and search time scale with the
+    length of the path rather than the volume of the domain.
+    """
+
+    def __init__(
+        self,
+        target: Vector3,
+        dimensions: Vector3,
+        wind_field: Field3,
+        grid_size: Vector3 = Vector3(100, 100, 100),
+        max_vertical_speed: float = 4.0,
+        refinement: Vector3 = Vector3(2, 2, 2),
+        levels: int = 2,
+        corridor_margin: int = 1,
+    ):
+        """
+        Initializes the controller with the given tuning parameters. The refinement factor must be
+        an integer in each dimension.
+        """
+        super().__init__(target, dimensions, wind_field, grid_size, max_vertical_speed)
+        self.refinement: Vector3 = Vector3(*(int(r) for r in refinement))
+        self.corridor_margin: int = corridor_margin
+        self.corridor: Union[Set[Vector3], None] = None
+
+        # Share the cached wind field with the coarse planner. The coarsest level searches the
+        # entire domain.
+        coarse_grid_size = self.grid_size * self.refinement
+        if levels > 2:
+            self.coarse: SearchPositionController = (
+                HierarchicalSearchPositionController(
+                    target,
+                    dimensions,
+                    self.wind_field,
+                    coarse_grid_size,
+                    max_vertical_speed,
+                    refinement,
+                    levels - 1,
+                    corridor_margin,
+                )
+            )
+        else:
+            self.coarse = SearchPositionController(
+                target,
+                dimensions,
+                self.wind_field,
+                coarse_grid_size,
+                max_vertical_speed,
+            )
+
+    def update_controller(self):
+        """
+        Updates the current controller, planning a new corridor if the balloon has left the current
+        one.
+        """
+        if self.current_grid is not None:
+            self.plan(self.current_grid)
+        super().update_controller()
+
+    def plan(self, grid: Vector3) -> List[Vector3]:
+        """
+        Returns the planned path from the given grid position. The coarse path and the corridor are
+        recomputed if the grid position is outside of the current corridor.
+        """
+        if self.corridor is None or not self.in_corridor(grid):
+            coarse_start = self.coarse.position_to_grid(self.grid_to_position(grid))
+            if isinstance(self.coarse, HierarchicalSearchPositionController):
+                coarse_path = self.coarse.plan(coarse_start)
+            else:
+                coarse_path = self.coarse.path(coarse_start)
+            self.corridor = self.make_corridor(coarse_path)
+            self.parents = self.search()
+        return self.path(grid)
+
+    def make_corridor(self, coarse_path: List[Vector3]) -> Set[Vector3]:
+        """
+        Returns the set of coarse grid positions within the margin of the given coarse path. The
+        coarse grid position containing the target is always included.
+        """
+        margin = range(-self.corridor_margin, self.corridor_margin + 1)
+        corridor: Set[Vector3] = set()
+        for coarse_grid in coarse_path + [self.coarse.target_grid]:
+            for dx in margin:
+                for dy in margin:
+                    for dz in margin:
+                        corridor.add(coarse_grid + Vector3(dx, dy, dz))
+        return corridor
+
+    def in_corridor(self, grid: Vector3) -> bool:
+        """
+        Checks if the given grid position is within the current corridor.
+        """
+        if self.corridor is None:
+            return True
+        return (
+            self.coarse.position_to_grid(self.grid_to_position(grid)) in self.corridor
+        )
+
+    def grid_in_bounds(self, grid: Vector3) -> bool:
+        """
+        Checks if the given grid position is within the bounds of the dimensions and the corridor.
+        """
+        return super().grid_in_bounds(grid) and self.in_corridor(grid)
+
+    def grids(self) -> Generator[Vector3, None, None]:
+        """
+        Yields all grid positions within the bounds of the dimensions and the corridor.
+        """
+        if self.corridor is None:
+            yield from super().grids()
+            return
+
+        r_x, r_y, r_z = self.refinement
+        for coarse_grid in sorted(self.corridor):
+            for x in range(coarse_grid.x * r_x, (coarse_grid.x + 1) * r_x):
+                for y in range(coarse_grid.y * r_y, (coarse_grid.y + 1) * r_y):
+                    for z in range(coarse_grid.z * r_z, (coarse_grid.z + 1) * r_z):
+                        grid = Vector3(x, y, z)
+                        if super().grid_in_bounds(grid):
+                            yield grid
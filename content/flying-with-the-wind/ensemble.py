@@ -0,0 +1,480 @@
+import functools
+import math
+from typing import Callable, Generator, List, Tuple, Union
+
+import numpy as np
+from balloon import Balloon, integrate
+from controller import (
+    PID_INTEGRAL,
+    PID_K_D,
+    PID_K_I,
+    PID_K_P,
+    PID_LAST_INPUT,
+    PID_LAST_OUTPUT,
+    PID_LAST_TIME,
+    PID_SETPOINT,
+    PID_STATE_SIZE,
+    update_vertical_position,
+    update_vertical_velocity,
+)
+from field import EnsembleField, Field3, UniformField
+from numba import jit
+from vector import Vector3
+
+BATCH_STATE_DTYPE = np.dtype(
+    [
+        ("time", np.float64),
+        ("position", np.float64, (3,)),
+        ("velocity", np.float64, (3,)),
+        ("temperature", np.float64),
+        ("fuel", np.float64),
+        ("vent", np.float64),
+    ]
+)
+"""
+Represents the state of one balloon in a batch. The fields and units match ControllerInput.
+"""
+
+type BatchController = Callable[[np.ndarray, np.ndarray, np.ndarray, np.ndarray], None]
+"""
+Represents a controller for a batch of balloons. It is called with a structured array of N states,
+a boolean mask of the balloons to control, and fuel and vent output arrays of length N. Outputs
+are only written for the masked balloons.
+"""
+
+
+def make_batch_states(num_balloons: int) -> np.ndarray:
+    """
+    Returns a zeroed structured array of states for the given number of balloons.
+    """
+    return np.zeros(num_balloons, dtype=BATCH_STATE_DTYPE)
+
+
+def get_batch_controller_input(balloons: List[Balloon], states: np.ndarray):
+    """
+    Writes the states of the given balloons into the given structured array.
+    """
+    for i, balloon in enumerate(balloons):
+        states[i]["time"] = balloon.time
+        states[i]["position"] = balloon.position
+        states[i]["velocity"] = balloon.velocity
+        states[i]["temperature"] = balloon.temperature
+        states[i]["fuel"] = balloon.fuel
+        states[i]["vent"] = balloon.vent
+
+    # Scale all states at once rather than through the per-balloon getters.
+    states["time"] *= Balloon.k_ratio_time
+    states["position"] *= Balloon.k_ratio_distance
+    states["velocity"] *= Balloon.k_ratio_distance / Balloon.k_ratio_time
+    states["temperature"] *= Balloon.k_ratio_temperature
+    states["fuel"] *= Balloon.k_ratio_fuel
+    states["vent"] *= Balloon.k_ratio_vent
+
+
+def apply_batch_controller_output(
+    balloons: List[Balloon], fuel: np.ndarray, vent: np.ndarray
+):
+    """
+    Applies the given fuel and vent outputs to the given balloons.
+    """
+    for balloon, balloon_fuel, balloon_vent in zip(balloons, fuel, vent):
+        balloon.set_fuel(balloon_fuel)
+        balloon.set_vent(balloon_vent)
+
+
+def make_pid_states(
+    num_balloons: int,
+    k_p: Union[float, np.ndarray],
+    k_i: Union[float, np.ndarray],
+    k_d: Union[float, np.ndarray],
+    setpoint: Union[float, np.ndarray],
+) -> np.ndarray:
+    """
+    Returns an array of shape (N, PID_STATE_SIZE) holding one PID state per balloon. Gains and
+    setpoints may be given per balloon.
+    """
+    states = np.empty((num_balloons, PID_STATE_SIZE), dtype=np.float64)
+    states[:, PID_K_P] = k_p
+    states[:, PID_K_I] = k_i
+    states[:, PID_K_D] = k_d
+    states[:, PID_SETPOINT] = setpoint
+    states[:, PID_INTEGRAL] = 0.0
+    states[:, PID_LAST_TIME] = 0.0
+    states[:, PID_LAST_INPUT] = np.nan
+    states[:, PID_LAST_OUTPUT] = np.nan
+    return states
+
+
+@functools.cache
+def make_batch_step_function(ensemble: bool = False) -> Callable[..., None]:
+    """
+    Returns a compiled function that advances the dimensionless states of a batch of balloons by one
+    step like Balloon.step. It takes an array of shape (N, 7) of states, the start time and time
+    delta, fuel and vent arrays, an array of step size hints (see Balloon.make_integrate_function),
+    the grid of the wind fields with an array of shape (F, X, Y, Z, 3) holding F sets of control
+    vectors, and the index of the control vectors used by each balloon. For an ensemble field, the
+    values of the grid are instead the pair of the ensemble's components and its array of member
+    weights, and the indices are the members used by each balloon (see EnsembleField). The states
+    and step size hints are updated in place. The function is only compiled once per kind of field,
+    and is cached on disk.
+    """
+
+    # Define the function to be compiled. The branch on the kind of field is pruned when compiling.
+    def step_batch(
+        x: np.ndarray,
+        time: float,
+        time_delta: float,
+        fuel: np.ndarray,
+        vent: np.ndarray,
+        step_sizes: np.ndarray,
+        dim_x: float,
+        dim_y: float,
+        dim_z: float,
+        points_x: np.ndarray,
+        points_y: np.ndarray,
+        points_z: np.ndarray,
+        values: Union[np.ndarray, Tuple[np.ndarray, np.ndarray]],
+        field_indices: np.ndarray,
+    ):
+        for i in range(x.shape[0]):
+            if ensemble:
+                member_values = (values[0], values[1][field_indices[i]])
+            else:
+                member_values = values[field_indices[i]]
+            x_end, step_sizes[i] = integrate(
+                x[i],
+                step_sizes[i],
+                time,
+                time + time_delta,
+                fuel[i],
+                vent[i],
+                dim_x,
+                dim_y,
+                dim_z,
+                points_x,
+                points_y,
+                points_z,
+                member_values,
+            )
+            if x_end[2] <= 0.0:
+                x_end[2] = 0.0
+                x_end[3:6] = 0.0
+            x[i] = x_end
+
+    # Return the compiled function.
+    return jit(step_batch, cache=True)
+
+
+class BalloonBatch:
+    """
+    Represents a batch of balloons in the same wind field, which are simulated together by a single
+    compiled function. The dimensionless state of balloon i is stored in row i of an array with the
+    same layout as Balloon.derivative. All balloons share the same time. The integrator differs
+    from Balloon.step (see Balloon.make_integrate_function), so trajectories agree with individual
+    balloons to within the integration tolerances. Balloons can also be given their own wind fields
+    over the same grid (see set_control_vectors), or fly different members of an ensemble field.
+    """
+
+    def __init__(
+        self,
+        num_balloons: int,
+        wind_field: Union[Field3, EnsembleField] = UniformField(Vector3(0.0, 0.0, 0.0)),
+    ):
+        """
+        Initializes the balloons at rest at the origin, like Balloon. The wind field must provide a
+        grid of control vectors, or be an ensemble field whose members are selected by
+        field_indices.
+        """
+        self.time: float = 0.0
+        self.x: np.ndarray = np.zeros((num_balloons, 7), dtype=np.float64)
+        self.x[:, 6] = 1.0
+        self.fuel: np.ndarray = np.zeros(num_balloons, dtype=np.float64)
+        self.vent: np.ndarray = np.zeros(num_balloons, dtype=np.float64)
+        self.step_sizes: np.ndarray = np.zeros(num_balloons, dtype=np.float64)
+
+        self.wind_field: Union[Field3, EnsembleField] = wind_field
+        self.field_indices: np.ndarray = np.zeros(num_balloons, dtype=np.int64)
+        if isinstance(wind_field, EnsembleField):
+            self.control_grid = wind_field.component_grid()
+        else:
+            # All balloons use the control vectors of the wind field until told otherwise.
+            self.control_grid = wind_field.control_grid()
+            self.control_vectors: np.ndarray = self.control_grid[2][np.newaxis]
+
+    def __len__(self) -> int:
+        return self.x.shape[0]
+
+    def set_control_vectors(self, control_vectors: np.ndarray):
+        """
+        Gives the batch F sets of control vectors as an array of shape (F, X, Y, Z, 3), each over the
+        same grid as the wind field. Balloon i uses the set given by field_indices[i], so a balloon
+        can switch fields by changing its index, and fields can be changed in place without
+        recompiling anything. Balloons of an ensemble batch select members of the ensemble field
+        instead.
+        """
+        if isinstance(self.wind_field, EnsembleField):
+            raise TypeError(
+                "The members of an ensemble batch are selected by field_indices"
+            )
+        if control_vectors.shape[1:] != self.control_vectors.shape[1:]:
+            raise ValueError("Control vectors do not match the grid of the wind field")
+        self.control_vectors = control_vectors
+
+    def reset(self, mask: np.ndarray):
+        """
+        Puts the masked balloons back at rest at the origin with no fuel or vent, like new balloons.
+        The time of the batch is unchanged, which does not affect the dynamics.
+        """
+        self.x[mask] = 0.0
+        self.x[mask, 6] = 1.0
+        self.fuel[mask] = 0.0
+        self.vent[mask] = 0.0
+        self.step_sizes[mask] = 0.0
+
+    def get_states(self, states: np.ndarray):
+        """
+        Writes the states of the balloons into the given structured array (see make_batch_states).
+        """
+        states["time"] = self.time * Balloon.k_ratio_time
+        states["position"] = self.x[:, 0:3] * Balloon.k_ratio_distance
+        states["velocity"] = self.x[:, 3:6] * (
+            Balloon.k_ratio_distance / Balloon.k_ratio_time
+        )
+        states["temperature"] = self.x[:, 6] * Balloon.k_ratio_temperature
+        states["fuel"] = self.fuel * Balloon.k_ratio_fuel
+        states["vent"] = self.vent * Balloon.k_ratio_vent
+
+    def set_output(self, fuel: np.ndarray, vent: np.ndarray):
+        """
+        Sets the fuel and vent percentages of the balloons.
+        """
+        self.fuel[:] = fuel / Balloon.k_ratio_fuel
+        self.vent[:] = vent / Balloon.k_ratio_vent
+
+    def step(self, duration: float):
+        """
+        Simulates the balloons for the given duration in seconds.
+        """
+        time_delta = duration / Balloon.k_ratio_time
+
+        # Start integrating new balloons with the step as a step size hint.
+        self.step_sizes[self.step_sizes <= 0.0] = time_delta
+
+        dimensions, control_points, values = self.control_grid
+        ensemble = isinstance(self.wind_field, EnsembleField)
+        make_batch_step_function(ensemble)(
+            self.x,
+            self.time,
+            time_delta,
+            self.fuel,
+            self.vent,
+            self.step_sizes,
+            *dimensions,
+            *control_points,
+            (values, self.wind_field.weights) if ensemble else self.control_vectors,
+            self.field_indices,
+        )
+        self.time = self.time + time_delta
+
+
+def run_batch(
+    balloons: BalloonBatch,
+    controller: BatchController,
+    time_step: float,
+    total_time: float,
+) -> Generator[np.ndarray, None, None]:
+    """
+    Runs the simulation of a batch of balloons like simulation.run. Yields a structured array of
+    states (see make_batch_states) for the initial state and after each step. The same array is
+    reused for every step, so copy it to keep it.
+    """
+    states = make_batch_states(len(balloons))
+    active = np.ones(len(balloons), dtype=np.bool_)
+    fuel = np.zeros(len(balloons), dtype=np.float64)
+    vent = np.zeros(len(balloons), dtype=np.float64)
+
+    start_time = balloons.time * Balloon.k_ratio_time
+    num_steps = int(math.ceil((total_time - start_time) / time_step - 1e-6))
+
+    balloons.get_states(states)
+    yield states
+    for _ in range(num_steps):
+        controller(states, active, fuel, vent)
+        balloons.set_output(fuel, vent)
+        balloons.step(time_step)
+        balloons.get_states(states)
+        yield states
+
+
+@jit(cache=True)
+def write_vertical_output(i: int, output: float, fuel: np.ndarray, vent: np.ndarray):
+    """
+    Writes the signed output of a vertical controller as fuel and vent percentages.
+    """
+    fuel[i] = output if output > 0 else 0.0
+    vent[i] = -output if output < 0 else 0.0
+
+
+@jit(cache=True)
+def update_vertical_velocities(
+    pid: np.ndarray,
+    active: np.ndarray,
+    velocity: np.ndarray,
+    time: np.ndarray,
+    fuel: np.ndarray,
+    vent: np.ndarray,
+):
+    """
+    Updates the vertical velocity PID controller of each active balloon.
+    """
+    for i in range(pid.shape[0]):
+        if active[i]:
+            output = update_vertical_velocity(pid[i], velocity[i], time[i])
+            write_vertical_output(i, output, fuel, vent)
+
+
+@jit(cache=True)
+def update_vertical_positions(
+    position_pid: np.ndarray,
+    velocity_pid: np.ndarray,
+    active: np.ndarray,
+    position: np.ndarray,
+    velocity: np.ndarray,
+    time: np.ndarray,
+    fuel: np.ndarray,
+    vent: np.ndarray,
+):
+    """
+    Updates the cascaded vertical position PID controller of each active balloon.
+    """
+    for i in range(position_pid.shape[0]):
+        if active[i]:
+            output = update_vertical_position(
+                position_pid[i], velocity_pid[i], position[i], velocity[i], time[i]
+            )
+            write_vertical_output(i, output, fuel, vent)
+
+
+class BatchFixedController:
+    """
+    A batch controller that returns a fixed output. The output may be given per balloon.
+    """
+
+    def __init__(self, fuel: Union[float, np.ndarray], vent: Union[float, np.ndarray]):
+        """
+        Initializes the controller with a fixed output.
+        """
+        self.fuel = fuel
+        self.vent = vent
+
+    def __call__(
+        self, states: np.ndarray, active: np.ndarray, fuel: np.ndarray, vent: np.ndarray
+    ):
+        """
+        Writes the controller output for the active balloons.
+        """
+        fuel[active] = np.broadcast_to(self.fuel, fuel.shape)[active]
+        vent[active] = np.broadcast_to(self.vent, vent.shape)[active]
+
+
+class BatchSequenceController:
+    """
+    A batch controller that switches between batch controllers at pre-defined times. Each balloon
+    uses the most recent controller whose time is less than or equal to its own time, and outputs
+    nothing before the first controller.
+    """
+
+    def __init__(self, *controllers: Tuple[float, BatchController]):
+        """
+        Initializes the controller with a sequence of batch controllers.
+        """
+        controllers = tuple(sorted(controllers, key=lambda t: t[0]))
+        self.times = np.array([time for time, _ in controllers], dtype=np.float64)
+        self.controllers = [controller for _, controller in controllers]
+
+    def __call__(
+        self, states: np.ndarray, active: np.ndarray, fuel: np.ndarray, vent: np.ndarray
+    ):
+        """
+        Writes the controller output for the active balloons.
+        """
+        indices = np.searchsorted(self.times, states["time"], side="right") - 1
+
+        inactive = active & (indices < 0)
+        fuel[inactive] = 0.0
+        vent[inactive] = 0.0
+
+        for index in np.unique(indices[active & (indices >= 0)]):
+            self.controllers[index](states, active & (indices == index), fuel, vent)
+
+
+class BatchVerticalVelocityController:
+    """
+    A batch version of VerticalVelocityController. Targets and gains may be given per balloon.
+    """
+
+    def __init__(
+        self,
+        num_balloons: int,
+        target: Union[float, np.ndarray],
+        k_p: Union[float, np.ndarray] = 10.874548503904872,
+        k_i: Union[float, np.ndarray] = 34.790141360779124,
+        k_d: Union[float, np.ndarray] = 124.25863289470911,
+    ):
+        """
+        Initializes the controller with the given tuning parameters.
+        """
+        self.pid = make_pid_states(num_balloons, k_p, k_i, k_d, target)
+
+    def __call__(
+        self, states: np.ndarray, active: np.ndarray, fuel: np.ndarray, vent: np.ndarray
+    ):
+        """
+        Writes the controller output for the active balloons.
+        """
+        update_vertical_velocities(
+            self.pid,
+            active,
+            states["velocity"][:, 2],
+            states["time"],
+            fuel,
+            vent,
+        )
+
+
+class BatchVerticalPositionController:
+    """
+    A batch version of VerticalPositionController. Targets and position gains may be given per
+    balloon.
+    """
+
+    def __init__(
+        self,
+        num_balloons: int,
+        target: Union[float, np.ndarray],
+        k_p: Union[float, np.ndarray] = 0.009774907674593549,
+        k_i: Union[float, np.ndarray] = 0.0,
+        k_d: Union[float, np.ndarray] = 0.0,
+    ):
+        """
+        Initializes the controller with the given tuning parameters.
+        """
+        self.pid = make_pid_states(num_balloons, k_p, k_i, k_d, target)
+        self.velocity_controller = BatchVerticalVelocityController(num_balloons, 0.0)
+
+    def __call__(
+        self, states: np.ndarray, active: np.ndarray, fuel: np.ndarray, vent: np.ndarray
+    ):
+        """
+        Writes the controller output for the active balloons.
+        """
+        update_vertical_positions(
+            self.pid,
+            self.velocity_controller.pid,
+            active,
+            states["position"][:, 2],
+            states["velocity"][:, 2],
+            states["time"],
+            fuel,
+            vent,
+        )
@@ -0,0 +1,216 @@
+from typing import Any, Dict, List, Union
+
+import numpy as np
+from balloon import Balloon
+from ensemble import BalloonBatch
+from evaluate import (
+    FIELD_DIMENSIONS,
+    FIELD_MAGNITUDE,
+    FIELD_NUM_DIMENSION_POINTS,
+    TARGET_DISTANCE,
+    TARGET_HEIGHT,
+    TIME_STEP,
+    TOTAL_TIME,
+)
+from field import RandomField
+from gymnasium import spaces
+from gymnasium.vector import VectorEnv
+
+# Number of values in an observation.
+NUM_OBSERVATIONS = 8
+
+
+class BalloonVectorEnv(VectorEnv):
+    """
+    A vectorized Gymnasium environment in which balloons learn to reach a target position. All
+    environments are simulated together by a BalloonBatch, so a step of N environments is a single
+    compiled call. Each episode has its own random wind field and a target at a random bearing, like
+    the evaluation scenarios (see evaluate.make_scenario).
+
+    The action is the vertical output in [-1, 1], where positive values are fuel and negative values
+    are vent, like the output of the vertical controllers. The observation is the offset from the
+    balloon to the target, the velocity, and the temperature in the balloon's dimensionless units,
+    followed by the fraction of the episode that has elapsed. The reward is the decrease of the
+    horizontal distance to the target in kilometers. Episodes terminate once the balloon is within
+    the target radius and are truncated after the total time.
+
+    Environments are reset automatically when their episode ends. As in the Gymnasium vector
+    environments, the observation returned for them is then the first of the next episode, and the
+    last observation of the episode is returned in the info as "final_observation".
+    """
+
+    def __init__(
+        self,
+        num_envs: int,
+        target_radius: float = 100.0,
+        time_step: float = TIME_STEP,
+        total_time: float = TOTAL_TIME,
+        copy: bool = True,
+        seed: Union[int, None] = None,
+        dtype: type = np.float64,
+    ):
+        """
+        Initializes the environments. If copy is false, step and reset return the same preallocated
+        arrays every time, so they must be copied to be kept. The wind fields are stored with the
+        given dtype (see RandomField).
+        """
+        super().__init__(
+            num_envs,
+            spaces.Box(-np.inf, np.inf, (NUM_OBSERVATIONS,), dtype=np.float32),
+            spaces.Box(-1.0, 1.0, (1,), dtype=np.float32),
+        )
+        self.target_radius = target_radius
+        self.time_step = time_step
+        self.total_time = total_time
+        self.copy = copy
+        self.generator = np.random.default_rng(seed)
+
+        # Give each environment its own wind field, which is regenerated in place on reset.
+        control_vectors = np.stack(
+            [
+                RandomField.make_control_vectors(
+                    FIELD_MAGNITUDE, FIELD_NUM_DIMENSION_POINTS, self.generator
+                )
+                for _ in range(num_envs)
+            ]
+        ).astype(dtype)
+        self.balloons = BalloonBatch(
+            num_envs,
+            RandomField.from_control_vectors(FIELD_DIMENSIONS, control_vectors[0]),
+        )
+        self.balloons.set_control_vectors(control_vectors)
+        self.balloons.field_indices[:] = np.arange(num_envs)
+
+        # Preallocate the state of the environments.
+        self.targets = np.zeros((num_envs, 3), dtype=np.float64)
+        self.episode_time = np.zeros(num_envs, dtype=np.float64)
+        self.distance = np.zeros(num_envs, dtype=np.float64)
+        self.fuel = np.zeros(num_envs, dtype=np.float64)
+        self.vent = np.zeros(num_envs, dtype=np.float64)
+        self.actions = np.zeros(num_envs, dtype=np.float64)
+
+        # Preallocate the results of a step.
+        self.observations = np.zeros((num_envs, NUM_OBSERVATIONS), dtype=np.float32)
+        self.rewards = np.zeros(num_envs, dtype=np.float64)
+        self.terminated = np.zeros(num_envs, dtype=np.bool_)
+        self.truncated = np.zeros(num_envs, dtype=np.bool_)
+
+    def reset_wait(
+        self,
+        seed: Union[int, List[int], None] = None,
+        options: Union[Dict[str, Any], None] = None,
+    ):
+        """
+        Resets all environments and returns their observations and an empty info.
+        """
+        if isinstance(seed, list):
+            seed = seed[0]
+        if seed is not None:
+            self.generator = np.random.default_rng(seed)
+
+        self.reset_envs(np.ones(self.num_envs, dtype=np.bool_))
+        self.write_observations()
+        return self.get_result(self.observations), {}
+
+    def step_async(self, actions: np.ndarray):
+        """
+        Stores the actions of the next step.
+        """
+        self.actions[:] = np.clip(np.reshape(actions, self.num_envs), -1.0, 1.0)
+
+    def step_wait(self, **kwargs):
+        """
+        Steps all environments with the stored actions. Returns the observations, rewards,
+        terminations, truncations, and info.
+        """
+        # Simulate one step of every balloon.
+        np.multiply(np.maximum(self.actions, 0.0), 100.0, out=self.fuel)
+        np.multiply(np.maximum(-self.actions, 0.0), 100.0, out=self.vent)
+        self.balloons.set_output(self.fuel, self.vent)
+        self.balloons.step(self.time_step)
+        self.episode_time += self.time_step
+
+        # Reward the progress towards the target.
+        self.rewards[:] = self.distance
+        self.update_distance()
+        self.rewards -= self.distance
+        self.rewards /= 1000.0
+
+        # Allow for rounding in the accumulated episode time.
+        np.less_equal(self.distance, self.target_radius, out=self.terminated)
+        np.greater_equal(
+            self.episode_time,
+            self.total_time - 1e-6 * self.time_step,
+            out=self.truncated,
+        )
+        self.truncated &= ~self.terminated
+        self.write_observations()
+
+        # Start new episodes where the episode ended.
+        infos: Dict[str, Any] = {}
+        done = self.terminated | self.truncated
+        if done.any():
+            final_observations = np.full(self.num_envs, None, dtype=object)
+            final_infos = np.full(self.num_envs, None, dtype=object)
+            for i in np.flatnonzero(done):
+                final_observations[i] = self.observations[i].copy()
+                final_infos[i] = {"distance": self.distance[i]}
+            infos["final_observation"] = final_observations
+            infos["_final_observation"] = done
+            infos["final_info"] = final_infos
+            infos["_final_info"] = done
+
+            self.reset_envs(done)
+            self.write_observations()
+
+        return (
+            self.get_result(self.observations),
+            self.get_result(self.rewards),
+            self.get_result(self.terminated),
+            self.get_result(self.truncated),
+            infos,
+        )
+
+    def reset_envs(self, mask: np.ndarray):
+        """
+        Starts new episodes in the masked environments with new wind fields and targets.
+        """
+        for i in np.flatnonzero(mask):
+            self.balloons.control_vectors[i] = RandomField.make_control_vectors(
+                FIELD_MAGNITUDE, FIELD_NUM_DIMENSION_POINTS, self.generator
+            )
+
+        theta = self.generator.uniform(0, 2 * np.pi, self.num_envs)
+        self.targets[mask, 0] = TARGET_DISTANCE * np.cos(theta[mask])
+        self.targets[mask, 1] = TARGET_DISTANCE * np.sin(theta[mask])
+        self.targets[mask, 2] = TARGET_HEIGHT
+
+        self.balloons.reset(mask)
+        self.episode_time[mask] = 0.0
+        self.update_distance()
+
+    def update_distance(self):
+        """
+        Updates the horizontal distance in meters from each balloon to its target.
+        """
+        position = self.balloons.x[:, 0:2] * Balloon.k_ratio_distance
+        np.hypot(
+            self.targets[:, 0] - position[:, 0],
+            self.targets[:, 1] - position[:, 1],
+            out=self.distance,
+        )
+
+    def write_observations(self):
+        """
+        Writes the observations of the current states into the preallocated array.
+        """
+        x = self.balloons.x
+        self.observations[:, 0:3] = self.targets / Balloon.k_ratio_distance - x[:, 0:3]
+        self.observations[:, 3:7] = x[:, 3:7]
+        self.observations[:, 7] = self.episode_time / self.total_time
+
+    def get_result(self, array: np.ndarray) -> np.ndarray:
+        """
+        Returns the given preallocated array, or a copy of it if the environment copies its results.
+        """
+        return array.copy() if self.copy else array
@@ -1,6 +1,11 @@
+import hashlib
+import inspect
+import json
 import multiprocessing
-from functools import partial
-from typing import List, Tuple
+import os
+from multiprocessing import resource_tracker
+from multiprocessing.shared_memory import SharedMemory
+from typing import Dict, Generator, List, Sequence, Tuple, Union
 
 import numpy as np
 from balloon import Balloon
@@ -9,12 +14,19 @@ from controller import (
     SearchPositionController,
     VerticalPositionController,
 )
-from field import RandomField
+from field import FieldCache, RandomField, get_source_digest
 from monitor import Monitor
-from simulation import run
-from tqdm import tqdm
+from simulation import NoImprovement, run
+from store import ResultStore
 from vector import Vector3
 
+POLICY_CACHE = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), ".cache", "policy"
+)
+"""
+The directory used to cache search policies between evaluations.
+"""
+
 
 def penalty(target: Vector3, monitor: Monitor) -> float:
     """
@@ -31,77 +43,450 @@ def penalty(target: Vector3, monitor: Monitor) -> float:
     return np.min(distance)
 
 
-def simulate_one(controller_type: str, seed: int) -> Tuple[Vector3, Monitor]:
+RESULT_STORE = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), ".cache", "results.sqlite"
+)
+"""
+The file used to store evaluation results between runs.
+"""
+
+# Parameters of the evaluation scenarios.
+FIELD_MAGNITUDE = Vector3(10.0, 10.0, 0.0)
+FIELD_DIMENSIONS = Vector3(4000.0, 4000.0, 2000.0)
+FIELD_NUM_DIMENSION_POINTS = Vector3(20, 20, 10)
+TARGET_DISTANCE = 2000.0
+TARGET_HEIGHT = 500.0
+TIME_STEP = 1.0
+TOTAL_TIME = 7200.0
+
+RESULT_VERSION = 1
+"""
+The version of the stored results. It must be incremented when penalties change for a reason that
+the simulation sources do not capture, like a dependency upgrade.
+"""
+
+SIMULATION_MODULES = [
+    "balloon",
+    "controller",
+    "ensemble",
+    "evaluate",
+    "field",
+    "monitor",
+    "policy",
+    "simulation",
+    "vector",
+]
+"""
+The modules whose sources determine the penalties. Changing any of them invalidates stored results.
+"""
+
+
+CONFIG_DIGEST = hashlib.sha256(
+    repr(
+        (
+            RESULT_VERSION,
+            get_source_digest(SIMULATION_MODULES),
+            tuple(FIELD_MAGNITUDE),
+            tuple(FIELD_DIMENSIONS),
+            tuple(FIELD_NUM_DIMENSION_POINTS),
+            TARGET_DISTANCE,
+            TARGET_HEIGHT,
+            TIME_STEP,
+            TOTAL_TIME,
+        )
+    ).encode()
+).hexdigest()
+"""
+A hash identifying the evaluation scenarios and the code simulating them, used to key stored
+results.
+"""
+
+CONTROLLER_PARAMETERS: Dict[str, Dict[str, float]] = {
+    "Fixed": {"target": TARGET_HEIGHT},
+    "Greedy": {},
+    "Search": {},
+}
+"""
+The parameters passed to each controller type in addition to the scenario.
+"""
+
+CONTROLLER_TYPES: Dict[str, type] = {
+    "Fixed": VerticalPositionController,
+    "Greedy": GreedyPositionController,
+    "Search": SearchPositionController,
+}
+"""
+The controller class of each controller type.
+"""
+
+# Constructor parameters which do not change the results of a controller.
+IGNORED_PARAMETERS = {"policy_cache"}
+
+
+def controller_key(controller_type: str) -> str:
+    """
+    Returns the canonical form of the given controller type's effective parameters, used to key
+    stored results. These are the parameters it is built with along with the defaults of its
+    constructor, so that changing a default does not return stale results.
+    """
+    parameters = {
+        name: parameter.default
+        for name, parameter in inspect.signature(
+            CONTROLLER_TYPES[controller_type]
+        ).parameters.items()
+        if parameter.default is not inspect.Parameter.empty
+        and name not in IGNORED_PARAMETERS
+    }
+    parameters.update(CONTROLLER_PARAMETERS[controller_type])
+    return json.dumps(parameters, sort_keys=True)
+
+
+def make_scenario(seed: int) -> Tuple[np.ndarray, Vector3]:
     """
-    Simulates the given controller with the given seed.
+    Generates the scenario for the given seed. Returns the control vectors of the wind field (see
+    RandomField.from_control_vectors) and the target position.
     """
     generator = np.random.default_rng(seed)
 
-    magnitude = Vector3(10.0, 10.0, 0.0)
-    dimensions = Vector3(4000.0, 4000.0, 2000.0)
-    num_dimension_points = Vector3(20, 20, 10)
-    wind_field = RandomField(
-        magnitude, dimensions, num_dimension_points, generator=generator
+    control_vectors = RandomField.make_control_vectors(
+        FIELD_MAGNITUDE, FIELD_NUM_DIMENSION_POINTS, generator=generator
     )
 
     theta = generator.uniform(0, 2 * np.pi)
-    x = 2000.0 * np.cos(theta)
-    y = 2000.0 * np.sin(theta)
-    target = Vector3(x, y, 500.0)
+    x = TARGET_DISTANCE * np.cos(theta)
+    y = TARGET_DISTANCE * np.sin(theta)
+    target = Vector3(x, y, TARGET_HEIGHT)
+
+    return control_vectors, target
+
 
+def simulate_scenario(
+    controller_type: str,
+    wind_field: RandomField,
+    target: Vector3,
+    policy_cache: Union[str, None] = POLICY_CACHE,
+    stop_early: bool = False,
+) -> Monitor:
+    """
+    Simulates the given controller in the given scenario. If stop_early is set, the simulation
+    stops once the penalty provably cannot improve, so the trajectory may be shorter than the full
+    horizon. This only saves a few percent of the steps, and checking the condition after every
+    step prevents integrating several steps at once, so it is only used to compute penalties.
+    Search policies are cached in the given directory, if any.
+    """
+    if controller_type not in CONTROLLER_PARAMETERS:
+        raise ValueError(f"Unknown controller type {controller_type}")
+
+    dimensions = FIELD_DIMENSIONS
+    parameters = CONTROLLER_PARAMETERS[controller_type]
     if controller_type == "Fixed":
-        controller = VerticalPositionController(500)
+        controller = VerticalPositionController(**parameters)
     elif controller_type == "Greedy":
-        controller = GreedyPositionController(target, dimensions, wind_field)
-    elif controller_type == "Search":
-        controller = SearchPositionController(target, dimensions, wind_field)
+        controller = GreedyPositionController(
+            target, dimensions, wind_field, **parameters
+        )
     else:
-        raise ValueError(f"Unknown controller type {controller_type}")
+        controller = SearchPositionController(
+            target, dimensions, wind_field, policy_cache=policy_cache, **parameters
+        )
 
-    monitor = run(
+    return run(
         balloon=Balloon(wind_field),
         controller=controller,
-        time_step=1.0,
-        total_time=7200.0,
+        time_step=TIME_STEP,
+        total_time=TOTAL_TIME,
         show_progress=False,
+        stop_conditions=(
+            [NoImprovement.from_field(target, TOTAL_TIME, wind_field)]
+            if stop_early
+            else []
+        ),
     )
 
-    return target, monitor
+
+def simulate_one(
+    controller_type: str, seed: int, stop_early: bool = False
+) -> Tuple[Vector3, Monitor]:
+    """
+    Simulates the given controller with the given seed (see simulate_scenario).
+    """
+    control_vectors, target = make_scenario(seed)
+    wind_field = RandomField.from_control_vectors(FIELD_DIMENSIONS, control_vectors)
+    return target, simulate_scenario(
+        controller_type, wind_field, target, stop_early=stop_early
+    )
 
 
 def evaluate_one(controller_type: str, seed: int) -> float:
     """
     Evaluates the given controller with the given seed.
     """
-    target, monitor = simulate_one(controller_type, seed)
+    target, monitor = simulate_one(controller_type, seed, stop_early=True)
     return penalty(target, monitor)
 
 
-def evaluate(controller_type: str, num_simulations: int = 100) -> List[float]:
+def initialize_worker():
     """
-    Evaluates the given controller with the given number of simulations. Returns the penalties from
-    the simulations.
+    Initializes an evaluation worker process. Running a short simulation compiles the functions
+    which are shared by all simulations, so that tasks do not pay for it.
+    """
+    wind_field = RandomField(Vector3(1.0, 1.0, 0.0), FIELD_DIMENSIONS, Vector3(2, 2, 2))
+    target = Vector3(1000.0, 1000.0, 500.0)
+    for controller in [
+        VerticalPositionController(500),
+        GreedyPositionController(target, FIELD_DIMENSIONS, wind_field),
+    ]:
+        run(
+            balloon=Balloon(wind_field),
+            controller=controller,
+            time_step=1.0,
+            total_time=10.0,
+            show_progress=False,
+        )
+
+
+def evaluate_task(
+    task: Tuple[
+        str, Tuple[int, ...], int, int, Vector3, Sequence[str], Union[str, None]
+    ],
+) -> List[Tuple[str, int, float]]:
+    """
+    Evaluates the given controller types on one scenario whose control vectors are stored in shared
+    memory. The field is only compiled once for all controller types. Returns the controller type,
+    seed, and penalty of each evaluation.
     """
-    with multiprocessing.Pool() as pool:
-        results = list(
-            tqdm(
-                pool.imap(
-                    partial(evaluate_one, controller_type), range(num_simulations)
+    name, shape, index, seed, target, controller_types, policy_cache = task
+
+    # Copy the control vectors out of shared memory so that it can be closed right away.
+    shared_memory = SharedMemory(name=name)
+    try:
+        control_vectors = np.array(
+            np.ndarray(shape, dtype=np.float64, buffer=shared_memory.buf)[index]
+        )
+    finally:
+        shared_memory.close()
+
+    wind_field = RandomField.from_control_vectors(FIELD_DIMENSIONS, control_vectors)
+
+    # Hold the shared field cache while the controllers of every type run, so that they reuse it.
+    field_cache = FieldCache.shared(wind_field)
+    results = [
+        (
+            controller_type,
+            seed,
+            penalty(
+                target,
+                simulate_scenario(
+                    controller_type, wind_field, target, policy_cache, stop_early=True
                 ),
-                total=num_simulations,
-            )
+            ),
         )
+        for controller_type in controller_types
+    ]
+    field_cache.clear()
     return results
 
 
+class EvaluationEngine:
+    """
+    Evaluates controllers in a pool of worker processes which are kept warm between evaluations.
+    The scenario of each seed is generated once into shared memory and every controller type is
+    evaluated on it in the same task, so each wind field is only compiled once. Results are
+    streamed back in batches.
+    """
+
+    def __init__(
+        self,
+        processes: Union[int, None] = None,
+        batch_size: int = 2,
+        policy_cache: Union[str, None] = POLICY_CACHE,
+    ):
+        """
+        Initializes the engine and starts its worker processes. The batch size is the number of
+        seeds sent to a worker at once. Search policies are cached in the given directory, if any.
+        """
+        # Start the resource tracker before the workers so that they share it. Otherwise, workers
+        # attaching to shared memory would track it separately and try to unlink it when exiting.
+        resource_tracker.ensure_running()
+        self.pool = multiprocessing.Pool(processes, initializer=initialize_worker)
+        self.batch_size: int = batch_size
+        self.policy_cache: Union[str, None] = policy_cache
+
+        # Shared memory of interrupted evaluations, which workers may still be using.
+        self.abandoned_memory: List[SharedMemory] = []
+
+    def __enter__(self) -> "EvaluationEngine":
+        return self
+
+    def __exit__(self, exception_type, *_):
+        if exception_type is None:
+            self.close()
+        else:
+            self.terminate()
+
+    def close(self):
+        """
+        Stops the worker processes once they finish their current tasks.
+        """
+        self.pool.close()
+        self.pool.join()
+        self.release_abandoned_memory()
+
+    def terminate(self):
+        """
+        Stops the worker processes immediately.
+        """
+        self.pool.terminate()
+        self.pool.join()
+        self.release_abandoned_memory()
+
+    def release_abandoned_memory(self):
+        """
+        Releases the shared memory of interrupted evaluations. This must only be called once the
+        workers have stopped.
+        """
+        for shared_memory in self.abandoned_memory:
+            shared_memory.close()
+            shared_memory.unlink()
+        self.abandoned_memory.clear()
+
+    def stream(
+        self,
+        controller_types: Sequence[str],
+        seeds: Sequence[int],
+        store: Union[ResultStore, None] = None,
+    ) -> Generator[Tuple[str, int, float], None, None]:
+        """
+        Evaluates the given controller types with the given seeds. Yields the controller type, seed,
+        and penalty of each evaluation as soon as its batch completes, in no particular order. If a
+        store is given, stored results are yielded first without being evaluated again, and new
+        results are added to it as they arrive.
+        """
+        # Find the controller types which still need to be evaluated for each seed.
+        pending: Dict[int, List[str]] = {seed: [] for seed in seeds}
+        for controller_type in controller_types:
+            stored = {}
+            if store is not None:
+                stored = store.get(
+                    controller_type,
+                    controller_key(controller_type),
+                    CONFIG_DIGEST,
+                    seeds,
+                )
+            for seed in seeds:
+                if seed in stored:
+                    yield controller_type, seed, stored[seed]
+                else:
+                    pending[seed].append(controller_type)
+
+        seeds = [seed for seed in seeds if pending[seed]]
+        if not seeds:
+            return
+
+        # Generate the scenarios into shared memory.
+        scenarios = [make_scenario(seed) for seed in seeds]
+        shape = (len(seeds),) + scenarios[0][0].shape
+        shared_memory = SharedMemory(
+            create=True, size=int(np.prod(shape)) * np.dtype(np.float64).itemsize
+        )
+        completed = False
+        try:
+            control_vectors = np.ndarray(
+                shape, dtype=np.float64, buffer=shared_memory.buf
+            )
+            for i, (scenario_control_vectors, _) in enumerate(scenarios):
+                control_vectors[i] = scenario_control_vectors
+            del control_vectors
+
+            tasks = [
+                (
+                    shared_memory.name,
+                    shape,
+                    i,
+                    seed,
+                    target,
+                    tuple(pending[seed]),
+                    self.policy_cache,
+                )
+                for i, (seed, (_, target)) in enumerate(zip(seeds, scenarios))
+            ]
+            for results in self.pool.imap_unordered(
+                evaluate_task, tasks, chunksize=self.batch_size
+            ):
+                for controller_type, seed, result in results:
+                    if store is not None:
+                        store.add(
+                            controller_type,
+                            controller_key(controller_type),
+                            CONFIG_DIGEST,
+                            seed,
+                            result,
+                        )
+                    yield controller_type, seed, result
+            completed = True
+        finally:
+            if completed:
+                shared_memory.close()
+                shared_memory.unlink()
+            else:
+                # Workers may still attach to the memory for tasks that were already sent, so keep
+                # it until they have stopped.
+                self.abandoned_memory.append(shared_memory)
+
+    def evaluate(
+        self,
+        controller_types: Sequence[str],
+        seeds: Sequence[int],
+        show_progress: bool = True,
+        store: Union[ResultStore, None] = None,
+    ) -> Dict[str, List[float]]:
+        """
+        Evaluates the given controller types with the given seeds. Returns the penalties of each
+        controller type in the order of the seeds. If a store is given, only results missing from it
+        are evaluated (see stream).
+        """
+        from tqdm import tqdm
+
+        indices = {seed: i for i, seed in enumerate(seeds)}
+        results = {
+            controller_type: [0.0] * len(seeds) for controller_type in controller_types
+        }
+        for controller_type, seed, result in tqdm(
+            self.stream(controller_types, seeds, store),
+            total=len(controller_types) * len(seeds),
+            disable=not show_progress,
+        ):
+            results[controller_type][indices[seed]] = result
+        return results
+
+
+def evaluate(
+    controller_type: str,
+    num_simulations: int = 100,
+    engine: Union[EvaluationEngine, None] = None,
+) -> List[float]:
+    """
+    Evaluates the given controller with the given number of simulations. Returns the penalties from
+    the simulations. If no engine is given, a temporary one is used.
+    """
+    if engine is None:
+        with EvaluationEngine() as engine:
+            return evaluate(controller_type, num_simulations, engine)
+
+    return engine.evaluate([controller_type], range(num_simulations))[controller_type]
+
+
 if __name__ == "__main__":
-    for controller_type in ["Fixed", "Greedy", "Search"]:
-        results = evaluate(controller_type)
+    controller_types = ["Fixed", "Greedy", "Search"]
+    with EvaluationEngine() as engine, ResultStore(RESULT_STORE) as store:
+        results = engine.evaluate(controller_types, range(100), store=store)
+
+    for controller_type in controller_types:
         print(
             "controller_type={}, mean={}, median={}, standard_deviation={}".format(
                 controller_type,
-                np.mean(results),
-                np.median(results),
-                np.std(results),
+                np.mean(results[controller_type]),
+                np.median(results[controller_type]),
+                np.std(results[controller_type]),
             )
         )
@@ -1,14 +1,479 @@
-from typing import Callable, Tuple
+import hashlib
+import json
+import os
+import weakref
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Callable, Dict, Iterator, List, Sequence, Tuple, Union
 
 import numpy as np
-from numba import jit
+from numba import config as numba_config
+from numba import jit, types
+from numba.extending import overload
 from vector import Vector3
 
+KERNEL_CACHE = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), ".cache", "numba"
+)
+"""
+The directory used to cache compiled functions between runs, unless NUMBA_CACHE_DIR is set.
+"""
+
+KERNEL_MODULES = ["balloon", "controller", "ensemble", "field", "simulation"]
+"""
+The modules defining compiled functions which are cached on disk. A module defining such functions
+must be added here, or changes to it will not be picked up by the functions calling into it.
+"""
+
+
+def get_source_digest(modules: Sequence[str]) -> str:
+    """
+    Returns a hash of the sources of the given modules of this directory.
+    """
+    digest = hashlib.sha256()
+    for name in modules:
+        with open(
+            os.path.join(os.path.dirname(os.path.abspath(__file__)), f"{name}.py"), "rb"
+        ) as f:
+            digest.update(f.read())
+    return digest.hexdigest()
+
+
+# Compiled functions are cached along with the compiled functions they call from other modules, but
+# numba only checks the file of each function for changes. Key the cache on the sources of all
+# modules defining compiled functions, so that changing any of them recompiles every function. This
+# module is imported by all of them before they define their functions.
+numba_config.CACHE_DIR = os.path.join(
+    numba_config.CACHE_DIR or KERNEL_CACHE, get_source_digest(KERNEL_MODULES)[:16]
+)
+
 type Field3 = Callable[[Vector3], Vector3]
 """
 Represents an arbitrary field in 3D space.
 """
 
+type Field4 = Callable[[Vector3, float], Vector3]
+"""
+Represents an arbitrary field in 3D space that varies in time. The time is in seconds.
+"""
+
+
+def sample_field(field: Field3, positions: np.ndarray) -> np.ndarray:
+    """
+    Computes the field at each of the given positions, which is an array of shape (N, 3). Returns an
+    array of the same shape. Fields that provide a compiled batch function use it, and other fields
+    are evaluated one position at a time.
+    """
+    interpolate_many = getattr(field, "interpolate_many", None)
+    if interpolate_many is not None:
+        return interpolate_many(np.ascontiguousarray(positions, dtype=np.float64))
+
+    values = np.empty((positions.shape[0], 3), dtype=np.float64)
+    for i, position in enumerate(positions):
+        values[i] = field(Vector3(*position))
+    return values
+
+
+@dataclass
+class FieldCacheStats:
+    """
+    Represents the counters of a field cache.
+    """
+
+    hits: int
+    misses: int
+    evictions: int
+    size: int
+
+    @property
+    def hit_rate(self) -> float:
+        """
+        Returns the fraction of lookups that were served from the cache.
+        """
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+
+class FieldCache:
+    """
+    A bounded cache in front of a field. Entries are evicted in least recently used ("lru") or
+    first in first out ("fifo") order once the maximum number of entries is reached. Each entry
+    holds two Vector3 and takes roughly 400 bytes. Positions can optionally be snapped to the
+    center of a grid before lookup, which trades accuracy for a higher hit rate.
+    """
+
+    # Caches shared between users of the same field, keyed by the field and the cache parameters.
+    # Each cache references its field, so the caches are held weakly too. Otherwise, the field would
+    # keep itself alive through its caches and neither would ever be freed.
+    shared_caches: "weakref.WeakKeyDictionary[Field3, weakref.WeakValueDictionary[Tuple, FieldCache]]" = (weakref.WeakKeyDictionary())
+
+    def __init__(
+        self,
+        field: Field3,
+        max_entries: int = 2**18,
+        policy: str = "lru",
+        quantization: Union[Vector3, None] = None,
+    ):
+        """
+        Initializes the cache for the given field.
+        """
+        if policy not in ("lru", "fifo"):
+            raise ValueError(f"Unknown eviction policy {policy}")
+
+        self.field: Field3 = field
+        self.max_entries: int = max_entries
+        self.policy: str = policy
+        self.quantization: Union[Vector3, None] = quantization
+        self.entries: OrderedDict[Vector3, Vector3] = OrderedDict()
+
+        self.hits: int = 0
+        self.misses: int = 0
+        self.evictions: int = 0
+
+        # Quantization changes the values of the field, so it is part of the identity.
+        field_digest = getattr(field, "digest", None)
+        if field_digest is not None and quantization is not None:
+            field_digest = hashlib.sha256(
+                repr((field_digest, tuple(quantization))).encode()
+            ).hexdigest()
+        self.digest: Union[str, None] = field_digest
+
+    @staticmethod
+    def shared(
+        field: Field3,
+        max_entries: int = 2**18,
+        policy: str = "lru",
+        quantization: Union[Vector3, None] = None,
+    ) -> "FieldCache":
+        """
+        Returns a cache for the given field that is shared with every other caller using the same
+        field and parameters. A field that is already a cache is returned as is. The cache is only
+        shared while a caller holds it, so callers that use a field one after the other should hold
+        the cache for as long as they want to share it.
+        """
+        if isinstance(field, FieldCache):
+            return field
+
+        key = (max_entries, policy, quantization)
+        try:
+            caches = FieldCache.shared_caches.setdefault(
+                field, weakref.WeakValueDictionary()
+            )
+        except TypeError:
+            # The field cannot be weakly referenced, so it cannot be shared.
+            return FieldCache(field, max_entries, policy, quantization)
+
+        cache = caches.get(key)
+        if cache is None:
+            cache = caches[key] = FieldCache(field, max_entries, policy, quantization)
+        return cache
+
+    def __call__(self, position: Vector3) -> Vector3:
+        """
+        Computes the field at the given position, using the cached value if there is one.
+        """
+        if self.quantization is not None:
+            q = self.quantization
+            position = Vector3(
+                (position.x // q.x) * q.x + q.x / 2,
+                (position.y // q.y) * q.y + q.y / 2,
+                (position.z // q.z) * q.z + q.z / 2,
+            )
+
+        value = self.entries.get(position)
+        if value is not None:
+            self.hits += 1
+            if self.policy == "lru":
+                self.entries.move_to_end(position)
+            return value
+
+        self.misses += 1
+        value = self.field(position)
+        self.entries[position] = value
+        if len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+        return value
+
+    def stats(self) -> FieldCacheStats:
+        """
+        Returns the current counters of the cache.
+        """
+        return FieldCacheStats(
+            hits=self.hits,
+            misses=self.misses,
+            evictions=self.evictions,
+            size=len(self.entries),
+        )
+
+    def clear(self):
+        """
+        Removes all entries from the cache. The counters are kept.
+        """
+        self.entries.clear()
+
+    def __getstate__(self) -> dict:
+        """
+        Returns the state to pickle. The entries are not pickled since they can be recomputed.
+        """
+        state = self.__dict__.copy()
+        state["entries"] = OrderedDict()
+        return state
+
+    def __deepcopy__(self, memo: dict) -> "FieldCache":
+        """
+        Returns the cache itself. Copies of the cache's users share it, since it only memoizes the
+        field.
+        """
+        return self
+
+
+@jit(cache=True)
+def interpolate_grid(
+    dim_x: float,
+    dim_y: float,
+    dim_z: float,
+    points_x: np.ndarray,
+    points_y: np.ndarray,
+    points_z: np.ndarray,
+    values: np.ndarray,
+    xi_x: float,
+    xi_y: float,
+    xi_z: float,
+) -> np.ndarray:
+    """
+    Trilinearly interpolates a grid of control vectors at the given position. The grid spans the
+    given dimensions, centered horizontally, with evenly spaced control points. Positions outside of
+    the grid are clamped to its bounds.
+    """
+    # Ensure the input is within bounds.
+    xi_x = min(max(xi_x, -dim_x / 2), dim_x / 2)
+    xi_y = min(max(xi_y, -dim_y / 2), dim_y / 2)
+    xi_z = min(max(xi_z, 0), dim_z)
+
+    # Compute the deltas between consecutive grid points.
+    delta_x = points_x[1] - points_x[0]
+    delta_y = points_y[1] - points_y[0]
+    delta_z = points_z[1] - points_z[0]
+
+    # Find the indices based on deltas.
+    i_x = int((xi_x - points_x[0]) / delta_x)
+    i_y = int((xi_y - points_y[0]) / delta_y)
+    i_z = int((xi_z - points_z[0]) / delta_z)
+
+    # Ensure the indices are within bounds.
+    i_x = max(0, min(i_x, points_x.shape[0] - 2))
+    i_y = max(0, min(i_y, points_y.shape[0] - 2))
+    i_z = max(0, min(i_z, points_z.shape[0] - 2))
+
+    # Get the values at the 8 surrounding grid points.
+    v_000 = values[i_x, i_y, i_z]
+    v_001 = values[i_x, i_y, i_z + 1]
+    v_010 = values[i_x, i_y + 1, i_z]
+    v_011 = values[i_x, i_y + 1, i_z + 1]
+    v_100 = values[i_x + 1, i_y, i_z]
+    v_101 = values[i_x + 1, i_y, i_z + 1]
+    v_110 = values[i_x + 1, i_y + 1, i_z]
+    v_111 = values[i_x + 1, i_y + 1, i_z + 1]
+
+    # Compute the trilinear interpolation.
+    relative_x = (xi_x - points_x[i_x]) / delta_x
+    relative_y = (xi_y - points_y[i_y]) / delta_y
+    relative_z = (xi_z - points_z[i_z]) / delta_z
+    c_00 = v_000 + (v_100 - v_000) * relative_x
+    c_01 = v_001 + (v_101 - v_001) * relative_x
+    c_10 = v_010 + (v_110 - v_010) * relative_x
+    c_11 = v_011 + (v_111 - v_011) * relative_x
+    c_0 = c_00 + (c_10 - c_00) * relative_y
+    c_1 = c_01 + (c_11 - c_01) * relative_y
+    return c_0 + (c_1 - c_0) * relative_z
+
+
+@jit(cache=True)
+def interpolate_grid_in_time(
+    dim_x: float,
+    dim_y: float,
+    dim_z: float,
+    points_x: np.ndarray,
+    points_y: np.ndarray,
+    points_z: np.ndarray,
+    values_0: np.ndarray,
+    values_1: np.ndarray,
+    weight: float,
+    xi_x: float,
+    xi_y: float,
+    xi_z: float,
+) -> np.ndarray:
+    """
+    Interpolates between two grids of control vectors over the same control points at the given
+    position (see interpolate_grid), and then linearly between the two grids with the given weight
+    of the second grid.
+    """
+    value_0 = interpolate_grid(
+        dim_x, dim_y, dim_z, points_x, points_y, points_z, values_0, xi_x, xi_y, xi_z
+    )
+    if weight == 0.0:
+        return value_0
+
+    value_1 = interpolate_grid(
+        dim_x, dim_y, dim_z, points_x, points_y, points_z, values_1, xi_x, xi_y, xi_z
+    )
+    return value_0 + (value_1 - value_0) * weight
+
+
+@jit(cache=True)
+def interpolate_grid_many(
+    dim_x: float,
+    dim_y: float,
+    dim_z: float,
+    points_x: np.ndarray,
+    points_y: np.ndarray,
+    points_z: np.ndarray,
+    values: np.ndarray,
+    positions: np.ndarray,
+) -> np.ndarray:
+    """
+    Interpolates a grid of control vectors (see interpolate_grid) at each of the given positions,
+    which is an array of shape (N, 3). Returns an array of the same shape.
+    """
+    result = np.empty((positions.shape[0], 3), dtype=np.float64)
+    for i in range(positions.shape[0]):
+        result[i] = interpolate_grid(
+            dim_x,
+            dim_y,
+            dim_z,
+            points_x,
+            points_y,
+            points_z,
+            values,
+            positions[i, 0],
+            positions[i, 1],
+            positions[i, 2],
+        )
+    return result
+
+
+@jit(cache=True)
+def interpolate_ensemble_grid(
+    dim_x: float,
+    dim_y: float,
+    dim_z: float,
+    points_x: np.ndarray,
+    points_y: np.ndarray,
+    points_z: np.ndarray,
+    values: Tuple[np.ndarray, np.ndarray],
+    xi_x: float,
+    xi_y: float,
+    xi_z: float,
+) -> np.ndarray:
+    """
+    Interpolates a member of an ensemble of grids at the given position like interpolate_grid. The
+    values are a pair of an array of shape (X, Y, Z, M, 3) holding M grids of control vectors, and
+    the weights of the member's M grids. Only the 8 surrounding control vectors of the member are
+    computed from the grids, so the cost barely depends on the number of grids.
+    """
+    components, weights = values
+
+    # Ensure the input is within bounds.
+    xi_x = min(max(xi_x, -dim_x / 2), dim_x / 2)
+    xi_y = min(max(xi_y, -dim_y / 2), dim_y / 2)
+    xi_z = min(max(xi_z, 0), dim_z)
+
+    # Compute the deltas between consecutive grid points.
+    delta_x = points_x[1] - points_x[0]
+    delta_y = points_y[1] - points_y[0]
+    delta_z = points_z[1] - points_z[0]
+
+    # Find the indices based on deltas.
+    i_x = int((xi_x - points_x[0]) / delta_x)
+    i_y = int((xi_y - points_y[0]) / delta_y)
+    i_z = int((xi_z - points_z[0]) / delta_z)
+
+    # Ensure the indices are within bounds.
+    i_x = max(0, min(i_x, points_x.shape[0] - 2))
+    i_y = max(0, min(i_y, points_y.shape[0] - 2))
+    i_z = max(0, min(i_z, points_z.shape[0] - 2))
+
+    # Combine the grids at the 8 surrounding grid points, indexed by their offsets as bits, weighted
+    # by their trilinear coefficients. The sums are kept in scalars, since this runs for every
+    # derivative evaluation.
+    relative_x = (xi_x - points_x[i_x]) / delta_x
+    relative_y = (xi_y - points_y[i_y]) / delta_y
+    relative_z = (xi_z - points_z[i_z]) / delta_z
+    v_x = 0.0
+    v_y = 0.0
+    v_z = 0.0
+    for corner in range(8):
+        offset_x = corner >> 2
+        offset_y = (corner >> 1) & 1
+        offset_z = corner & 1
+        corner_weight = (
+            (relative_x if offset_x else 1.0 - relative_x)
+            * (relative_y if offset_y else 1.0 - relative_y)
+            * (relative_z if offset_z else 1.0 - relative_z)
+        )
+        grids = components[i_x + offset_x, i_y + offset_y, i_z + offset_z]
+        for m in range(weights.shape[0]):
+            weight = corner_weight * weights[m]
+            v_x += weight * grids[m, 0]
+            v_y += weight * grids[m, 1]
+            v_z += weight * grids[m, 2]
+
+    v = np.empty(3, dtype=np.float64)
+    v[0] = v_x
+    v[1] = v_y
+    v[2] = v_z
+    return v
+
+
+def interpolate_values(
+    dim_x: float,
+    dim_y: float,
+    dim_z: float,
+    points_x: np.ndarray,
+    points_y: np.ndarray,
+    points_z: np.ndarray,
+    values: Union[np.ndarray, Tuple[np.ndarray, np.ndarray]],
+    xi_x: float,
+    xi_y: float,
+    xi_z: float,
+) -> np.ndarray:
+    """
+    Interpolates a grid of control vectors at the given position (see interpolate_grid), or a member
+    of an ensemble if the values are a pair of components and weights (see
+    interpolate_ensemble_grid). In compiled code, the function is chosen when compiling, so that
+    compiled functions can call it as a global and be cached on disk for either kind of values.
+    """
+    interpolate = (
+        interpolate_ensemble_grid if isinstance(values, tuple) else interpolate_grid
+    )
+    return interpolate(
+        dim_x, dim_y, dim_z, points_x, points_y, points_z, values, xi_x, xi_y, xi_z
+    )
+
+
+@overload(interpolate_values)
+def overload_interpolate_values(
+    dim_x, dim_y, dim_z, points_x, points_y, points_z, values, xi_x, xi_y, xi_z
+):
+    """
+    Returns the compiled implementation of interpolate_values for the types of the arguments.
+    """
+    interpolate = (
+        interpolate_ensemble_grid
+        if isinstance(values, types.BaseTuple)
+        else interpolate_grid
+    )
+
+    def implementation(
+        dim_x, dim_y, dim_z, points_x, points_y, points_z, values, xi_x, xi_y, xi_z
+    ):
+        return interpolate(
+            dim_x, dim_y, dim_z, points_x, points_y, points_z, values, xi_x, xi_y, xi_z
+        )
+
+    return implementation
+
 
 class UniformField:
     """
@@ -20,6 +485,7 @@ class UniformField:
         Initializes the field with the given vector.
         """
         self.vector = vector
+        self.digest = hashlib.sha256(repr(tuple(vector)).encode()).hexdigest()
 
     def __call__(self, _: Vector3) -> Vector3:
         """
@@ -27,6 +493,27 @@ class UniformField:
         """
         return self.vector
 
+    def __deepcopy__(self, memo: dict) -> "UniformField":
+        """
+        Returns the field itself, since it is immutable.
+        """
+        return self
+
+    def control_grid(
+        self,
+    ) -> Tuple[Vector3, Tuple[np.ndarray, np.ndarray, np.ndarray], np.ndarray]:
+        """
+        Returns an equivalent grid of control vectors which can be passed to interpolate_grid.
+        """
+        control_points = (
+            np.linspace(-1.0, 1.0, 2),
+            np.linspace(-1.0, 1.0, 2),
+            np.linspace(0.0, 2.0, 2),
+        )
+        control_vectors = np.empty((2, 2, 2, 3), dtype=np.float64)
+        control_vectors[...] = self.vector
+        return Vector3(2.0, 2.0, 2.0), control_points, control_vectors
+
 
 class RandomField:
     """
@@ -40,22 +527,50 @@ class RandomField:
         dimensions: Vector3,
         num_dimension_points: Vector3,
         generator: np.random.Generator = np.random.default_rng(),
+        dtype: type = np.float64,
     ):
         """
-        Initializes the field with the given parameters.
+        Initializes the field with the given parameters. The control vectors are stored with the
+        given dtype, which can be np.float32 to halve their memory and bandwidth. They are always
+        drawn in double precision, so a generator gives the same field up to rounding in either
+        precision. The dtype only affects storage: the field is interpolated in double precision,
+        and balloons are always integrated in double precision, since rounding their state to single
+        precision every step makes balloons near neutral buoyancy diverge by kilometers.
+        """
+        self.initialize(
+            dimensions,
+            self.make_control_vectors(
+                magnitude, num_dimension_points, generator
+            ).astype(dtype),
+        )
+
+    @staticmethod
+    def from_control_vectors(
+        dimensions: Vector3, control_vectors: np.ndarray
+    ) -> "RandomField":
+        """
+        Returns the field with the given control vectors, for example as generated by
+        make_control_vectors in another process. The array is used as is rather than copied.
+        """
+        field = RandomField.__new__(RandomField)
+        field.initialize(dimensions, control_vectors)
+        return field
+
+    @staticmethod
+    def make_control_vectors(
+        magnitude: Vector3,
+        num_dimension_points: Vector3,
+        generator: np.random.Generator = np.random.default_rng(),
+    ) -> np.ndarray:
+        """
+        Generates random control vectors for a field with the given parameters. Returns an array of
+        shape (X, Y, Z, 3).
         """
         # Make sure there are at two points in each dimension.
         x_num = int(max(2, num_dimension_points.x))
         y_num = int(max(2, num_dimension_points.y))
         z_num = int(max(2, num_dimension_points.z))
 
-        # Generate control points.
-        control_points = (
-            np.linspace(-dimensions.x / 2, dimensions.x / 2, x_num),
-            np.linspace(-dimensions.y / 2, dimensions.y / 2, y_num),
-            np.linspace(0, dimensions.z, z_num),
-        )
-
         # Generate random control vectors.
         control_vectors = np.array(
             [
@@ -65,76 +580,733 @@ class RandomField:
             ],
             dtype=np.float64,
         )
-        control_vectors = np.moveaxis(control_vectors, 0, -1)
+        return np.moveaxis(control_vectors, 0, -1)
 
-        # Store the compiled interpolation function.
-        self.interpolate = self.make_interpolate_function(
-            dimensions, control_points, control_vectors
+    @staticmethod
+    def make_control_points(
+        dimensions: Vector3, shape: Tuple[int, ...]
+    ) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Returns the control points of a grid of control vectors with the given shape, which are
+        evenly spaced over the given dimensions.
+        """
+        x_num, y_num, z_num = shape[0:3]
+        return (
+            np.linspace(-dimensions.x / 2, dimensions.x / 2, x_num),
+            np.linspace(-dimensions.y / 2, dimensions.y / 2, y_num),
+            np.linspace(0, dimensions.z, z_num),
         )
 
+    def initialize(self, dimensions: Vector3, control_vectors: np.ndarray):
+        """
+        Initializes the field with the given control vectors, which are evenly spaced over the
+        given dimensions.
+        """
+        control_points = self.make_control_points(dimensions, control_vectors.shape)
+
+        # Keep the control grid so that compiled code can interpolate the field directly.
+        self.dimensions = dimensions
+        self.control_points = control_points
+        self.control_vectors = control_vectors
+
+        # Fingerprint the generated field so that results derived from it can be cached.
+        self.digest = self.make_digest(dimensions, control_points, control_vectors)
+
     @staticmethod
-    def make_interpolate_function(
+    def make_digest(
         dimensions: Vector3,
         control_points: Tuple[np.ndarray, np.ndarray, np.ndarray],
         control_vectors: np.ndarray,
-    ):
+    ) -> str:
         """
-        A helper function to create a compiled interpolation function.
-        """
-        # Capture constants in closure.
-        dim_x, dim_y, dim_z = dimensions
-        points_x, points_y, points_z = control_points
-        values = control_vectors
-
-        # Define the function to be compiled.
-        def interpolate(xi_x: float, xi_y: float, xi_z: float) -> np.ndarray:
-            # Ensure the input is within bounds.
-            xi_x = min(max(xi_x, -dim_x / 2), dim_x / 2)
-            xi_y = min(max(xi_y, -dim_y / 2), dim_y / 2)
-            xi_z = min(max(xi_z, 0), dim_z)
-
-            # Compute the deltas between consecutive grid points.
-            delta_x = points_x[1] - points_x[0]
-            delta_y = points_y[1] - points_y[0]
-            delta_z = points_z[1] - points_z[0]
-
-            # Find the indices based on deltas.
-            i_x = int((xi_x - points_x[0]) / delta_x)
-            i_y = int((xi_y - points_y[0]) / delta_y)
-            i_z = int((xi_z - points_z[0]) / delta_z)
-
-            # Ensure the indices are within bounds.
-            i_x = max(0, min(i_x, points_x.shape[0] - 2))
-            i_y = max(0, min(i_y, points_y.shape[0] - 2))
-            i_z = max(0, min(i_z, points_z.shape[0] - 2))
-
-            # Get the values at the 8 surrounding grid points.
-            v_000 = values[i_x, i_y, i_z]
-            v_001 = values[i_x, i_y, i_z + 1]
-            v_010 = values[i_x, i_y + 1, i_z]
-            v_011 = values[i_x, i_y + 1, i_z + 1]
-            v_100 = values[i_x + 1, i_y, i_z]
-            v_101 = values[i_x + 1, i_y, i_z + 1]
-            v_110 = values[i_x + 1, i_y + 1, i_z]
-            v_111 = values[i_x + 1, i_y + 1, i_z + 1]
-
-            # Compute the trilinear interpolation.
-            relative_x = (xi_x - points_x[i_x]) / delta_x
-            relative_y = (xi_y - points_y[i_y]) / delta_y
-            relative_z = (xi_z - points_z[i_z]) / delta_z
-            c_00 = v_000 + (v_100 - v_000) * relative_x
-            c_01 = v_001 + (v_101 - v_001) * relative_x
-            c_10 = v_010 + (v_110 - v_010) * relative_x
-            c_11 = v_011 + (v_111 - v_011) * relative_x
-            c_0 = c_00 + (c_10 - c_00) * relative_y
-            c_1 = c_01 + (c_11 - c_01) * relative_y
-            return c_0 + (c_1 - c_0) * relative_z
-
-        # Return the compiled function.
-        return jit(interpolate)
+        Returns a hash that uniquely identifies the field defined by the given parameters.
+        """
+        digest = hashlib.sha256(repr(tuple(dimensions)).encode())
+        for points in control_points:
+            digest.update(np.ascontiguousarray(points).tobytes())
+        digest.update(np.ascontiguousarray(control_vectors).tobytes())
+        return digest.hexdigest()
+
+    def interpolate(self, xi_x: float, xi_y: float, xi_z: float) -> np.ndarray:
+        """
+        Interpolates the field at the given position, returning an array.
+        """
+        dim_x, dim_y, dim_z = self.dimensions
+        points_x, points_y, points_z = self.control_points
+        return interpolate_grid(
+            dim_x,
+            dim_y,
+            dim_z,
+            points_x,
+            points_y,
+            points_z,
+            self.control_vectors,
+            xi_x,
+            xi_y,
+            xi_z,
+        )
+
+    def interpolate_many(self, positions: np.ndarray) -> np.ndarray:
+        """
+        Interpolates the field at each of the given positions, which is an array of shape (N, 3).
+        Returns an array of the same shape.
+        """
+        dim_x, dim_y, dim_z = self.dimensions
+        points_x, points_y, points_z = self.control_points
+        return interpolate_grid_many(
+            dim_x,
+            dim_y,
+            dim_z,
+            points_x,
+            points_y,
+            points_z,
+            self.control_vectors,
+            positions,
+        )
 
     def __call__(self, position: Vector3) -> Vector3:
         """
         Computes the field at the given position.
         """
         return Vector3(*self.interpolate(*position))
+
+    def __deepcopy__(self, memo: dict) -> "RandomField":
+        """
+        Returns the field itself, since it is immutable. This avoids copying its control vectors.
+        """
+        return self
+
+    def control_grid(
+        self,
+    ) -> Tuple[Vector3, Tuple[np.ndarray, np.ndarray, np.ndarray], np.ndarray]:
+        """
+        Returns the grid of control vectors which can be passed to interpolate_grid.
+        """
+        return self.dimensions, self.control_points, self.control_vectors
+
+
+class TiledField:
+    """
+    A random field like RandomField whose control vectors are stored in a memory-mapped file rather
+    than in memory, for fields which are too large to fit in memory. The horizontal grid is split
+    into square tiles of control points spanning the whole height. Each tile is stored contiguously
+    and overlaps its neighbors by one point, so every cell of the grid lies within a single tile.
+    Tiles are paged in as they are needed, and at most max_tiles of them are kept in memory in
+    least recently used order. Control vectors can be stored as float32 to halve the size of the
+    file, and are always interpolated in float64.
+    """
+
+    # Names of the files of a saved field within its directory.
+    metadata_filename = "field.json"
+    tiles_filename = "tiles.npy"
+
+    def __init__(self, directory: str, max_tiles: int = 16):
+        """
+        Opens the field saved in the given directory (see generate and save).
+        """
+        with open(os.path.join(directory, self.metadata_filename)) as f:
+            metadata = json.load(f)
+
+        self.directory = directory
+        self.max_tiles = max_tiles
+        self.dimensions = Vector3(*metadata["dimensions"])
+        self.shape: Tuple[int, int, int] = tuple(metadata["shape"])
+        self.tile_size: int = metadata["tile_size"]
+        self.digest: str = metadata["digest"]
+        self.control_points = RandomField.make_control_points(
+            self.dimensions, self.shape
+        )
+        self.tiles: np.ndarray = np.load(
+            os.path.join(directory, self.tiles_filename), mmap_mode="r"
+        )
+
+        # The resident tiles, keyed by their index.
+        self.resident: OrderedDict[
+            Tuple[int, int], Tuple[np.ndarray, np.ndarray, np.ndarray]
+        ] = OrderedDict()
+
+    @staticmethod
+    def generate(
+        directory: str,
+        magnitude: Vector3,
+        dimensions: Vector3,
+        num_dimension_points: Vector3,
+        generator: np.random.Generator = np.random.default_rng(),
+        tile_size: int = 64,
+        dtype: np.dtype = np.float64,
+        max_tiles: int = 16,
+    ) -> "TiledField":
+        """
+        Generates a random field with the given parameters like RandomField, saves it to the given
+        directory, and opens it. The control vectors are drawn one plane of constant x at a time,
+        so the field only depends on the generator's state and not on the tile size or data type,
+        and only one plane is ever held in memory. The digest does depend on the data type, since
+        float32 rounds the control vectors.
+        """
+        shape = (
+            int(max(2, num_dimension_points.x)),
+            int(max(2, num_dimension_points.y)),
+            int(max(2, num_dimension_points.z)),
+        )
+        digest = hashlib.sha256(
+            repr(
+                (
+                    tuple(magnitude),
+                    tuple(dimensions),
+                    shape,
+                    generator.bit_generator.state,
+                    np.dtype(dtype).str,
+                )
+            ).encode()
+        ).hexdigest()
+
+        low = -np.array(magnitude, dtype=np.float64)
+        planes = (
+            generator.uniform(low, -low, (shape[1], shape[2], 3))
+            for _ in range(shape[0])
+        )
+        TiledField.write(directory, dimensions, shape, planes, tile_size, dtype, digest)
+        return TiledField(directory, max_tiles)
+
+    @staticmethod
+    def save(
+        directory: str,
+        field: RandomField,
+        tile_size: int = 64,
+        dtype: np.dtype = np.float64,
+        max_tiles: int = 16,
+    ) -> "TiledField":
+        """
+        Saves the given field to the given directory and opens it as a tiled field. It keeps the
+        field's digest unless the control vectors are rounded to the given data type.
+        """
+        digest = field.digest
+        if not np.can_cast(field.control_vectors.dtype, dtype):
+            digest = hashlib.sha256(
+                repr((digest, np.dtype(dtype).str)).encode()
+            ).hexdigest()
+
+        TiledField.write(
+            directory,
+            field.dimensions,
+            field.control_vectors.shape[0:3],
+            iter(field.control_vectors),
+            tile_size,
+            dtype,
+            digest,
+        )
+        return TiledField(directory, max_tiles)
+
+    @staticmethod
+    def write(
+        directory: str,
+        dimensions: Vector3,
+        shape: Tuple[int, int, int],
+        planes: Iterator[np.ndarray],
+        tile_size: int,
+        dtype: np.dtype,
+        digest: str,
+    ):
+        """
+        Writes a field to the given directory, given its planes of control vectors of shape (Y, Z, 3)
+        in order of increasing x. The tiles are stored as an array of shape
+        (tiles x, tiles y, tile size + 1, tile size + 1, Z, 3), where tiles at the upper bounds of
+        the grid are only partially used.
+        """
+        x_num, y_num, z_num = shape
+        num_tiles_x = -(-(x_num - 1) // tile_size)
+        num_tiles_y = -(-(y_num - 1) // tile_size)
+
+        os.makedirs(directory, exist_ok=True)
+        tiles = np.lib.format.open_memmap(
+            os.path.join(directory, TiledField.tiles_filename),
+            mode="w+",
+            dtype=dtype,
+            shape=(
+                num_tiles_x,
+                num_tiles_y,
+                tile_size + 1,
+                tile_size + 1,
+                z_num,
+                3,
+            ),
+        )
+        for i, plane in enumerate(planes):
+            # A plane on a tile boundary belongs to the tiles on both sides of it.
+            for tile_x in {i // tile_size, (i - 1) // tile_size}:
+                if not 0 <= tile_x < num_tiles_x:
+                    continue
+                for tile_y in range(num_tiles_y):
+                    start = tile_y * tile_size
+                    end = min(start + tile_size + 1, y_num)
+                    local_x = i - tile_x * tile_size
+                    tiles[tile_x, tile_y, local_x, : end - start] = plane[start:end]
+        tiles.flush()
+        del tiles
+
+        with open(os.path.join(directory, TiledField.metadata_filename), "w") as f:
+            json.dump(
+                {
+                    "dimensions": list(dimensions),
+                    "shape": list(shape),
+                    "tile_size": tile_size,
+                    "digest": digest,
+                },
+                f,
+            )
+
+    def get_tile(
+        self, tile_x: int, tile_y: int
+    ) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Returns the control points in x and y and the control vectors of the given tile, paging it
+        in if needed.
+        """
+        key = (tile_x, tile_y)
+        tile = self.resident.get(key)
+        if tile is not None:
+            self.resident.move_to_end(key)
+            return tile
+
+        start_x = tile_x * self.tile_size
+        start_y = tile_y * self.tile_size
+        end_x = min(start_x + self.tile_size + 1, self.shape[0])
+        end_y = min(start_y + self.tile_size + 1, self.shape[1])
+        tile = (
+            self.control_points[0][start_x:end_x],
+            self.control_points[1][start_y:end_y],
+            np.array(
+                self.tiles[tile_x, tile_y, : end_x - start_x, : end_y - start_y],
+                dtype=np.float64,
+            ),
+        )
+
+        self.resident[key] = tile
+        if len(self.resident) > self.max_tiles:
+            self.resident.popitem(last=False)
+        return tile
+
+    def get_tile_index(self, xi: float, axis: int) -> int:
+        """
+        Returns the index along the given horizontal axis of the tile containing the given
+        coordinate.
+        """
+        # Find the cell like interpolate_grid, which also clamps to the bounds.
+        points = self.control_points[axis]
+        xi = min(max(xi, points[0]), points[-1])
+        cell = int((xi - points[0]) / (points[1] - points[0]))
+        return max(0, min(cell, len(points) - 2)) // self.tile_size
+
+    def get_tile_indices(
+        self, x: np.ndarray, y: np.ndarray
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Returns the indices of the tiles containing the given horizontal positions, like
+        get_tile_index.
+        """
+        indices = []
+        for xi, points in zip((x, y), self.control_points[0:2]):
+            xi = np.clip(xi, points[0], points[-1])
+            cell = ((xi - points[0]) / (points[1] - points[0])).astype(np.int64)
+            indices.append(np.clip(cell, 0, len(points) - 2) // self.tile_size)
+        return indices[0], indices[1]
+
+    def __call__(self, position: Vector3) -> Vector3:
+        """
+        Computes the field at the given position.
+        """
+        points_x, points_y, values = self.get_tile(
+            self.get_tile_index(position.x, 0), self.get_tile_index(position.y, 1)
+        )
+        return Vector3(
+            *interpolate_grid(
+                *self.dimensions,
+                points_x,
+                points_y,
+                self.control_points[2],
+                values,
+                *position,
+            )
+        )
+
+    def interpolate_many(self, positions: np.ndarray) -> np.ndarray:
+        """
+        Computes the field at each of the given positions, which is an array of shape (N, 3). The
+        positions are grouped by tile, so each tile is paged in at most once.
+        """
+        tile_x, tile_y = self.get_tile_indices(positions[:, 0], positions[:, 1])
+        keys = tile_x * (len(self.control_points[1]) + 1) + tile_y
+        values = np.empty((positions.shape[0], 3), dtype=np.float64)
+        for key in np.unique(keys):
+            (indices,) = np.nonzero(keys == key)
+            points_x, points_y, tile = self.get_tile(
+                int(tile_x[indices[0]]), int(tile_y[indices[0]])
+            )
+            values[indices] = interpolate_grid_many(
+                *self.dimensions,
+                points_x,
+                points_y,
+                self.control_points[2],
+                tile,
+                np.ascontiguousarray(positions[indices], dtype=np.float64),
+            )
+        return values
+
+    def __getstate__(self) -> dict:
+        """
+        Returns the state to pickle. The file is memory-mapped again when unpickling rather than
+        pickling its contents.
+        """
+        return {"directory": self.directory, "max_tiles": self.max_tiles}
+
+    def __setstate__(self, state: dict):
+        """
+        Restores the pickled state and memory-maps the file.
+        """
+        self.__init__(state["directory"], state["max_tiles"])
+
+    def __deepcopy__(self, memo: dict) -> "TiledField":
+        """
+        Returns the field itself, since it is immutable. Copies of the field's users share the
+        resident tiles.
+        """
+        return self
+
+
+class EnsembleField:
+    """
+    An ensemble of perturbed versions of one field, such as the members of a forecast ensemble.
+    The grids of control vectors of the members are stored compactly as a base grid plus low-rank
+    deltas: member k is the base grid plus the sum of R mode grids weighted by the member's
+    coefficients. All members share the grids and one compiled interpolation function (see
+    interpolate_ensemble_grid), so thousands of members take little more memory than one field.
+    """
+
+    def __init__(
+        self,
+        dimensions: Vector3,
+        base: np.ndarray,
+        modes: np.ndarray,
+        coefficients: np.ndarray,
+        dtype: type = np.float64,
+    ):
+        """
+        Initializes the ensemble with a base grid of shape (X, Y, Z, 3), R mode grids of shape
+        (R, X, Y, Z, 3), and the coefficients of the modes of each of the K members of shape (K, R).
+        The grids are stored with the given dtype (see RandomField).
+        """
+        if modes.shape[1:] != base.shape or coefficients.shape[1] != modes.shape[0]:
+            raise ValueError("Modes and coefficients do not match the base grid")
+
+        self.dimensions = dimensions
+        self.control_points = RandomField.make_control_points(dimensions, base.shape)
+
+        # Interleave the grids, so that the control vectors of all grids at a control point are
+        # interpolated together.
+        self.components = np.ascontiguousarray(
+            np.stack([base, *modes], axis=3), dtype=dtype
+        )
+        self.weights = np.empty(
+            (coefficients.shape[0], modes.shape[0] + 1), dtype=np.float64
+        )
+        self.weights[:, 0] = 1.0
+        self.weights[:, 1:] = coefficients
+
+        self.digest = hashlib.sha256(
+            (
+                RandomField.make_digest(
+                    dimensions, self.control_points, self.components
+                )
+                + hashlib.sha256(self.weights.tobytes()).hexdigest()
+            ).encode()
+        ).hexdigest()
+
+    @staticmethod
+    def perturb(
+        field: RandomField,
+        num_members: int,
+        num_modes: int,
+        magnitude: Vector3,
+        generator: np.random.Generator = np.random.default_rng(),
+        dtype: type = np.float64,
+    ) -> "EnsembleField":
+        """
+        Returns an ensemble of random perturbations of the given field. The modes are random grids
+        like those of RandomField with the given magnitude, and the coefficients of each member are
+        normally distributed with a variance of 1 / num_modes, so the perturbations have the
+        spread of a single mode whatever their number.
+        """
+        modes = np.stack(
+            [
+                RandomField.make_control_vectors(
+                    magnitude, Vector3(*field.control_vectors.shape[0:3]), generator
+                )
+                for _ in range(num_modes)
+            ]
+        )
+        coefficients = generator.normal(
+            0.0, 1.0 / np.sqrt(num_modes), (num_members, num_modes)
+        )
+        return EnsembleField(
+            field.dimensions, field.control_vectors, modes, coefficients, dtype
+        )
+
+    def __len__(self) -> int:
+        return self.weights.shape[0]
+
+    def __deepcopy__(self, memo: dict) -> "EnsembleField":
+        """
+        Returns the ensemble itself, since it is immutable.
+        """
+        return self
+
+    def member(self, index: int) -> "EnsembleMember":
+        """
+        Returns the field of the member with the given index.
+        """
+        return EnsembleMember(self, index)
+
+    def component_grid(
+        self,
+    ) -> Tuple[Vector3, Tuple[np.ndarray, np.ndarray, np.ndarray], np.ndarray]:
+        """
+        Returns the grid of the ensemble, whose values are the interleaved grids of shape
+        (X, Y, Z, R + 1, 3) which can be passed to interpolate_ensemble_grid along with the weights
+        of a member.
+        """
+        return self.dimensions, self.control_points, self.components
+
+
+class EnsembleMember:
+    """
+    A member of an ensemble field. Interpolating the member costs about as much as interpolating a
+    RandomField, and no memory or compiled code is added per member.
+    """
+
+    def __init__(self, ensemble: EnsembleField, index: int):
+        """
+        Initializes the member with the given index of the given ensemble.
+        """
+        self.ensemble = ensemble
+        self.index = index
+        self.values = (ensemble.components, ensemble.weights[index])
+        self.digest = hashlib.sha256(
+            repr((ensemble.digest, index)).encode()
+        ).hexdigest()
+
+    def __call__(self, position: Vector3) -> Vector3:
+        """
+        Computes the field at the given position.
+        """
+        return Vector3(
+            *interpolate_ensemble_grid(
+                *self.ensemble.dimensions,
+                *self.ensemble.control_points,
+                self.values,
+                *position,
+            )
+        )
+
+    def __deepcopy__(self, memo: dict) -> "EnsembleMember":
+        """
+        Returns the member itself, since it is immutable.
+        """
+        return self
+
+    def control_grid(
+        self,
+    ) -> Tuple[Vector3, Tuple[np.ndarray, np.ndarray, np.ndarray], np.ndarray]:
+        """
+        Returns an equivalent grid of control vectors which can be passed to interpolate_grid. The
+        grid is computed from the base grid and the modes when called.
+        """
+        control_vectors = np.einsum("xyzmc,m->xyzc", *self.values)
+        return self.ensemble.dimensions, self.ensemble.control_points, control_vectors
+
+
+class SliceDirectory:
+    """
+    A sequence of time slices stored as .npy files in a directory. Each file holds one grid of
+    control vectors of shape (X, Y, Z, 3) and is named after its time in seconds, such as 3600.npy.
+    Slices are read from disk whenever they are indexed.
+    """
+
+    def __init__(self, directory: str):
+        """
+        Finds the slices in the given directory, sorted by time.
+        """
+        slices = sorted(
+            (float(name[: -len(".npy")]), os.path.join(directory, name))
+            for name in os.listdir(directory)
+            if name.endswith(".npy")
+        )
+        self.times: np.ndarray = np.array([time for time, _ in slices])
+        self.filenames: List[str] = [filename for _, filename in slices]
+
+    def __len__(self) -> int:
+        return len(self.filenames)
+
+    def __getitem__(self, index: int) -> np.ndarray:
+        """
+        Loads the slice with the given index.
+        """
+        return np.load(self.filenames[index])
+
+
+class SliceFile:
+    """
+    A sequence of time slices stored in one .npy file as an array of shape (T, X, Y, Z, 3). The file
+    is memory-mapped rather than read, so only the slices which are indexed are read from disk.
+    """
+
+    def __init__(self, filename: str):
+        """
+        Memory-maps the given file.
+        """
+        self.filename = filename
+        self.array: np.ndarray = np.load(filename, mmap_mode="r")
+
+    def __len__(self) -> int:
+        return self.array.shape[0]
+
+    def __getitem__(self, index: int) -> np.ndarray:
+        """
+        Returns the slice with the given index, which is read from disk when accessed.
+        """
+        return self.array[index]
+
+    def __getstate__(self) -> dict:
+        """
+        Returns the state to pickle. The file is memory-mapped again when unpickling rather than
+        pickling its contents.
+        """
+        return {"filename": self.filename}
+
+    def __setstate__(self, state: dict):
+        """
+        Restores the pickled state and memory-maps the file.
+        """
+        self.__init__(state["filename"])
+
+
+class TimeVaryingField:
+    """
+    A field that varies in time, given by time slices of control vectors over the same grid, such
+    as hourly forecasts. The field is interpolated in space within the slices like RandomField, and
+    linearly in time between the two slices that bracket the time. It is held constant before the
+    first and after the last slice. Slices are loaded lazily, and only the two bracketing slices are
+    kept in memory, so memory stays flat however long the simulation runs.
+    """
+
+    def __init__(
+        self, dimensions: Vector3, times: np.ndarray, slices: Sequence[np.ndarray]
+    ):
+        """
+        Initializes the field with the given times in seconds and a sequence of slices of shape
+        (X, Y, Z, 3), which is only indexed when a slice is needed. The sequence can be an array of
+        shape (T, X, Y, Z, 3), a SliceFile, or a SliceDirectory.
+        """
+        times = np.asarray(times, dtype=np.float64)
+        if len(times) == 0 or len(times) != len(slices):
+            raise ValueError("Expected one time for each of at least one slice")
+        if np.any(np.diff(times) <= 0.0):
+            raise ValueError("Slice times must be strictly increasing")
+
+        self.dimensions = dimensions
+        self.times = times
+        self.slices = slices
+        self.control_points = RandomField.make_control_points(
+            dimensions, self.load_slice(0).shape
+        )
+
+        # The resident slices, keyed by their index.
+        self.resident: Dict[int, np.ndarray] = {}
+
+    @staticmethod
+    def from_directory(dimensions: Vector3, directory: str) -> "TimeVaryingField":
+        """
+        Returns the field with the slices stored in the given directory (see SliceDirectory).
+        """
+        slices = SliceDirectory(directory)
+        return TimeVaryingField(dimensions, slices.times, slices)
+
+    @staticmethod
+    def from_file(
+        dimensions: Vector3, times: np.ndarray, filename: str
+    ) -> "TimeVaryingField":
+        """
+        Returns the field with the slices stored in the given file (see SliceFile).
+        """
+        return TimeVaryingField(dimensions, times, SliceFile(filename))
+
+    def load_slice(self, index: int) -> np.ndarray:
+        """
+        Reads the slice with the given index into memory.
+        """
+        return np.array(self.slices[index], dtype=np.float64)
+
+    def get_slices(self, time: float) -> Tuple[np.ndarray, np.ndarray, float]:
+        """
+        Returns the two slices bracketing the given time in seconds and the weight of the second
+        slice, loading them if needed. Slices which no longer bracket the time are released.
+        """
+        index = int(np.searchsorted(self.times, time, side="right")) - 1
+        if index < 0:
+            index, weight = 0, 0.0
+        elif index >= len(self.times) - 1:
+            index, weight = len(self.times) - 1, 0.0
+        else:
+            weight = (time - self.times[index]) / (
+                self.times[index + 1] - self.times[index]
+            )
+
+        indices = (index, min(index + 1, len(self.times) - 1))
+        for i in list(self.resident):
+            if i not in indices:
+                del self.resident[i]
+        for i in indices:
+            if i not in self.resident:
+                self.resident[i] = self.load_slice(i)
+
+        return self.resident[indices[0]], self.resident[indices[1]], weight
+
+    def __call__(self, position: Vector3, time: float) -> Vector3:
+        """
+        Computes the field at the given position and time in seconds.
+        """
+        values_0, values_1, weight = self.get_slices(time)
+        return Vector3(
+            *interpolate_grid_in_time(
+                *self.dimensions,
+                *self.control_points,
+                values_0,
+                values_1,
+                weight,
+                *position,
+            )
+        )
+
+    def at(self, time: float) -> RandomField:
+        """
+        Returns the static field at the given time in seconds, for example for controllers which
+        plan in a static field.
+        """
+        values_0, values_1, weight = self.get_slices(time)
+        return RandomField.from_control_vectors(
+            self.dimensions, values_0 + (values_1 - values_0) * weight
+        )
+
+    def __getstate__(self) -> dict:
+        """
+        Returns the state to pickle. Resident slices are not pickled since they can be reloaded.
+        """
+        state = self.__dict__.copy()
+        state["resident"] = {}
+        return state
+
+    def __deepcopy__(self, memo: dict) -> "TimeVaryingField":
+        """
+        Returns the field itself. Copies of the field's users share it, since the resident slices
+        only cache the slices.
+        """
+        return self
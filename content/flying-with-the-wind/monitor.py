@@ -1,52 +1,172 @@
 import copy
-from typing import List, Union, cast, Tuple
+import os
+import shutil
+import subprocess
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from typing import IO, TYPE_CHECKING, Deque, List, Union, cast, Tuple
 
-import matplotlib.pyplot as plt
 import numpy as np
 from balloon import Balloon
-from matplotlib.animation import FuncAnimation
-from mpl_toolkits.mplot3d import Axes3D
-from vector import Vector3
+
+if TYPE_CHECKING:
+    from matplotlib.figure import Figure
+    from matplotlib.text import Text
+    from mpl_toolkits.mplot3d import Axes3D
+    from mpl_toolkits.mplot3d.art3d import Line3D
 
 
 class Monitor:
     """
-    Represents a monitor for a balloon.
+    Represents a monitor for a balloon. States are stored as rows of a preallocated array that grows
+    as needed. The columns are time, position (3), velocity (3), temperature, fuel, and vent, all in
+    the units returned by the balloon's getters. States can be stored in single precision to halve
+    the memory of long trajectories. Matplotlib is only imported when plotting, since it is slow to
+    import and simulations rarely plot.
     """
 
-    def __init__(self):
+    # Number of columns in a state row.
+    num_columns = 10
+
+    def __init__(self, capacity: int = 1024, dtype: type = np.float64):
         """
-        Initializes the monitor with an empty state.
+        Initializes the monitor with an empty state, stored with the given dtype.
         """
-        self.time: List[float] = []
-        self.position: List[Vector3] = []
-        self.velocity: List[Vector3] = []
-        self.temperature: List[float] = []
-        self.fuel: List[float] = []
-        self.vent: List[float] = []
+        self.states: np.ndarray = np.empty(
+            (max(1, capacity), self.num_columns), dtype=dtype
+        )
+        self.size: int = 0
+
+    @staticmethod
+    def from_arrays(
+        time: np.ndarray,
+        position: np.ndarray,
+        velocity: np.ndarray,
+        temperature: np.ndarray,
+        fuel: np.ndarray,
+        vent: np.ndarray,
+        dtype: type = np.float64,
+    ) -> "Monitor":
+        """
+        Returns a monitor containing the given states, stored with the given dtype.
+        """
+        monitor = Monitor(len(time), dtype)
+        monitor.extend(
+            np.column_stack((time, position, velocity, temperature, fuel, vent))
+        )
+        return monitor
+
+    def __getstate__(self) -> dict:
+        """
+        Returns the state to pickle. Unused capacity is not pickled.
+        """
+        return {"states": self.states[: self.size].copy(), "size": self.size}
+
+    @property
+    def time(self) -> np.ndarray:
+        """
+        Returns the recorded times in seconds.
+        """
+        return self.states[: self.size, 0]
+
+    @property
+    def position(self) -> np.ndarray:
+        """
+        Returns the recorded positions in meters as an array of shape (N, 3).
+        """
+        return self.states[: self.size, 1:4]
+
+    @property
+    def velocity(self) -> np.ndarray:
+        """
+        Returns the recorded velocities in meters per second as an array of shape (N, 3).
+        """
+        return self.states[: self.size, 4:7]
+
+    @property
+    def temperature(self) -> np.ndarray:
+        """
+        Returns the recorded temperatures in kelvin.
+        """
+        return self.states[: self.size, 7]
+
+    @property
+    def fuel(self) -> np.ndarray:
+        """
+        Returns the recorded fuel percentages.
+        """
+        return self.states[: self.size, 8]
+
+    @property
+    def vent(self) -> np.ndarray:
+        """
+        Returns the recorded vent percentages.
+        """
+        return self.states[: self.size, 9]
+
+    def reserve(self, capacity: int):
+        """
+        Grows the underlying array so that it can hold at least the given number of states.
+        """
+        if capacity <= self.states.shape[0]:
+            return
+        states = np.empty(
+            (max(capacity, 2 * self.states.shape[0]), self.num_columns),
+            dtype=self.states.dtype,
+        )
+        states[: self.size] = self.states[: self.size]
+        self.states = states
 
     def update(self, balloon: Balloon):
         """
         Updates the monitor's internal state. This should be called for every simulation step after
         the balloon's state has been updated.
         """
-        self.time.append(balloon.get_time())
-        self.position.append(balloon.get_position())
-        self.velocity.append(balloon.get_velocity())
-        self.temperature.append(balloon.get_temperature())
-        self.fuel.append(balloon.get_fuel())
-        self.vent.append(balloon.get_vent())
+        self.reserve(self.size + 1)
+        row = self.states[self.size]
+        row[0] = balloon.get_time()
+        row[1:4] = balloon.get_position()
+        row[4:7] = balloon.get_velocity()
+        row[7] = balloon.get_temperature()
+        row[8] = balloon.get_fuel()
+        row[9] = balloon.get_vent()
+        self.size += 1
+
+    def update_many(self, balloon: Balloon, time: np.ndarray, x: np.ndarray):
+        """
+        Updates the monitor's internal state with several steps at once, given the dimensionless
+        times and states returned by Balloon.step_many. The balloon's fuel and vent are recorded for
+        every step.
+        """
+        states = np.empty((len(time), self.num_columns), dtype=self.states.dtype)
+        states[:, 0] = time * balloon.k_ratio_time
+        states[:, 1:4] = x[:, 0:3] * balloon.k_ratio_distance
+        states[:, 4:7] = x[:, 3:6] * (balloon.k_ratio_distance / balloon.k_ratio_time)
+        states[:, 7] = x[:, 6] * balloon.k_ratio_temperature
+        states[:, 8] = balloon.get_fuel()
+        states[:, 9] = balloon.get_vent()
+        self.extend(states)
+
+    def extend(self, states: np.ndarray):
+        """
+        Appends the given state rows, which must have the same layout as the monitor's states.
+        """
+        self.reserve(self.size + len(states))
+        self.states[self.size : self.size + len(states)] = states
+        self.size += len(states)
 
     def plot_state(self, filename: Union[str, None] = None):
         """
         Plots the balloon's state over time. If a filename is provided, the plot will be saved to
         that file. Otherwise, it will be shown.
         """
+        import matplotlib.pyplot as plt
+
         _, axs = plt.subplots(5, 1, sharex=True)
-        axs[0].plot(self.time, [p.z for p in self.position])
+        axs[0].plot(self.time, self.position[:, 2])
         axs[0].set_ylabel("Height (m)")
         axs[0].grid(True)
-        axs[1].plot(self.time, [v.z for v in self.velocity])
+        axs[1].plot(self.time, self.velocity[:, 2])
         axs[1].set_ylabel("Velocity (m/s)")
         axs[1].grid(True)
         axs[2].plot(self.time, self.temperature)
@@ -69,12 +189,14 @@ class Monitor:
         """
         Plots the balloon's trajectory over time, using color as time.
         """
+        import matplotlib.pyplot as plt
+
         points = np.array(self.position)
         time = np.array(self.time)
         x_bounds, y_bounds, z_bounds = self.get_square_bounds()
 
         fig = plt.figure()
-        ax: Axes3D = cast(Axes3D, fig.add_subplot(projection="3d"))
+        ax: "Axes3D" = cast("Axes3D", fig.add_subplot(projection="3d"))
         ax.scatter(
             points[:, 0],
             points[:, 1],
@@ -96,27 +218,31 @@ class Monitor:
         else:
             plt.show()
 
-    def animate_trajectory(self, duration: float, filename: Union[str, None] = None):
+    def animate_trajectory(
+        self,
+        duration: float,
+        filename: Union[str, None] = None,
+        fps: float = 30.0,
+        max_points_per_frame: int = 2000,
+        processes: Union[int, None] = None,
+    ):
         """
-        Animates the balloon's trajectory over time. The duration is in seconds.
+        Animates the balloon's trajectory over time. The duration is in seconds. If a filename is
+        provided, the animation is exported to that file at the given frame rate (see
+        export_animation). Otherwise, it will be shown.
         """
-        points = np.array(self.position)
-        x_bounds, y_bounds, z_bounds = self.get_square_bounds()
+        if filename:
+            self.export_animation(
+                duration, filename, fps, max_points_per_frame, processes
+            )
+            return
 
-        fig = plt.figure()
-        ax: Axes3D = cast(Axes3D, fig.add_subplot(projection="3d"))
-        (line,) = ax.plot([], [], [])
-        ax.set_xlabel("x (m)")
-        ax.set_ylabel("y (m)")
-        ax.set_zlabel("z (m)")
-        ax.set_xlim3d(*x_bounds)
-        ax.set_ylim3d(*y_bounds)
-        ax.set_zlim3d(*z_bounds)
-        ax.set_aspect("equal")
+        import matplotlib.pyplot as plt
+        from matplotlib.animation import FuncAnimation
 
-        counter = ax.text2D(
-            0.01, 0.99, "", transform=ax.transAxes, fontsize=16, ha="left", va="top"
-        )
+        points = np.array(self.position)
+        fig = plt.figure()
+        _, line, counter = self.make_trajectory_axes(fig, self.get_square_bounds())
 
         def update(num, line, points):
             line.set_data(points[:num, 0], points[:num, 1])
@@ -125,14 +251,180 @@ class Monitor:
             return (line, counter)
 
         interval = int(1000 * duration / len(points))
+        # Keep a reference to the animation while it is shown, or it would be garbage collected.
         ani = FuncAnimation(
             fig, update, len(points), fargs=(line, points), interval=interval, blit=True
         )
+        plt.show()
 
-        if filename:
-            ani.save(filename, writer="ffmpeg")
-        else:
-            plt.show()
+    def export_animation(
+        self,
+        duration: float,
+        filename: str,
+        fps: float = 30.0,
+        max_points_per_frame: int = 2000,
+        processes: Union[int, None] = None,
+    ):
+        """
+        Exports the animation of the balloon's trajectory to the given file with ffmpeg. The frames
+        are split into chunks which are rendered offscreen with Agg by the given number of worker
+        processes, which defaults to the number of CPUs. The raw frames are streamed to ffmpeg in
+        order as the chunks complete, with a bounded number of chunks in flight. Each frame draws
+        the trajectory up to its time decimated to at most max_points_per_frame points, so that the
+        cost of a frame does not grow with the length of the trajectory.
+        """
+        import matplotlib
+        from matplotlib.backends.backend_agg import FigureCanvasAgg
+        from matplotlib.figure import Figure
+
+        ffmpeg = shutil.which(matplotlib.rcParams["animation.ffmpeg_path"])
+        if ffmpeg is None:
+            raise RuntimeError("ffmpeg is required to export animations")
+
+        # Each frame shows the states recorded up to its time.
+        num_frames = max(1, round(duration * fps))
+        ends = np.linspace(1, self.size, num_frames).round().astype(np.int64)
+        bounds = self.get_square_bounds()
+
+        # The workers render figures of the same size as the default figure.
+        figsize = tuple(matplotlib.rcParams["figure.figsize"])
+        dpi = matplotlib.rcParams["figure.dpi"]
+        width, height = FigureCanvasAgg(Figure(figsize, dpi)).get_width_height()
+
+        # Split the frames into chunks small enough to balance the workers and bound the memory of
+        # the chunks in flight, but large enough to amortize setting up a figure.
+        num_processes = processes or os.cpu_count() or 1
+        chunk_size = int(np.clip(np.ceil(num_frames / (4 * num_processes)), 1, 16))
+
+        # Decimate the frames here so that only the points to draw are sent to the workers. The
+        # tasks are generated as they are submitted, so only the chunks in flight are held.
+        tasks = (
+            (
+                [
+                    (
+                        self.get_frame_points(end, max_points_per_frame),
+                        float(self.time[end - 1]),
+                    )
+                    for end in chunk
+                ],
+                bounds,
+                figsize,
+                dpi,
+            )
+            for chunk in np.split(ends, np.arange(chunk_size, num_frames, chunk_size))
+        )
+
+        command = [
+            ffmpeg,
+            "-y",
+            "-loglevel",
+            "error",
+            "-f",
+            "rawvideo",
+            "-pix_fmt",
+            "rgba",
+            "-s",
+            f"{width}x{height}",
+            "-r",
+            str(fps),
+            "-i",
+            "-",
+            # Most codecs need even dimensions for yuv420p.
+            "-vf",
+            "pad=ceil(iw/2)*2:ceil(ih/2)*2",
+            "-pix_fmt",
+            "yuv420p",
+            filename,
+        ]
+        # Workers forked after ffmpeg is started inherit its input, so they must exit before the
+        # input is closed for ffmpeg to see the end of the stream.
+        encoder = subprocess.Popen(command, stdin=subprocess.PIPE)
+        try:
+            with encoder:
+                stdin = cast(IO[bytes], encoder.stdin)
+                with ProcessPoolExecutor(num_processes) as executor:
+                    pending: Deque[Future] = deque()
+                    for task in tasks:
+                        pending.append(executor.submit(Monitor.render_frames, task))
+                        # Write the oldest chunk once enough chunks are in flight.
+                        if len(pending) >= 2 * num_processes:
+                            stdin.write(pending.popleft().result())
+                    while pending:
+                        stdin.write(pending.popleft().result())
+        except BrokenPipeError:
+            # ffmpeg exited early after reporting why, so only its exit code is needed.
+            encoder.wait()
+
+        if encoder.returncode != 0:
+            raise RuntimeError(f"ffmpeg exited with code {encoder.returncode}")
+
+    def get_frame_points(self, end: int, max_points: int) -> np.ndarray:
+        """
+        Returns the positions drawn by a frame of an animation showing the first end states,
+        decimated to at most max_points points. The points are taken from the start so that they
+        stay put between frames, and the last state is always drawn.
+        """
+        stride = -(-end // max_points)
+        points = self.position[:end:stride]
+        if (end - 1) % stride:
+            points = np.concatenate((points, self.position[end - 1 : end]))
+        return points
+
+    @staticmethod
+    def render_frames(
+        task: Tuple[
+            List[Tuple[np.ndarray, float]],
+            Tuple[Tuple[float, float], Tuple[float, float], Tuple[float, float]],
+            Tuple[float, float],
+            float,
+        ],
+    ) -> bytes:
+        """
+        Renders a chunk of frames of an animation offscreen, given the points and time of each frame
+        (see get_frame_points), the bounds, and the figure size and resolution. Returns the
+        concatenated RGBA pixels of the frames.
+        """
+        from matplotlib.backends.backend_agg import FigureCanvasAgg
+        from matplotlib.figure import Figure
+
+        frames, bounds, figsize, dpi = task
+        fig = Figure(figsize, dpi)
+        canvas = FigureCanvasAgg(fig)
+        _, line, counter = Monitor.make_trajectory_axes(fig, bounds)
+
+        pixels = []
+        for points, time in frames:
+            line.set_data(points[:, 0], points[:, 1])
+            line.set_3d_properties(points[:, 2])
+            counter.set_text(f"Time: {(time / 60):.2f} minutes")
+            canvas.draw()
+            pixels.append(bytes(canvas.buffer_rgba()))
+        return b"".join(pixels)
+
+    @staticmethod
+    def make_trajectory_axes(
+        fig: "Figure",
+        bounds: Tuple[Tuple[float, float], Tuple[float, float], Tuple[float, float]],
+    ) -> Tuple["Axes3D", "Line3D", "Text"]:
+        """
+        Adds the 3D axes of a trajectory animation with the given bounds to the figure. Returns the
+        axes, the line of the trajectory, and the text of the time counter.
+        """
+        x_bounds, y_bounds, z_bounds = bounds
+        ax: "Axes3D" = cast("Axes3D", fig.add_subplot(projection="3d"))
+        (line,) = ax.plot([], [], [])
+        ax.set_xlabel("x (m)")
+        ax.set_ylabel("y (m)")
+        ax.set_zlabel("z (m)")
+        ax.set_xlim3d(*x_bounds)
+        ax.set_ylim3d(*y_bounds)
+        ax.set_zlim3d(*z_bounds)
+        ax.set_aspect("equal")
+
+        counter = ax.text2D(
+            0.01, 0.99, "", transform=ax.transAxes, fontsize=16, ha="left", va="top"
+        )
+        return ax, cast("Line3D", line), counter
 
     def get_square_bounds(
         self,
@@ -156,30 +448,14 @@ class Monitor:
         if len(self.time) <= max_points:
             return copy.deepcopy(self)
 
-        np_time = np.array(self.time)
-        np_position = np.array(self.position)
-        np_velocity = np.array(self.velocity)
-        np_temperature = np.array(self.temperature)
-        np_fuel = np.array(self.fuel)
-        np_vent = np.array(self.vent)
-
-        i_time = np.linspace(np_time[0], np_time[-1], num=max_points)
-        i_position = np.array(
-            [np.interp(i_time, np_time, np_position[:, i]) for i in range(3)]
-        ).T
-        i_velocity = np.array(
-            [np.interp(i_time, np_time, np_velocity[:, i]) for i in range(3)]
-        ).T
-        i_temperature = np.interp(i_time, np_time, np_temperature)
-        i_fuel = np.interp(i_time, np_time, np_fuel)
-        i_vent = np.interp(i_time, np_time, np_vent)
-
-        monitor = Monitor()
-        monitor.time = i_time.tolist()
-        monitor.position = [Vector3(*p) for p in i_position.tolist()]
-        monitor.velocity = [Vector3(*v) for v in i_velocity.tolist()]
-        monitor.temperature = i_temperature.tolist()
-        monitor.fuel = i_fuel.tolist()
-        monitor.vent = i_vent.tolist()
+        i_time = np.linspace(self.time[0], self.time[-1], num=max_points)
+        i_states = np.column_stack(
+            [
+                np.interp(i_time, self.time, self.states[: self.size, i])
+                for i in range(self.num_columns)
+            ]
+        )
 
+        monitor = Monitor(max_points, self.states.dtype)
+        monitor.extend(i_states)
         return monitor
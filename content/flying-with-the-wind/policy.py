@@ -0,0 +1,146 @@
+import hashlib
+import os
+import tempfile
+from typing import Dict, Union
+
+import numpy as np
+from vector import Vector3
+
+
+def policy_key(
+    field_digest: str,
+    dimensions: Vector3,
+    target_grid: Vector3,
+    grid_size: Vector3,
+    max_vertical_speed: float,
+) -> str:
+    """
+    Returns a hash identifying a search policy. The policy only depends on the wind field, the
+    search domain, the target grid position, the grid size, and the maximum vertical speed.
+    """
+    parameters = (
+        field_digest,
+        tuple(dimensions),
+        tuple(target_grid),
+        tuple(grid_size),
+        max_vertical_speed,
+    )
+    return hashlib.sha256(repr(parameters).encode()).hexdigest()
+
+
+class PolicyTable:
+    """
+    A compact representation of the parents map produced by a search. Grid positions inside a box
+    are stored as a dense int32 array of flattened parent indices. The table can be saved to disk
+    and memory-mapped back so that the search does not need to be repeated.
+    """
+
+    # Sentinel values for grid positions without a regular parent.
+    NO_PARENT = -1
+    UNREACHABLE = -2
+
+    def __init__(
+        self, lower_bound: Vector3, parents: np.ndarray, unreachable_grid: Vector3
+    ):
+        """
+        Initializes the table from an array of flattened parent indices. The lower bound is the grid
+        position corresponding to the first element of the array.
+        """
+        self.lower_bound: Vector3 = lower_bound
+        self.parents: np.ndarray = parents
+        self.unreachable_grid: Vector3 = unreachable_grid
+
+    @staticmethod
+    def from_parents(
+        parents: Dict[Vector3, Union[Vector3, None]],
+        lower_bound: Vector3,
+        upper_bound: Vector3,
+        unreachable_grid: Vector3,
+    ) -> "PolicyTable":
+        """
+        Builds a table from a parents map. Only grid positions between the lower bound (inclusive)
+        and the upper bound (exclusive) are stored.
+        """
+        shape = tuple(int(u - l) for l, u in zip(lower_bound, upper_bound))
+        table = PolicyTable(
+            lower_bound,
+            np.full(shape, PolicyTable.NO_PARENT, dtype=np.int32),
+            unreachable_grid,
+        )
+
+        flat_parents = table.parents.reshape(-1)
+        for grid, parent in parents.items():
+            index = table.index(grid)
+            if index is None or parent is None:
+                continue
+            if parent == unreachable_grid:
+                flat_parents[index] = PolicyTable.UNREACHABLE
+                continue
+            parent_index = table.index(parent)
+            if parent_index is not None:
+                flat_parents[index] = parent_index
+
+        return table
+
+    @staticmethod
+    def load(
+        filename: str, lower_bound: Vector3, unreachable_grid: Vector3
+    ) -> "PolicyTable":
+        """
+        Loads a table from the given file. The array is memory-mapped rather than read.
+        """
+        return PolicyTable(
+            lower_bound, np.load(filename, mmap_mode="r"), unreachable_grid
+        )
+
+    def save(self, filename: str):
+        """
+        Saves the table to the given file. The file is written atomically so that concurrent
+        readers never observe a partial table.
+        """
+        directory = os.path.dirname(filename) or "."
+        os.makedirs(directory, exist_ok=True)
+        fd, temporary = tempfile.mkstemp(dir=directory, suffix=".npy")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                np.save(f, self.parents)
+            os.replace(temporary, filename)
+        except BaseException:
+            os.unlink(temporary)
+            raise
+
+    def index(self, grid: Vector3) -> Union[int, None]:
+        """
+        Returns the flattened index of the given grid position or None if it is not in the table.
+        """
+        size_x, size_y, size_z = self.parents.shape
+        x = int(grid.x - self.lower_bound.x)
+        y = int(grid.y - self.lower_bound.y)
+        z = int(grid.z - self.lower_bound.z)
+        if not (0 <= x < size_x and 0 <= y < size_y and 0 <= z < size_z):
+            return None
+        return (x * size_y + y) * size_z + z
+
+    def get(
+        self, grid: Vector3, default: Union[Vector3, None] = None
+    ) -> Union[Vector3, None]:
+        """
+        Returns the parent of the given grid position. This mirrors the dict interface so that the
+        table can be used in place of a parents map.
+        """
+        index = self.index(grid)
+        if index is None:
+            return default
+
+        parent = int(self.parents.flat[index])
+        if parent == PolicyTable.NO_PARENT:
+            return default
+        if parent == PolicyTable.UNREACHABLE:
+            return self.unreachable_grid
+
+        _, size_y, size_z = self.parents.shape
+        x, remainder = divmod(parent, size_y * size_z)
+        y, z = divmod(remainder, size_z)
+        return Vector3(
+            x + self.lower_bound.x, y + self.lower_bound.y, z + self.lower_bound.z
+        )
@@ -3,7 +3,8 @@ from field import RandomField
 from vector import Vector3
 from simulation import run_reference_simulation
 from tune import simulate_position
-from evaluate import evaluate, simulate_one
+from evaluate import RESULT_STORE, EvaluationEngine, simulate_one
+from store import ResultStore
 
 
 def field():
@@ -38,12 +39,8 @@ def reference():
     monitor = monitor.interpolate(1000)
 
     out = []
-    for point in monitor.position:
-        out.append(
-            "[{:.5g}, {:.5g}, {:.5g}]".format(
-                round(point.x), round(point.y), round(point.z)
-            )
-        )
+    for x, y, z in monitor.position:
+        out.append("[{:.5g}, {:.5g}, {:.5g}]".format(round(x), round(y), round(z)))
     print("const data = [" + ", ".join(out) + "];")
     print(monitor.get_square_bounds())
 
@@ -58,13 +55,13 @@ def tune():
     print("const data_time = [" + ", ".join(time) + "];")
 
     position = []
-    for point in monitor.position:
-        position.append("{:.5g}".format(round(point.z, 1)))
+    for point in monitor.position[:, 2]:
+        position.append("{:.5g}".format(round(point, 1)))
     print("const data_position = [" + ", ".join(position) + "];")
 
     velocity = []
-    for point in monitor.velocity:
-        velocity.append("{:.5g}".format(round(point.z, 1)))
+    for point in monitor.velocity[:, 2]:
+        velocity.append("{:.5g}".format(round(point, 1)))
     print("const data_velocity = [" + ", ".join(velocity) + "];")
 
     fuel = []
@@ -79,8 +76,12 @@ def tune():
 
 
 def horizontal():
-    for controller_type in ["Fixed", "Greedy", "Search"]:
-        results = evaluate(controller_type)
+    controller_types = ["Fixed", "Greedy", "Search"]
+    with EvaluationEngine() as engine, ResultStore(RESULT_STORE) as store:
+        all_results = engine.evaluate(controller_types, range(100), store=store)
+
+    for controller_type in controller_types:
+        results = all_results[controller_type]
         histogram, bins = np.histogram(
             results, bins=np.concatenate((np.arange(0, 2000, 100), [np.inf]))
         )
@@ -110,12 +111,8 @@ def trajectory():
         monitor = monitor.interpolate(1000)
 
         out = []
-        for point in monitor.position:
-            out.append(
-                "[{:.5g}, {:.5g}, {:.5g}]".format(
-                    round(point.x), round(point.y), round(point.z)
-                )
-            )
+        for x, y, z in monitor.position:
+            out.append("[{:.5g}, {:.5g}, {:.5g}]".format(round(x), round(y), round(z)))
         print("const data_" + controller_type.lower() + " = [" + ", ".join(out) + "];")
         print(monitor.get_square_bounds())
         print(target)
@@ -0,0 +1,174 @@
+import contextlib
+import json
+import os
+import time
+from typing import Dict, Iterator, List, Tuple
+
+from balloon import Balloon
+
+
+class Phase:
+    """
+    Represents a phase of a simulation timed by a profiler. It is a reusable context manager which
+    adds the time spent in it to the profiler's statistics, and records a trace event if traced.
+    Phases are not reentrant, but different phases can be nested.
+    """
+
+    __slots__ = ("profiler", "name", "traced", "start")
+
+    def __init__(self, profiler: "Profiler", name: str, traced: bool):
+        """
+        Initializes the phase of the given profiler.
+        """
+        self.profiler = profiler
+        self.name = name
+        self.traced = traced
+        self.start = 0
+
+    def __enter__(self):
+        """
+        Starts timing the phase.
+        """
+        self.start = time.perf_counter_ns()
+
+    def __exit__(self, *args):
+        """
+        Stops timing the phase and records it.
+        """
+        duration = time.perf_counter_ns() - self.start
+        stats = self.profiler.stats[self.name]
+        stats[0] += 1
+        stats[1] += duration
+        if self.traced:
+            self.profiler.events.append((self.name, self.start, duration))
+
+
+class Profiler:
+    """
+    Records where the time of simulations goes (see simulation.run). The time spent in each phase of
+    a step is accumulated along with the number of calls: getting the controller input, calling the
+    controller, integrating, and updating the monitor. While a simulation runs, the balloon's
+    derivative and wind lookups are instrumented too, so that the number of evaluations of the
+    right-hand side per step is known. These nested phases are called many times per step, so they
+    are only traced if trace_nested is set. A profiler can be reused to accumulate several runs.
+    """
+
+    # Null context returned for phases when not profiling.
+    null_context = contextlib.nullcontext()
+
+    def __init__(self, trace_nested: bool = False):
+        """
+        Initializes the profiler with no recorded phases.
+        """
+        self.trace_nested = trace_nested
+        self.origin: int = time.perf_counter_ns()
+        self.num_steps: int = 0
+        self.stats: Dict[str, List[int]] = {}
+        self.phases: Dict[str, Phase] = {}
+        self.events: List[Tuple[str, int, int]] = []
+
+    @staticmethod
+    def null_phase(name: str) -> contextlib.nullcontext:
+        """
+        Returns a context manager which does nothing, used in place of phase when not profiling.
+        """
+        return Profiler.null_context
+
+    def phase(self, name: str, traced: bool = True) -> Phase:
+        """
+        Returns the context manager timing the phase with the given name.
+        """
+        phase = self.phases.get(name)
+        if phase is None:
+            phase = self.phases[name] = Phase(self, name, traced)
+            self.stats[name] = [0, 0]
+        return phase
+
+    @contextlib.contextmanager
+    def instrument(self, balloon: Balloon) -> Iterator[None]:
+        """
+        Returns a context manager timing a whole run of the given balloon, during which its
+        derivative and wind lookups are timed too. The balloon is restored afterwards.
+        """
+        derivative = balloon.derivative
+        get_wind = balloon.get_wind
+        derivative_phase = self.phase("derivative", self.trace_nested)
+        wind_phase = self.phase("wind", self.trace_nested)
+
+        def profiled_derivative(*args):
+            with derivative_phase:
+                return derivative(*args)
+
+        def profiled_get_wind(*args):
+            with wind_phase:
+                return get_wind(*args)
+
+        # Shadow the methods with instance attributes, which the balloon's own calls look up first.
+        balloon.derivative = profiled_derivative
+        balloon.get_wind = profiled_get_wind
+        try:
+            with self.phase("run"):
+                yield
+        finally:
+            del balloon.derivative
+            del balloon.get_wind
+
+    def summary(self) -> str:
+        """
+        Returns a table of the calls, cumulative time, and share of the run time of each phase,
+        followed by the number of steps and derivative evaluations per step.
+        """
+        total = self.stats.get("run", [0, 0])[1]
+        lines = [
+            "{:<18} {:>10} {:>12} {:>12} {:>8}".format(
+                "phase", "calls", "total (ms)", "mean (us)", "share"
+            )
+        ]
+        for name, (calls, duration) in self.stats.items():
+            lines.append(
+                "{:<18} {:>10} {:>12.3f} {:>12.3f} {:>7.1f}%".format(
+                    name,
+                    calls,
+                    duration * 1e-6,
+                    duration * 1e-3 / max(1, calls),
+                    100.0 * duration / max(1, total),
+                )
+            )
+
+        num_derivatives = self.stats.get("derivative", [0, 0])[0]
+        lines.append(
+            "steps={}, derivatives_per_step={:.2f}".format(
+                self.num_steps, num_derivatives / max(1, self.num_steps)
+            )
+        )
+        return "\n".join(lines)
+
+    def write_trace(self, filename: str):
+        """
+        Writes the traced phases to the given file in the Chrome trace event format, which can be
+        opened in chrome://tracing or Perfetto.
+        """
+        pid = os.getpid()
+        with open(filename, "w") as f:
+            json.dump(
+                {
+                    "traceEvents": [
+                        {
+                            "name": name,
+                            "cat": "simulation",
+                            "ph": "X",
+                            "ts": (start - self.origin) * 1e-3,
+                            "dur": duration * 1e-3,
+                            "pid": pid,
+                            "tid": 0,
+                        }
+                        for name, start, duration in self.events
+                    ],
+                    "displayTimeUnit": "ms",
+                    "otherData": {
+                        "steps": self.num_steps,
+                        "derivatives": self.stats.get("derivative", [0, 0])[0],
+                    },
+                },
+                f,
+            )
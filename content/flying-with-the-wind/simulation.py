@@ -1,7 +1,11 @@
+import contextlib
+import functools
 import math
+import time
+from typing import Callable, Sequence, Tuple, Union
 
 import numpy as np
-from balloon import Balloon
+from balloon import Balloon, integrate
 from controller import (
     Controller,
     ControllerOutput,
@@ -10,13 +14,227 @@ from controller import (
     SearchPositionController,
     SequenceController,
     apply_controller_output,
+    compile_schedule,
     get_controller_input,
+    get_next_decision_time,
 )
-from field import RandomField
+from field import Field3, RandomField
 from monitor import Monitor
-from tqdm import tqdm
+from numba import jit
+from profiler import Profiler
 from vector import Vector3
 
+type StopCondition = Callable[[Balloon], bool]
+"""
+Represents a condition for stopping a simulation early. It is called with the balloon after every
+step, and the simulation stops as soon as it returns True.
+"""
+
+
+class TargetReached:
+    """
+    A stop condition that is met once the balloon is within the given horizontal distance of the
+    target position.
+    """
+
+    def __init__(self, target: Vector3, radius: float):
+        """
+        Initializes the condition with the target position and radius in meters.
+        """
+        self.target = target
+        self.radius = radius
+
+    def __call__(self, balloon: Balloon) -> bool:
+        """
+        Returns whether the condition is met.
+        """
+        position = balloon.get_position()
+        return (
+            math.hypot(position.x - self.target.x, position.y - self.target.y)
+            <= self.radius
+        )
+
+
+class Grounded:
+    """
+    A stop condition that is met once the balloon is on the ground with no fuel.
+    """
+
+    def __call__(self, balloon: Balloon) -> bool:
+        """
+        Returns whether the condition is met.
+        """
+        return balloon.position.z <= 0.0 and balloon.fuel == 0.0
+
+
+class NoImprovement:
+    """
+    A stop condition that is met once the balloon provably cannot get horizontally closer to the
+    target than it has already been before the total time. The balloon's horizontal velocity is
+    pulled towards the wind velocity by drag, so each of its components never exceeds the largest
+    magnitude of the wind in that component, or its current magnitude if that is larger.
+    """
+
+    def __init__(
+        self,
+        target: Vector3,
+        total_time: float,
+        max_wind_velocity: Vector3,
+        tolerance: float = 1.0,
+    ):
+        """
+        Initializes the condition with the target position, the total simulation time in seconds,
+        and the largest magnitude of each component of the wind velocity in meters per second. The
+        tolerance in meters accounts for integration errors.
+        """
+        self.target = target
+        self.total_time = total_time
+        self.max_wind_velocity = max_wind_velocity
+        self.tolerance = tolerance
+        self.best_distance = math.inf
+
+    @staticmethod
+    def from_field(
+        target: Vector3, total_time: float, wind_field: Field3, tolerance: float = 1.0
+    ) -> "NoImprovement":
+        """
+        Returns the condition for a wind field with a grid of control vectors. Interpolation never
+        exceeds the largest control vector in each component.
+        """
+        _, _, control_vectors = wind_field.control_grid()
+        return NoImprovement(
+            target,
+            total_time,
+            Vector3(*np.abs(control_vectors).max(axis=(0, 1, 2))),
+            tolerance,
+        )
+
+    def __call__(self, balloon: Balloon) -> bool:
+        """
+        Returns whether the condition is met.
+        """
+        position = balloon.get_position()
+        velocity = balloon.get_velocity()
+        distance = math.hypot(position.x - self.target.x, position.y - self.target.y)
+        self.best_distance = min(self.best_distance, distance)
+
+        max_speed = math.hypot(
+            max(abs(velocity.x), self.max_wind_velocity.x),
+            max(abs(velocity.y), self.max_wind_velocity.y),
+        )
+        remaining_time = max(0.0, self.total_time - balloon.get_time())
+        return (
+            distance - max_speed * remaining_time - self.tolerance > self.best_distance
+        )
+
+
+class WallClockBudget:
+    """
+    A stop condition that is met once the given wall-clock time has passed since it was first
+    checked.
+    """
+
+    def __init__(self, seconds: float):
+        """
+        Initializes the condition with the budget in seconds.
+        """
+        self.seconds = seconds
+        self.start: Union[float, None] = None
+
+    def __call__(self, balloon: Balloon) -> bool:
+        """
+        Returns whether the condition is met.
+        """
+        now = time.perf_counter()
+        if self.start is None:
+            self.start = now
+        return now - self.start > self.seconds
+
+
+@functools.cache
+def make_run_schedule_function() -> (
+    Callable[..., Tuple[np.ndarray, float, float, float]]
+):
+    """
+    Returns a compiled function that runs the whole simulation of a balloon following a compiled
+    schedule (see compile_schedule). It takes the dimensionless state and time of the balloon, the
+    dimensionless time step, the number of steps, the schedule arrays, the grid of control vectors
+    of the wind field, and an array of shape (num_steps, Monitor.num_columns) which is filled with
+    the state after each step. It returns the final dimensionless state, time, fuel, and vent. The
+    function is only compiled once, and is cached on disk.
+    """
+    # Capture constants in closure.
+    k_ratio_distance = Balloon.k_ratio_distance
+    k_ratio_time = Balloon.k_ratio_time
+    k_ratio_temperature = Balloon.k_ratio_temperature
+    k_ratio_fuel = Balloon.k_ratio_fuel
+    k_ratio_vent = Balloon.k_ratio_vent
+
+    # Define the function to be compiled.
+    def run_schedule(
+        x: np.ndarray,
+        time: float,
+        time_delta: float,
+        num_steps: int,
+        times: np.ndarray,
+        fuel_values: np.ndarray,
+        vent_values: np.ndarray,
+        fuel: float,
+        vent: float,
+        dim_x: float,
+        dim_y: float,
+        dim_z: float,
+        points_x: np.ndarray,
+        points_y: np.ndarray,
+        points_z: np.ndarray,
+        values: np.ndarray,
+        states: np.ndarray,
+    ) -> Tuple[np.ndarray, float, float, float]:
+        index = 0
+        step_size = time_delta
+        for i in range(num_steps):
+            # Look up the scheduled output at the current time.
+            while (
+                index + 1 < times.shape[0] and times[index + 1] <= time * k_ratio_time
+            ):
+                index += 1
+            fuel = fuel_values[index] / k_ratio_fuel
+            vent = vent_values[index] / k_ratio_vent
+
+            # Simulate one step like Balloon.step.
+            x, step_size = integrate(
+                x,
+                step_size,
+                time,
+                time + time_delta,
+                fuel,
+                vent,
+                dim_x,
+                dim_y,
+                dim_z,
+                points_x,
+                points_y,
+                points_z,
+                values,
+            )
+            if x[2] <= 0.0:
+                x[2] = 0.0
+                x[3:6] = 0.0
+            time = time + time_delta
+
+            # Record the state like Monitor.update.
+            states[i, 0] = time * k_ratio_time
+            states[i, 1:4] = x[0:3] * k_ratio_distance
+            states[i, 4:7] = x[3:6] * (k_ratio_distance / k_ratio_time)
+            states[i, 7] = x[6] * k_ratio_temperature
+            states[i, 8] = fuel * k_ratio_fuel
+            states[i, 9] = vent * k_ratio_vent
+
+        return x, time, fuel, vent
+
+    # Return the compiled function.
+    return jit(run_schedule, cache=True)
+
 
 def run(
     balloon: Balloon,
@@ -24,34 +242,134 @@ def run(
     time_step: float,
     total_time: float,
     show_progress: bool = True,
+    compiled: bool = True,
+    monitor: Union[Monitor, None] = None,
+    stop_conditions: Sequence[StopCondition] = (),
+    dtype: type = np.float64,
+    profiler: Union[Profiler, None] = None,
 ) -> Monitor:
     """
     Runs the balloon simulation. Returns a monitor containing the state of the balloon at each step
-    of the simulation.
+    of the simulation. If a monitor is given, the states are appended to it instead, which is used
+    to resume a simulation (see checkpoint.py). If the controller's output only depends on time and
+    compiled is set, the whole simulation runs in a single compiled loop. That loop uses its own
+    integrator, so results agree with the regular loop to within the integration tolerances rather
+    than exactly. The simulation stops early once any of the stop conditions is met. Stop
+    conditions are checked after every step, so they disable integrating several steps at once.
+    The states are stored with the given dtype unless a monitor is given. The dtype only affects
+    storage, since the balloon is always integrated in double precision. If a profiler is given,
+    the phases of each step are timed with it. The right-hand side of the single compiled loop
+    cannot be instrumented, so profiled simulations always use the regular loop, in which the
+    derivative evaluations per step are counted.
     """
-    monitor = Monitor()
-    monitor.update(balloon)
+    if monitor is None:
+        monitor = Monitor(dtype=dtype)
+        monitor.update(balloon)
+
+    # Time the phases of each step only if profiling, so that the overhead is a no-op otherwise.
+    if profiler is None:
+        phase = Profiler.null_phase
+        instrument = contextlib.nullcontext()
+    else:
+        phase = profiler.phase
+        instrument = profiler.instrument(balloon)
 
+    # Allow for rounding in the balloon's accumulated time, so that a resumed simulation takes the
+    # same number of steps as an uninterrupted one.
     start_time = balloon.get_time()
-    num_steps = int(math.ceil((total_time - start_time) / time_step))
+    num_steps = int(math.ceil((total_time - start_time) / time_step - 1e-6))
 
-    iterator = range(num_steps)
-    if show_progress:
-        iterator = tqdm(iterator)
+    # Run open-loop controllers in a single compiled loop, unless profiling.
+    schedule = (
+        compile_schedule(controller)
+        if compiled and not stop_conditions and profiler is None
+        else None
+    )
+    if schedule is not None and hasattr(balloon.wind_field, "control_grid"):
+        dimensions, control_points, control_vectors = balloon.wind_field.control_grid()
+        x = np.empty(7, dtype=np.float64)
+        x[0:3] = balloon.position
+        x[3:6] = balloon.velocity
+        x[6] = balloon.temperature
+        states = np.empty(
+            (max(0, num_steps), Monitor.num_columns), dtype=monitor.states.dtype
+        )
 
-    for _ in iterator:
-        apply_controller_output(balloon, controller(get_controller_input(balloon)))
-        balloon.step(time_step)
-        monitor.update(balloon)
+        result = make_run_schedule_function()(
+            x,
+            balloon.time,
+            time_step / balloon.k_ratio_time,
+            num_steps,
+            *schedule,
+            balloon.fuel,
+            balloon.vent,
+            *dimensions,
+            *control_points,
+            control_vectors,
+            states,
+        )
+        x, balloon.time, balloon.fuel, balloon.vent = result
+        balloon.position = Vector3(*x[0:3])
+        balloon.velocity = Vector3(*x[3:6])
+        balloon.temperature = x[6]
+
+        monitor.extend(states)
+        return monitor
+
+    from tqdm import tqdm
+
+    progress = tqdm(total=num_steps, disable=not show_progress)
+    step = 0
+    with instrument:
+        while step < num_steps:
+            with phase("controller_input"):
+                input = get_controller_input(balloon)
+            with phase("controller"):
+                apply_controller_output(balloon, controller(input))
+                decision_time = get_next_decision_time(controller, input)
+
+            # Integrate straight to the controller's next decision time. The controller is called
+            # again one step early rather than risking a late call due to rounding.
+            num_decision_steps = 1 if stop_conditions else num_steps - step
+            if not math.isinf(decision_time):
+                num_decision_steps = min(
+                    num_decision_steps,
+                    max(
+                        1, int(math.ceil((decision_time - input.time) / time_step)) - 1
+                    ),
+                )
+
+            if num_decision_steps == 1:
+                with phase("integrate"):
+                    balloon.step(time_step)
+                with phase("monitor"):
+                    monitor.update(balloon)
+            else:
+                with phase("integrate"):
+                    time, x = balloon.step_many(time_step, num_decision_steps)
+                with phase("monitor"):
+                    monitor.update_many(balloon, time, x)
+
+            step += num_decision_steps
+            progress.update(num_decision_steps)
+
+            with phase("stop_conditions"):
+                if any(condition(balloon) for condition in stop_conditions):
+                    break
 
+    progress.close()
+    if profiler is not None:
+        profiler.num_steps += step
     return monitor
 
 
 def run_reference_simulation(
     generator: np.random.Generator = np.random.default_rng(),
+    dtype: type = np.float64,
 ) -> Monitor:
     """
-    Runs the reference simulation in a random field.
+    Runs the reference simulation in a random field, storing the field and the states with the
+    given dtype.
     """
     tr = 10.10
     tf = 5000
@@ -64,6 +382,7 @@ def run_reference_simulation(
             Vector3(10000.0, 10000.0, 10000.0),
             Vector3(10, 10, 10),
             generator=generator,
+            dtype=dtype,
         )
     )
 
@@ -84,6 +403,7 @@ def run_reference_simulation(
         controller=controller,
         time_step=time_step,
         total_time=tf * tr,
+        dtype=dtype,
     )
 
 
@@ -0,0 +1,78 @@
+import os
+import sqlite3
+from typing import Dict, Iterable
+
+
+class ResultStore:
+    """
+    An append-only on-disk store of evaluation results, backed by SQLite. Each result is keyed by
+    the controller type, the controller parameters, the seed, and a digest of the simulation
+    configuration. Results are committed as soon as they are added, so an interrupted evaluation
+    can resume from where it stopped.
+    """
+
+    def __init__(self, filename: str):
+        """
+        Opens the store in the given file, creating it if needed.
+        """
+        directory = os.path.dirname(filename)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        self.connection = sqlite3.connect(filename)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS results (
+                controller_type TEXT NOT NULL,
+                parameters TEXT NOT NULL,
+                seed INTEGER NOT NULL,
+                config TEXT NOT NULL,
+                penalty REAL NOT NULL,
+                PRIMARY KEY (controller_type, parameters, config, seed)
+            )
+            """)
+        self.connection.commit()
+
+    def __enter__(self) -> "ResultStore":
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+    def close(self):
+        """
+        Closes the store.
+        """
+        self.connection.close()
+
+    def get(
+        self, controller_type: str, parameters: str, config: str, seeds: Iterable[int]
+    ) -> Dict[int, float]:
+        """
+        Returns the stored penalties for the given seeds, keyed by seed. Seeds without a result are
+        left out.
+        """
+        seeds = set(seeds)
+        rows = self.connection.execute(
+            "SELECT seed, penalty FROM results"
+            " WHERE controller_type = ? AND parameters = ? AND config = ?",
+            (controller_type, parameters, config),
+        )
+        return {seed: penalty for seed, penalty in rows if seed in seeds}
+
+    def add(
+        self,
+        controller_type: str,
+        parameters: str,
+        config: str,
+        seed: int,
+        penalty: float,
+    ):
+        """
+        Adds a result to the store. Results which are already stored are never replaced.
+        """
+        self.connection.execute(
+            "INSERT OR IGNORE INTO results VALUES (?, ?, ?, ?, ?)",
+            (controller_type, parameters, seed, config, float(penalty)),
+        )
+        self.connection.commit()
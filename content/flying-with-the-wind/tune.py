@@ -1,17 +1,123 @@
+import os
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, wait
+from typing import Callable, Dict, List, Tuple, Union
+
 import numpy as np
 from balloon import Balloon
-from bayes_opt import BayesianOptimization
+from bayes_opt import BayesianOptimization, Events, UtilityFunction
+from bayes_opt.logger import ScreenLogger
 from controller import (
     SequenceController,
     VerticalPositionController,
     VerticalVelocityController,
 )
+from ensemble import (
+    BalloonBatch,
+    BatchSequenceController,
+    BatchVerticalPositionController,
+    BatchVerticalVelocityController,
+    run_batch,
+)
 from simulation import run
 
+# Bounds of the gains searched when tuning the velocity controller.
+VELOCITY_BOUNDS = {"k_p": (0, 200), "k_i": (0, 200), "k_d": (0, 200)}
+
+# Bounds of the gains searched when tuning the position controller.
+POSITION_BOUNDS = {"k_p": (0, 0.02), "k_i": (0, 0.0), "k_d": (0, 0.0)}
+
+# Number of full fidelity objective evaluations made by tune_velocity and tune_position: 5 random
+# initial points followed by 100 iterations.
+NUM_TUNING_EVALUATIONS = 105
+
+# Fidelities used by successive halving when tuning the velocity controller, as pairs of total
+# time and time step, from the cheapest to the full fidelity of objective_velocity.
+VELOCITY_FIDELITIES = [(250.0, 2.0), (500.0, 2.0), (1000.0, 1.0), (2500.0, 1.0)]
+
+# Fidelities used by successive halving when tuning the position controller, as pairs of total
+# time and time step, from the cheapest to the full fidelity of objective_position.
+POSITION_FIDELITIES = [(600.0, 2.0), (1500.0, 2.0), (3000.0, 1.0), (6000.0, 1.0)]
+
+
+def maximize_parallel(
+    optimizer: BayesianOptimization,
+    init_points: int = 5,
+    n_iter: int = 25,
+    batch_size: Union[int, None] = None,
+    verbose: int = 2,
+):
+    """
+    Maximizes the optimizer's target function like BayesianOptimization.maximize, but evaluates up
+    to batch_size points at once in worker processes. The target function must be picklable. New
+    points are suggested with the constant liar strategy: points which are still being evaluated
+    are assumed to have the worst target seen so far, which steers suggestions away from them. A new
+    point is suggested as soon as any evaluation finishes. The batch size defaults to the number of
+    CPUs. Suggestions are drawn from the optimizer's random state, so a seeded optimizer suggests
+    the same points given the same order of results.
+    """
+    if batch_size is None:
+        batch_size = os.cpu_count() or 1
+
+    logger = ScreenLogger(verbose=verbose)
+    for event in [
+        Events.OPTIMIZATION_START,
+        Events.OPTIMIZATION_STEP,
+        Events.OPTIMIZATION_END,
+    ]:
+        optimizer.subscribe(event, logger)
+    optimizer.dispatch(Events.OPTIMIZATION_START)
+
+    utility = UtilityFunction(kind="ucb", kappa=2.576)
+    space = optimizer.space
+    pending: Dict[Future, Dict[str, float]] = {}
+    num_submitted = 0
+
+    with ProcessPoolExecutor(batch_size) as executor:
+        while num_submitted < init_points + n_iter or pending:
+            # Keep the workers busy with new suggestions.
+            while len(pending) < batch_size and num_submitted < init_points + n_iter:
+                if num_submitted < init_points or len(space) == 0:
+                    params = space.array_to_params(space.random_sample())
+                else:
+                    liar = BayesianOptimization(
+                        f=None,
+                        pbounds=dict(zip(space.keys, space.bounds)),
+                        random_state=optimizer._random_state,
+                        allow_duplicate_points=True,
+                    )
+                    # Model the targets like the optimizer, with any parameters set with
+                    # set_gp_params.
+                    liar.set_gp_params(**optimizer._gp.get_params(deep=False))
+                    for observed_params, target in zip(space.params, space.target):
+                        liar.register(observed_params, target)
+                    lie = float(np.min(space.target))
+                    for pending_params in pending.values():
+                        liar.register(pending_params, lie)
+                    params = liar.suggest(utility)
+                    utility.update_params()
+
+                pending[executor.submit(space.target_func, **params)] = params
+                num_submitted += 1
 
-def simulate_velocity(k_p, k_i, k_d):
+            # Register results as soon as they arrive.
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                optimizer.register(pending.pop(future), future.result())
+
+    optimizer.dispatch(Events.OPTIMIZATION_END)
+
+
+def simulate_velocity(
+    k_p,
+    k_i,
+    k_d,
+    show_progress: bool = True,
+    total_time: float = 2500.0,
+    time_step: float = 1.0,
+):
     """
-    Simulate the balloon with the given parameters for the velocity controller.
+    Simulate the balloon with the given parameters for the velocity controller. A shorter total
+    time or a longer time step gives a cheaper, lower fidelity simulation.
     """
     controller = SequenceController(
         (0.0, VerticalVelocityController(3.0, k_p, k_i, k_d)),
@@ -23,40 +129,57 @@ def simulate_velocity(k_p, k_i, k_d):
     monitor = run(
         balloon=Balloon(),
         controller=controller,
-        time_step=1.0,
-        total_time=2500.0,
+        time_step=time_step,
+        total_time=total_time,
+        show_progress=show_progress,
     )
 
-    target_velocity = np.zeros(len(monitor.time))
-    target_velocity[0:1000] = 3.0
-    target_velocity[1000:1500] = -2.0
-    target_velocity[1500:2000] = 1.0
-    target_velocity[2000:2500] = -1.0
+    return monitor, make_target_velocity(len(monitor.time), time_step)
+
 
-    return monitor, target_velocity
+def make_target_velocity(num_points: int, time_step: float = 1.0) -> np.ndarray:
+    """
+    Returns the target velocity of the velocity controller tuning at each simulation step. The
+    target is looked up at the nominal time of each step, which avoids rounding errors in the
+    accumulated simulation time at the switching times.
+    """
+    time = np.arange(num_points) * time_step
+    return np.select(
+        [time < 1000.0, time < 1500.0, time < 2000.0, time < 2500.0],
+        [3.0, -2.0, 1.0, -1.0],
+        0.0,
+    )
 
 
-def objective_velocity(k_p, k_i, k_d):
+def objective_velocity(
+    k_p, k_i, k_d, total_time: float = 2500.0, time_step: float = 1.0
+):
     """
     Objective function for the velocity controller tuning.
     """
-    monitor, target_velocity = simulate_velocity(k_p, k_i, k_d)
-    velocity = np.array([velocity.z for velocity in monitor.velocity])
+    monitor, target_velocity = simulate_velocity(
+        k_p,
+        k_i,
+        k_d,
+        show_progress=False,
+        total_time=total_time,
+        time_step=time_step,
+    )
+    velocity = monitor.velocity[:, 2]
     error = np.mean(np.abs(velocity - target_velocity))
     return -error
 
 
-def tune_velocity():
+def tune_velocity(batch_size: Union[int, None] = None):
     """
-    Tunes the velocity controller.
+    Tunes the velocity controller, evaluating batch_size candidates in parallel.
     """
-    bounds = {"k_p": (0, 200), "k_i": (0, 200), "k_d": (0, 200)}
     optimizer = BayesianOptimization(
         f=objective_velocity,
-        pbounds=bounds,
+        pbounds=VELOCITY_BOUNDS,
         verbose=2,
     )
-    optimizer.maximize(n_iter=100)
+    maximize_parallel(optimizer, n_iter=100, batch_size=batch_size)
 
     if optimizer.max is not None:
         print(optimizer.max)
@@ -65,9 +188,17 @@ def tune_velocity():
         monitor.plot_state()
 
 
-def simulate_position(k_p, k_i, k_d):
+def simulate_position(
+    k_p,
+    k_i,
+    k_d,
+    show_progress: bool = True,
+    total_time: float = 6000.0,
+    time_step: float = 1.0,
+):
     """
-    Simulate the balloon with the given parameters for the position controller.
+    Simulate the balloon with the given parameters for the position controller. A shorter total
+    time or a longer time step gives a cheaper, lower fidelity simulation.
     """
     controller = SequenceController(
         (0.0, VerticalPositionController(1000.0, k_p, k_i, k_d)),
@@ -79,40 +210,57 @@ def simulate_position(k_p, k_i, k_d):
     monitor = run(
         balloon=Balloon(),
         controller=controller,
-        time_step=1.0,
-        total_time=6000.0,
+        time_step=time_step,
+        total_time=total_time,
+        show_progress=show_progress,
     )
 
-    target_position = np.zeros(len(monitor.time))
-    target_position[0:1500] = 1000.0
-    target_position[1500:3000] = 500.0
-    target_position[3000:4500] = 750.0
-    target_position[4500:6000] = 250.0
+    return monitor, make_target_position(len(monitor.time), time_step)
 
-    return monitor, target_position
 
+def make_target_position(num_points: int, time_step: float = 1.0) -> np.ndarray:
+    """
+    Returns the target position of the position controller tuning at each simulation step. The
+    target is looked up at the nominal time of each step, which avoids rounding errors in the
+    accumulated simulation time at the switching times.
+    """
+    time = np.arange(num_points) * time_step
+    return np.select(
+        [time < 1500.0, time < 3000.0, time < 4500.0, time < 6000.0],
+        [1000.0, 500.0, 750.0, 250.0],
+        0.0,
+    )
 
-def objective_position(k_p, k_i, k_d):
+
+def objective_position(
+    k_p, k_i, k_d, total_time: float = 6000.0, time_step: float = 1.0
+):
     """
     Objective function for the position controller.
     """
-    monitor, target_position = simulate_position(k_p, k_i, k_d)
-    position = np.array([position.z for position in monitor.position])
+    monitor, target_position = simulate_position(
+        k_p,
+        k_i,
+        k_d,
+        show_progress=False,
+        total_time=total_time,
+        time_step=time_step,
+    )
+    position = monitor.position[:, 2]
     error = np.mean(np.abs(position - target_position))
     return -error
 
 
-def tune_position():
+def tune_position(batch_size: Union[int, None] = None):
     """
-    Tune the position controller.
+    Tune the position controller, evaluating batch_size candidates in parallel.
     """
-    bounds = {"k_p": (0, 0.02), "k_i": (0, 0.0), "k_d": (0, 0.0)}
     optimizer = BayesianOptimization(
         f=objective_position,
-        pbounds=bounds,
+        pbounds=POSITION_BOUNDS,
         verbose=2,
     )
-    optimizer.maximize(n_iter=100)
+    maximize_parallel(optimizer, n_iter=100, batch_size=batch_size)
 
     if optimizer.max is not None:
         print(optimizer.max)
@@ -121,6 +269,188 @@ def tune_position():
         monitor.plot_state()
 
 
+def successive_halving(
+    objective: Callable[..., float],
+    candidates: List[Dict[str, float]],
+    fidelities: List[Tuple[float, float]],
+    eta: int = 3,
+    processes: Union[int, None] = None,
+) -> Tuple[List[Tuple[Dict[str, float], float]], float]:
+    """
+    Maximizes an objective over the given candidate gains with successive halving. The objective
+    must accept total_time and time_step keyword arguments. All candidates are scored at the first,
+    cheapest fidelity, and only the best 1 / eta of them are promoted to the next fidelity, until
+    the survivors are scored at the last fidelity. Candidates are evaluated in parallel in the given
+    number of worker processes, which defaults to the number of CPUs. Returns the candidates scored
+    at the last fidelity with their objectives, best first, and the total simulated seconds.
+    """
+    simulated_time = 0.0
+    results: List[Tuple[Dict[str, float], float]] = []
+
+    with ProcessPoolExecutor(processes) as executor:
+        for rung, (total_time, time_step) in enumerate(fidelities):
+            if rung > 0:
+                num_promoted = max(1, len(results) // eta)
+                candidates = [params for params, _ in results[:num_promoted]]
+
+            futures = [
+                executor.submit(
+                    objective, **params, total_time=total_time, time_step=time_step
+                )
+                for params in candidates
+            ]
+            results = [
+                (params, future.result()) for params, future in zip(candidates, futures)
+            ]
+            results.sort(key=lambda result: result[1], reverse=True)
+            simulated_time += total_time * len(candidates)
+
+            print(
+                f"Scored {len(candidates)} candidates over {total_time:.0f} s with a time"
+                f" step of {time_step:.1f} s, best {results[0][1]:.4f}"
+            )
+
+    return results, simulated_time
+
+
+def tune_multi_fidelity(
+    objective: Callable[..., float],
+    bounds: Dict[str, Tuple[float, float]],
+    fidelities: List[Tuple[float, float]],
+    num_candidates: int = 81,
+    eta: int = 3,
+    generator: np.random.Generator = np.random.default_rng(),
+) -> Dict[str, float]:
+    """
+    Tunes a controller with successive halving over gains sampled uniformly between the given
+    bounds. Prints the simulated seconds spent compared to tuning with Bayesian optimization and to
+    scoring every candidate at full fidelity, and returns the best gains.
+    """
+    candidates = [
+        {name: generator.uniform(low, high) for name, (low, high) in bounds.items()}
+        for _ in range(num_candidates)
+    ]
+    results, simulated_time = successive_halving(objective, candidates, fidelities, eta)
+
+    full_time = fidelities[-1][0]
+    print(results[0])
+    print(f"Simulated {simulated_time:.0f} s")
+    print(f"Bayesian optimization simulates {NUM_TUNING_EVALUATIONS * full_time:.0f} s")
+    print(
+        f"Scoring every candidate at full fidelity simulates {num_candidates * full_time:.0f} s"
+    )
+    return results[0][0]
+
+
+def tune_velocity_multi_fidelity(num_candidates: int = 81, eta: int = 3):
+    """
+    Tunes the velocity controller with successive halving.
+    """
+    params = tune_multi_fidelity(
+        objective_velocity, VELOCITY_BOUNDS, VELOCITY_FIDELITIES, num_candidates, eta
+    )
+    monitor, _ = simulate_velocity(**params)
+    monitor.plot_state()
+
+
+def tune_position_multi_fidelity(num_candidates: int = 81, eta: int = 3):
+    """
+    Tunes the position controller with successive halving.
+    """
+    params = tune_multi_fidelity(
+        objective_position, POSITION_BOUNDS, POSITION_FIDELITIES, num_candidates, eta
+    )
+    monitor, _ = simulate_position(**params)
+    monitor.plot_state()
+
+
+def sweep_velocity(k_p: np.ndarray, k_i: np.ndarray, k_d: np.ndarray) -> np.ndarray:
+    """
+    Evaluates objective_velocity for many sets of gains at once by simulating one balloon per set
+    of gains in a batch. Returns the objective of each set of gains. The batch uses a different
+    integrator, so the objectives agree with objective_velocity to within the integration
+    tolerances.
+    """
+    num_balloons = len(k_p)
+    controller = BatchSequenceController(
+        (0.0, BatchVerticalVelocityController(num_balloons, 3.0, k_p, k_i, k_d)),
+        (1000.0, BatchVerticalVelocityController(num_balloons, -2.0, k_p, k_i, k_d)),
+        (1500.0, BatchVerticalVelocityController(num_balloons, 1.0, k_p, k_i, k_d)),
+        (2000.0, BatchVerticalVelocityController(num_balloons, 0.0, k_p, k_i, k_d)),
+    )
+
+    # Accumulate the error at each step rather than keeping the trajectories.
+    target_velocity = make_target_velocity(2501)
+    error = np.zeros(num_balloons)
+    for i, states in enumerate(
+        run_batch(BalloonBatch(num_balloons), controller, 1.0, 2500.0)
+    ):
+        error += np.abs(states["velocity"][:, 2] - target_velocity[i])
+    return -error / len(target_velocity)
+
+
+def sweep_position(k_p: np.ndarray, k_i: np.ndarray, k_d: np.ndarray) -> np.ndarray:
+    """
+    Evaluates objective_position for many sets of gains at once by simulating one balloon per set
+    of gains in a batch. Returns the objective of each set of gains. The batch uses a different
+    integrator, so the objectives agree with objective_position to within the integration
+    tolerances.
+    """
+    num_balloons = len(k_p)
+    controller = BatchSequenceController(
+        (0.0, BatchVerticalPositionController(num_balloons, 1000.0, k_p, k_i, k_d)),
+        (1500.0, BatchVerticalPositionController(num_balloons, 500.0, k_p, k_i, k_d)),
+        (3000.0, BatchVerticalPositionController(num_balloons, 750.0, k_p, k_i, k_d)),
+        (4500.0, BatchVerticalPositionController(num_balloons, 250.0, k_p, k_i, k_d)),
+    )
+
+    # Accumulate the error at each step rather than keeping the trajectories.
+    target_position = make_target_position(6001)
+    error = np.zeros(num_balloons)
+    for i, states in enumerate(
+        run_batch(BalloonBatch(num_balloons), controller, 1.0, 6000.0)
+    ):
+        error += np.abs(states["position"][:, 2] - target_position[i])
+    return -error / len(target_position)
+
+
+def grid_sweep(
+    sweep: Callable[[np.ndarray, np.ndarray, np.ndarray], np.ndarray],
+    bounds: Dict[str, Tuple[float, float]],
+    num_points: int,
+) -> Tuple[Tuple[np.ndarray, np.ndarray, np.ndarray], np.ndarray]:
+    """
+    Evaluates a sweep function on a regular grid with the given number of points between the bounds
+    of each gain. Returns the grid points of k_p, k_i, and k_d and the objective surface, which is
+    an array indexed by the grid points. Gains with equal bounds only use one point.
+    """
+    points = tuple(
+        np.linspace(low, high, 1 if low == high else num_points)
+        for low, high in (bounds["k_p"], bounds["k_i"], bounds["k_d"])
+    )
+    k_p, k_i, k_d = np.meshgrid(*points, indexing="ij")
+    objective = sweep(k_p.ravel(), k_i.ravel(), k_d.ravel())
+    return points, objective.reshape(k_p.shape)
+
+
+def random_sweep(
+    sweep: Callable[[np.ndarray, np.ndarray, np.ndarray], np.ndarray],
+    bounds: Dict[str, Tuple[float, float]],
+    num_samples: int,
+    generator: np.random.Generator = np.random.default_rng(),
+) -> Tuple[Dict[str, np.ndarray], np.ndarray]:
+    """
+    Evaluates a sweep function on gains sampled uniformly between the given bounds. Returns the
+    sampled gains and their objectives. The samples can be registered with a BayesianOptimization
+    before refining them.
+    """
+    params = {
+        name: generator.uniform(low, high, num_samples)
+        for name, (low, high) in bounds.items()
+    }
+    return params, sweep(params["k_p"], params["k_i"], params["k_d"])
+
+
 if __name__ == "__main__":
     tune_velocity()
     tune_position()
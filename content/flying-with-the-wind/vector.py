@@ -6,6 +6,12 @@ class Vector3(tuple):
     def __new__(cls, x, y, z):
         return super().__new__(cls, (x, y, z))
 
+    def __getnewargs__(self):
+        return tuple(self)
+
+    def __deepcopy__(self, memo):
+        return self
+
     def __add__(self, other):
         if isinstance(other, (int, float)):
             return Vector3(self.x + other, self.y + other, self.z + other)